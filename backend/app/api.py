@@ -4,12 +4,14 @@ Exposes endpoints for the Planner UI.
 """
 from typing import Optional, List, Dict
 from fastapi import APIRouter, Query, HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic import BaseModel
 from datetime import datetime
 import hashlib
 import secrets
 
+from . import async_db
 from . import db
 from . import mqtt_ingest
 from .zones import DISTRICTS
@@ -95,6 +97,19 @@ async def get_bins_latest():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _fetch_recent_telemetry(bin_id: Optional[str], limit: int) -> list:
+    """Read through asyncpg, or the psycopg2 pool if the async pool never started."""
+    try:
+        async_db.get_pool()
+    except RuntimeError:
+        if bin_id:
+            return await run_in_threadpool(db.get_recent_telemetry, bin_id, limit)
+        return await run_in_threadpool(db.get_all_recent_telemetry, limit)
+    if bin_id:
+        return await async_db.get_recent_telemetry(bin_id, limit)
+    return await async_db.get_all_recent_telemetry(limit)
+
+
 @router.get("/telemetry/recent", response_model=List[TelemetryRecord])
 async def get_recent_telemetry(
     bin_id: Optional[str] = Query(None, description="Bin ID to fetch telemetry for (optional - omit to get all bins)"),
@@ -107,15 +122,37 @@ async def get_recent_telemetry(
     Returns the most recent N records ordered by timestamp descending.
     """
     try:
+        rows = await _fetch_recent_telemetry(bin_id, limit)
         if bin_id:
-            rows = db.get_recent_telemetry(bin_id, limit)
             if not rows:
                 raise HTTPException(status_code=404, detail=f"No telemetry found for bin: {bin_id}")
         else:
-            rows = db.get_all_recent_telemetry(limit)
             if not rows:
                 return []  # Return empty list instead of 404 for all-bins query
-        return [TelemetryRecord(**dict(row)) for row in rows]
+        return [TelemetryRecord(**row) for row in rows]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/telemetry/{bin_id}/fill-series")
+async def get_fill_series(
+    bin_id: str,
+    limit: int = Query(100, ge=1, le=1000, description="Number of points to return")
+):
+    """
+    Get a bin's recent fill levels for charting.
+    Returns only timestamp and fill percentage, newest first.
+    """
+    try:
+        rows = db.get_recent_telemetry_fillseries(bin_id, limit)
+        if not rows:
+            raise HTTPException(status_code=404, detail=f"No telemetry found for bin: {bin_id}")
+        return {
+            "bin_id": bin_id,
+            "points": [{"ts": ts, "fill_pct": fill_pct} for ts, fill_pct in rows]
+        }
     except HTTPException:
         raise
     except Exception as e:
@@ -154,8 +191,8 @@ async def forecast_bins(
         else:
             target_dt = date_parser.parse(target_time)
         
-        # Get predictions
-        result = ml_prediction.forecast_all_bins(target_dt, threshold)
+        # Get predictions (blocking DB + NumPy work; keep it off the event loop)
+        result = await run_in_threadpool(ml_prediction.forecast_all_bins, target_dt, threshold)
         
         if "error" in result:
             raise HTTPException(status_code=500, detail=result["error"])
@@ -196,7 +233,7 @@ async def get_bin_prediction(
             target_dt = date_parser.parse(target_time)
         
         # Get prediction
-        prediction = ml_prediction.predict_fill_at_time(bin_id, target_dt)
+        prediction = await run_in_threadpool(ml_prediction.predict_fill_at_time, bin_id, target_dt)
         
         if "error" in prediction:
             raise HTTPException(status_code=404, detail=prediction["error"])
@@ -247,7 +284,8 @@ async def optimize_route(request: RouteOptimizationRequest):
             target_dt = date_parser.parse(request.target_time)
         
         # Get bins that need collection
-        bins_to_collect = ml_prediction.get_bins_needing_collection(
+        bins_to_collect = await run_in_threadpool(
+            ml_prediction.get_bins_needing_collection,
             target_dt, 
             request.threshold_pct
         )
@@ -261,7 +299,8 @@ async def optimize_route(request: RouteOptimizationRequest):
             }
         
         # Optimize route
-        route_result = route_optimizer.optimize_route(
+        route_result = await run_in_threadpool(
+            route_optimizer.optimize_route,
             bins_to_collect,
             request.depot_location,
             request.algorithm
@@ -294,7 +333,7 @@ async def get_bins_at_risk(
     
     try:
         target_time = datetime.utcnow() + timedelta(hours=threshold_hours)
-        bins = ml_prediction.get_bins_needing_collection(target_time, 80.0)
+        bins = await run_in_threadpool(ml_prediction.get_bins_needing_collection, target_time, 80.0)
         
         return {
             "threshold_hours": threshold_hours,
@@ -500,7 +539,7 @@ async def start_collection_day(collection_hours: int = Query(12, ge=1, le=24)):
     """
     from . import mqtt_commands
     try:
-        result = mqtt_commands.start_collection_day(collection_hours)
+        result = await run_in_threadpool(mqtt_commands.start_collection_day, collection_hours)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -515,7 +554,7 @@ async def end_collection_day():
     """
     from . import mqtt_commands
     try:
-        result = mqtt_commands.end_collection_day()
+        result = await run_in_threadpool(mqtt_commands.end_collection_day)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -758,6 +797,8 @@ async def delete_bin(bin_id: str, username: str = Depends(verify_admin)):
     success = db.delete_bin(bin_id)
     
     if success:
+        from . import mqtt_commands
+        mqtt_commands.clear_zone_bins_cache()
         return {
             "success": True,
             "message": f"Bin '{bin_id}' and all related data deleted",
@@ -846,7 +887,7 @@ async def start_zone_collection(request: ZoneCollectionRequest, username: str =
             }
         
         # Wake up all bins in the zone
-        result = mqtt_commands.wake_up_zone(request.zone_id, request.zone_name)
+        result = await run_in_threadpool(mqtt_commands.wake_up_zone, request.zone_id, request.zone_name)
         
         if not result.get('success') and result.get('total_bins', 0) == 0:
             raise HTTPException(status_code=404, detail="No bins found in this zone")
@@ -894,7 +935,7 @@ async def check_zone_collection(request: ZoneCollectionRequest, username: str =
     
     try:
         # Request status from all bins
-        result = mqtt_commands.request_zone_status(request.zone_id, request.zone_name)
+        result = await run_in_threadpool(mqtt_commands.request_zone_status, request.zone_id, request.zone_name)
         
         # Get detailed bin status
         bins_status = db.get_zone_bins_status(request.zone_id)
@@ -942,7 +983,7 @@ async def finish_zone_collection(request: ZoneCollectionRequest, username: str =
     
     try:
         # Request final status from all bins
-        result = mqtt_commands.request_zone_status(request.zone_id, request.zone_name)
+        result = await run_in_threadpool(mqtt_commands.request_zone_status, request.zone_id, request.zone_name)
         
         # Get detailed bin status
         bins_status = db.get_zone_bins_status(request.zone_id)
@@ -1001,7 +1042,7 @@ async def end_zone_collection(request: ZoneCollectionRequest, username: str = De
         session = db.get_active_collection_session(request.zone_id)
         
         # Put all bins to sleep
-        result = mqtt_commands.sleep_zone(request.zone_id, request.zone_name)
+        result = await run_in_threadpool(mqtt_commands.sleep_zone, request.zone_id, request.zone_name)
         
         # Update session status
         if session:
@@ -1080,6 +1121,7 @@ class FirmwareUpdateRequest(BaseModel):
 class BulkFirmwareUpdateRequest(BaseModel):
     zone_id: str
     version: str
+    window_seconds: Optional[int] = None
 
 
 class DiagnosticRequest(BaseModel):
@@ -1113,7 +1155,7 @@ async def provision_device(request: DeviceProvisionRequest, username: str = Depe
         
         # Create bin record
         if request.lat and request.lon:
-            db.upsert_bin(request.bin_id, request.lat, request.lon, datetime.utcnow().isoformat())
+            db.upsert_bin(request.bin_id, request.lat, request.lon, datetime.utcnow())
         
         # Store provisioning info
         db.provision_device(request.bin_id, request.bin_id, password_hash, username)
@@ -1250,7 +1292,7 @@ async def request_device_diagnostic(bin_id: str, request: DiagnosticRequest, use
 async def get_device_diagnostics(bin_id: str, limit: int = Query(10, le=50)):
     """Get diagnostic history for a device."""
     try:
-        diagnostics = db.get_device_diagnostics(bin_id, limit)
+        diagnostics = db.get_device_diagnostics(bin_id, limit, include_data=True)
         return {
             "bin_id": bin_id,
             "diagnostics": diagnostics,
@@ -1291,7 +1333,7 @@ async def create_firmware_version(request: FirmwareVersionRequest, username: str
 async def get_latest_firmware(stable_only: bool = Query(True)):
     """Get the latest available firmware version."""
     try:
-        firmware = db.get_latest_firmware(stable_only)
+        firmware = db.get_latest_firmware(stable_only, include_changelog=True)
         if not firmware:
             return {"message": "No firmware versions found", "firmware": None}
         return {"firmware": firmware}
@@ -1336,12 +1378,14 @@ async def initiate_bulk_firmware_update(request: BulkFirmwareUpdateRequest, user
         if not firmware:
             raise HTTPException(status_code=404, detail="Firmware version not found")
         
-        result = mqtt_commands.send_bulk_firmware_update(
+        result = await run_in_threadpool(
+            mqtt_commands.send_bulk_firmware_update,
             zone_id=request.zone_id,
             version=request.version,
             file_url=firmware.get('file_url', ''),
             checksum=firmware.get('checksum', ''),
-            file_size_kb=firmware.get('file_size_kb', 0)
+            file_size_kb=firmware.get('file_size_kb', 0),
+            window_seconds=request.window_seconds
         )
         
         return result
@@ -1387,7 +1431,7 @@ async def retry_pending_commands(max_age_seconds: int = Query(60), username: str
     from . import mqtt_commands
     
     try:
-        result = mqtt_commands.retry_pending_commands(max_age_seconds)
+        result = await run_in_threadpool(mqtt_commands.retry_pending_commands, max_age_seconds)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1399,7 +1443,7 @@ async def check_device_heartbeats(timeout_minutes: int = Query(5), username: str
     from . import mqtt_commands
     
     try:
-        result = mqtt_commands.check_device_heartbeats(timeout_minutes)
+        result = await run_in_threadpool(mqtt_commands.check_device_heartbeats, timeout_minutes)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
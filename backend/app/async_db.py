@@ -0,0 +1,92 @@
+"""
+Async database helpers for PostgreSQL (asyncpg).
+Used by FastAPI read endpoints so queries are awaited instead of blocking a
+worker. Everything else, including all writes, goes through db.py (psycopg2).
+"""
+import logging
+
+import asyncpg
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Connection Pool
+# ─────────────────────────────────────────────────────────────────────────────
+_pool = None
+
+
+async def init_pool():
+    """Create the asyncpg pool. Call from FastAPI startup."""
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    server_settings = {}
+    if config.POSTGRES_STATEMENT_TIMEOUT_MS and not config.USE_PGBOUNCER:
+        server_settings["statement_timeout"] = str(config.POSTGRES_STATEMENT_TIMEOUT_MS)
+
+    _pool = await asyncpg.create_pool(
+        host=config.DB_HOST,
+        port=config.DB_PORT,
+        database=config.POSTGRES_DB,
+        user=config.POSTGRES_USER,
+        password=config.POSTGRES_PASSWORD,
+        min_size=config.ASYNC_DB_POOL_MIN,
+        max_size=config.ASYNC_DB_POOL_MAX,
+        # asyncpg caches prepared statements per connection, which breaks
+        # under PgBouncer transaction pooling
+        statement_cache_size=0 if config.USE_PGBOUNCER else 100,
+        server_settings=server_settings or None,
+    )
+    logger.info(f"Async database pool ready ({config.DB_HOST}:{config.DB_PORT})")
+    return _pool
+
+
+async def close_pool():
+    """Close the asyncpg pool. Call from FastAPI shutdown."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool():
+    """Return the initialized pool."""
+    if _pool is None:
+        raise RuntimeError("Async database pool not initialized; call init_pool() first")
+    return _pool
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Telemetry Operations
+# ─────────────────────────────────────────────────────────────────────────────
+# Read-only: writes go through the write-behind queue in db.py.
+
+_SQL_GET_RECENT_TELEMETRY = """
+    SELECT id, ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon, received_at
+    FROM telemetry
+    WHERE bin_id = $1
+    ORDER BY ts DESC
+    LIMIT $2
+"""
+
+_SQL_GET_ALL_RECENT_TELEMETRY = """
+    SELECT id, ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon, received_at
+    FROM telemetry
+    ORDER BY ts DESC
+    LIMIT $1
+"""
+
+
+async def get_recent_telemetry(bin_id: str, limit: int = 100) -> list:
+    """Get the most recent telemetry records for a specific bin."""
+    rows = await get_pool().fetch(_SQL_GET_RECENT_TELEMETRY, bin_id, limit)
+    return [dict(r) for r in rows]
+
+
+async def get_all_recent_telemetry(limit: int = 500) -> list:
+    """Get the most recent telemetry records across all bins."""
+    rows = await get_pool().fetch(_SQL_GET_ALL_RECENT_TELEMETRY, limit)
+    return [dict(r) for r in rows]
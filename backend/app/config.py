@@ -18,6 +18,26 @@ MQTT_CA_CERT = os.getenv("MQTT_CA_CERT", "mqtt/certs/ca.crt")
 MQTT_USERNAME = os.getenv("MQTT_USERNAME", "backend_service")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", "CleanRoute@2025")
 
+# Worker threads running ingest handlers off the MQTT network thread; a bin's
+# messages always go to the same worker (0 = handle on the network thread)
+MQTT_INGEST_WORKERS = int(os.getenv("MQTT_INGEST_WORKERS", 4))
+# Fixed MQTT client id for the ingest subscriber. Setting it turns on a
+# persistent session (QoS 1 telemetry queued by the broker while offline);
+# only ONE process may use a given id. Empty = unique per process, clean session
+MQTT_INGEST_CLIENT_ID = os.getenv("MQTT_INGEST_CLIENT_ID", "")
+# Same for the command publisher: a fixed id enables a persistent session
+# (unacknowledged QoS 1 commands resent on reconnect), one process per id
+MQTT_COMMAND_CLIENT_ID = os.getenv("MQTT_COMMAND_CLIENT_ID", "")
+# Publish commands in the compact schema (short keys, epoch timestamp,
+# flattened params); devices must run firmware that understands it
+MQTT_COMPACT_COMMANDS = os.getenv("MQTT_COMPACT_COMMANDS", "false").lower() == "true"
+# QoS>0 publishes the command client keeps in flight before queueing
+MQTT_MAX_INFLIGHT = int(os.getenv("MQTT_MAX_INFLIGHT", 100))
+# Messages the command client buffers while reconnecting (0 = unlimited)
+MQTT_MAX_QUEUED = int(os.getenv("MQTT_MAX_QUEUED", 10000))
+# Seconds a fan-out batch waits for its PUBACKs
+MQTT_PUBLISH_TIMEOUT = float(os.getenv("MQTT_PUBLISH_TIMEOUT", 5))
+
 # ─────────────────────────────────────────────────────────────────────────────
 # PostgreSQL Settings
 # ─────────────────────────────────────────────────────────────────────────────
@@ -26,9 +46,74 @@ POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", 5432))
 POSTGRES_DB = os.getenv("POSTGRES_DB", "cleanroute_db")
 POSTGRES_USER = os.getenv("POSTGRES_USER", "cleanroute_user")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "cleanroute_pass")
+# Unix socket directory (e.g. /var/run/postgresql) when Postgres runs on the same host
+POSTGRES_SOCKET_DIR = os.getenv("POSTGRES_SOCKET_DIR", "")
+# Per-statement timeout in milliseconds (0 = server default)
+POSTGRES_STATEMENT_TIMEOUT_MS = int(os.getenv("POSTGRES_STATEMENT_TIMEOUT_MS", 0))
+
+# PgBouncer (transaction pooling) in front of Postgres - see pgbouncer/pgbouncer.ini
+USE_PGBOUNCER = os.getenv("USE_PGBOUNCER", "false").lower() == "true"
+PGBOUNCER_HOST = os.getenv("PGBOUNCER_HOST", POSTGRES_HOST)
+PGBOUNCER_PORT = int(os.getenv("PGBOUNCER_PORT", 6432))
+
+# Effective host/port and connection string for psycopg2
+# libpq treats a host starting with "/" as a socket directory; the port still
+# selects the socket file (.s.PGSQL.<port>) and the password is ignored under peer auth.
+if USE_PGBOUNCER:
+    DB_HOST, DB_PORT = PGBOUNCER_HOST, PGBOUNCER_PORT
+elif POSTGRES_SOCKET_DIR:
+    DB_HOST, DB_PORT = POSTGRES_SOCKET_DIR, POSTGRES_PORT
+else:
+    DB_HOST, DB_PORT = POSTGRES_HOST, POSTGRES_PORT
+DATABASE_URL = f"host={DB_HOST} port={DB_PORT} dbname={POSTGRES_DB} user={POSTGRES_USER} password={POSTGRES_PASSWORD}"
+# PgBouncer rejects the startup "options" parameter; it sets the timeout itself (connect_query)
+if POSTGRES_STATEMENT_TIMEOUT_MS and not USE_PGBOUNCER:
+    DATABASE_URL += f" options='-c statement_timeout={POSTGRES_STATEMENT_TIMEOUT_MS}'"
+
+# Connection pool size per backend process (kept small behind PgBouncer)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1 if USE_PGBOUNCER else 5))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 4 if USE_PGBOUNCER else 20))
+# Separate asyncpg pool for the async API reads; it adds to the budget above
+# (a process holds up to DB_POOL_MAX + ASYNC_DB_POOL_MAX connections)
+ASYNC_DB_POOL_MIN = int(os.getenv("ASYNC_DB_POOL_MIN", 1))
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", 2 if USE_PGBOUNCER else 5))
+
+# PREPARE hot statements per pooled connection (unsafe behind PgBouncer transaction pooling)
+DB_PREPARED_STATEMENTS = os.getenv(
+    "DB_PREPARED_STATEMENTS", "false" if USE_PGBOUNCER else "true"
+).lower() == "true"
+
+# Telemetry write-behind queue (MQTT ingest -> batched inserts)
+TELEMETRY_QUEUE_MAX = int(os.getenv("TELEMETRY_QUEUE_MAX", 10000))
+TELEMETRY_BATCH_SIZE = int(os.getenv("TELEMETRY_BATCH_SIZE", 500))
+TELEMETRY_FLUSH_INTERVAL = float(os.getenv("TELEMETRY_FLUSH_INTERVAL", 0.05))
+# Flushes with at least this many rows use COPY instead of multi-row INSERT
+COPY_BATCH_THRESHOLD = int(os.getenv("COPY_BATCH_THRESHOLD", 200))
+# Seconds telemetry shadow reports are coalesced per bin before being written
+SHADOW_FLUSH_INTERVAL = float(os.getenv("SHADOW_FLUSH_INTERVAL", 1.0))
+
+# Months of telemetry partitions to keep; older ones are dropped at startup (0 = keep all)
+TELEMETRY_RETENTION_MONTHS = int(os.getenv("TELEMETRY_RETENTION_MONTHS", 0))
+
+# Seconds to cache the latest-bins query between dashboard polls (0 = no cache)
+BINS_CACHE_TTL = float(os.getenv("BINS_CACHE_TTL", 2))
+
+# Seconds to cache zone -> bin_id membership lookups (0 = no cache)
+ZONE_BINS_CACHE_TTL = float(os.getenv("ZONE_BINS_CACHE_TTL", 60))
+
+# Seconds to cache the latest firmware lookup (0 = no cache)
+FIRMWARE_CACHE_TTL = float(os.getenv("FIRMWARE_CACHE_TTL", 30))
+
+# Caching CDN in front of the firmware origin; OTA commands point devices at it
+# (empty = devices download from the origin URL)
+FIRMWARE_CDN_URL = os.getenv("FIRMWARE_CDN_URL", "").rstrip("/")
+# Seconds a bulk OTA spreads device downloads over (0 = all start at once)
+FIRMWARE_DOWNLOAD_WINDOW = int(os.getenv("FIRMWARE_DOWNLOAD_WINDOW", 120))
+# Size of the HTTP Range requests devices download firmware in
+FIRMWARE_DOWNLOAD_CHUNK_KB = int(os.getenv("FIRMWARE_DOWNLOAD_CHUNK_KB", 4))
 
-# Connection string for psycopg2
-DATABASE_URL = f"host={POSTGRES_HOST} port={POSTGRES_PORT} dbname={POSTGRES_DB} user={POSTGRES_USER} password={POSTGRES_PASSWORD}"
+# Seconds to reuse the /health database probe result (0 = probe every call)
+DB_HEALTH_CACHE_TTL = float(os.getenv("DB_HEALTH_CACHE_TTL", 2))
 
 # ─────────────────────────────────────────────────────────────────────────────
 # API Settings
@@ -2,25 +2,107 @@
 Database connection helper for PostgreSQL.
 Provides connection pooling and helper functions.
 """
+import atexit
+import csv
+import io
+import logging
+import queue
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+import psycopg2.pool
+from psycopg2 import sql as pgsql
+from psycopg2.extras import Json, RealDictCursor, execute_values
 from contextlib import contextmanager
 from . import config
 
+logger = logging.getLogger(__name__)
+
 # ─────────────────────────────────────────────────────────────────────────────
-# Connection Helper
+# Connection Pool
 # ─────────────────────────────────────────────────────────────────────────────
 
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when exhausted; the
+# semaphore makes callers queue for a free connection instead.
+_pool_slots = threading.BoundedSemaphore(config.DB_POOL_MAX)
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements it has PREPAREd."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _get_pool():
+    """Create the process-wide connection pool on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    config.DB_POOL_MIN, config.DB_POOL_MAX, config.DATABASE_URL,
+                    connection_factory=PooledConnection
+                )
+    return _pool
+
+
 def get_connection():
-    """Get a new database connection."""
-    return psycopg2.connect(config.DATABASE_URL)
+    """Borrow a connection from the pool. Return it with put_connection()."""
+    _pool_slots.acquire()
+    try:
+        return _get_pool().getconn()
+    except Exception:
+        _pool_slots.release()
+        mark_db_unhealthy()
+        raise
+
+
+def put_connection(conn, close: bool = False):
+    """Return a borrowed connection to the pool (close=True discards it)."""
+    try:
+        _get_pool().putconn(conn, close=close or bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
+
+def get_pool_stats() -> dict:
+    """Connections currently borrowed and idle in the pool (zeros before first use)."""
+    pool = _pool
+    return {
+        "max": config.DB_POOL_MAX,
+        "in_use": len(pool._used) if pool is not None else 0,
+        "idle": len(pool._pool) if pool is not None else 0,
+    }
+
+
+def close_pool():
+    """Close all pooled connections."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+atexit.register(close_pool)
 
 
 @contextmanager
-def get_cursor(commit=False):
+def get_cursor(commit=False, cursor_factory=RealDictCursor, name=None):
     """
     Context manager for database cursor.
-    Automatically handles connection and cursor cleanup.
+    Borrows a pooled connection and always ends the transaction before
+    returning it (commit if requested, otherwise rollback).
+    Rows are dicts by default; pass cursor_factory=None for plain tuples.
+    Pass a name to get a server-side cursor (see stream_rows).
     
     Usage:
         with get_cursor() as cur:
@@ -28,63 +110,172 @@ def get_cursor(commit=False):
             rows = cur.fetchall()
     """
     conn = get_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    discard = False
     try:
-        yield cur
-        if commit:
-            conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
+        cur = conn.cursor(name=name, cursor_factory=cursor_factory)
+        try:
+            yield cur
+            if commit:
+                conn.commit()
+            else:
+                conn.rollback()
+        except Exception as e:
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                mark_db_unhealthy()
+            try:
+                conn.rollback()
+            except Exception:
+                # Connection is broken; don't hand it to the next caller
+                discard = True
+            raise
+        finally:
+            cur.close()
     finally:
-        cur.close()
-        conn.close()
+        put_connection(conn, close=discard)
+
+
+def stream_rows(sql: str, params=None, itersize: int = 500, cursor_factory=RealDictCursor):
+    """
+    Yield rows from a server-side (named) cursor, fetching `itersize` rows
+    per round-trip so large result sets never sit in memory at once.
+    The pooled connection is held until the generator is exhausted or closed.
+    """
+    with get_cursor(cursor_factory=cursor_factory, name=f"stream_{uuid.uuid4().hex}") as cur:
+        cur.itersize = itersize
+        cur.execute(sql, params)
+        yield from cur
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Prepared Statements
+# ─────────────────────────────────────────────────────────────────────────────
+# Hot single-row statements are PREPAREd once per pooled connection and then
+# run with EXECUTE, skipping parse/plan on every call. PgBouncer in
+# transaction mode can hand each transaction a different server connection,
+# so this is switched off there (config.DB_PREPARED_STATEMENTS).
+
+_PLACEHOLDER_RE = re.compile(r"\$\d+")
+
+
+def execute_prepared(cur, name: str, sql: str, params: tuple):
+    """
+    Execute `sql` (written with $1..$n placeholders, in order) as the
+    prepared statement `name`, preparing it on this connection if needed.
+    Falls back to a plain execute when prepared statements are disabled.
+    """
+    conn = cur.connection
+    prepared = getattr(conn, "prepared", None)
+    if not config.DB_PREPARED_STATEMENTS or prepared is None:
+        cur.execute(_PLACEHOLDER_RE.sub("%s", sql), params)
+        return
+    if name not in prepared:
+        # PREPARE is not rolled back with the transaction, so this sticks
+        cur.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name}({placeholders})", params)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Health Check
 # ─────────────────────────────────────────────────────────────────────────────
 
+# (monotonic time checked, result) of the last probe; None forces a fresh one
+_db_health = None
+
+
 def check_db_connection() -> bool:
-    """Check if database connection is healthy."""
+    """
+    Check if database connection is healthy.
+    The result is reused for DB_HEALTH_CACHE_TTL seconds so frequent
+    load-balancer probes don't each borrow a pool connection.
+    """
+    global _db_health
+    cached = _db_health
+    if cached is not None and time.monotonic() - cached[0] < config.DB_HEALTH_CACHE_TTL:
+        return cached[1]
     try:
-        with get_cursor() as cur:
+        with get_cursor(cursor_factory=None) as cur:
             cur.execute("SELECT 1")
-            return True
+        ok = True
     except Exception:
-        return False
+        ok = False
+    _db_health = (time.monotonic(), ok)
+    return ok
+
+
+def mark_db_unhealthy():
+    """Drop the cached health result after a connection-level error."""
+    global _db_health
+    _db_health = None
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Bin Operations
 # ─────────────────────────────────────────────────────────────────────────────
 
-def upsert_bin(bin_id: str, lat: float, lon: float, last_seen: str):
+_SQL_UPSERT_BIN = """
+    INSERT INTO bins (bin_id, lat, lon, last_seen, last_emptied, sleep_mode)
+    VALUES ($1, $2, $3, $4, $5, FALSE)
+    ON CONFLICT (bin_id) DO UPDATE SET
+        lat = EXCLUDED.lat,
+        lon = EXCLUDED.lon,
+        last_seen = EXCLUDED.last_seen,
+        last_emptied = COALESCE(EXCLUDED.last_emptied, bins.last_emptied),
+        sleep_mode = FALSE
+"""
+
+
+def upsert_bin(bin_id: str, lat: float, lon: float, last_seen: datetime, emptied_at: datetime = None):
     """
     Insert or update a bin record.
     Updates last_seen timestamp on every telemetry message.
     When telemetry is received, the device is awake (sleep_mode = FALSE).
-    """
-    sql = """
-        INSERT INTO bins (bin_id, lat, lon, last_seen, sleep_mode)
-        VALUES (%s, %s, %s, %s, FALSE)
-        ON CONFLICT (bin_id) DO UPDATE SET
-            lat = EXCLUDED.lat,
-            lon = EXCLUDED.lon,
-            last_seen = EXCLUDED.last_seen,
-            sleep_mode = FALSE
+    If emptied_at is given, last_emptied is set in the same statement.
     """
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (bin_id, lat, lon, last_seen))
+        execute_prepared(cur, "upsert_bin", _SQL_UPSERT_BIN, (bin_id, lat, lon, last_seen, emptied_at))
+    if emptied_at is not None:
+        clear_bins_latest_cache()
+
 
+_SQL_UPDATE_EMPTIED = "UPDATE bins SET last_emptied = $1 WHERE bin_id = $2"
 
-def update_bin_emptied(bin_id: str, emptied_at: str):
+
+def update_bin_emptied(bin_id: str, emptied_at: datetime):
     """Update the last_emptied timestamp when a bin is emptied."""
-    sql = """
-        UPDATE bins SET last_emptied = %s WHERE bin_id = %s
-    """
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (emptied_at, bin_id))
+        execute_prepared(cur, "update_bin_emptied", _SQL_UPDATE_EMPTIED, (emptied_at, bin_id))
+    clear_bins_latest_cache()
+
+
+_SQL_BINS_LATEST = """
+    SELECT
+        b.bin_id,
+        b.lat,
+        b.lon,
+        b.last_seen,
+        b.last_emptied,
+        b.sleep_mode,
+        t.fill_pct,
+        t.batt_v,
+        t.temp_c,
+        t.ts as last_telemetry_ts
+    FROM bins b
+    LEFT JOIN LATERAL (
+        SELECT fill_pct, batt_v, temp_c, ts
+        FROM telemetry
+        WHERE bin_id = b.bin_id
+        ORDER BY ts DESC
+        LIMIT 1
+    ) t ON TRUE
+    ORDER BY b.bin_id
+"""
+
+
+# Short-lived cache so dashboards polling /bins/latest share one query per TTL window
+_bins_latest_cache = {"rows": None, "expires_at": 0.0}
+_bins_latest_lock = threading.Lock()
 
 
 def get_all_bins_latest():
@@ -92,26 +283,33 @@ def get_all_bins_latest():
     Get all bins with their latest telemetry data.
     Returns one row per bin with the most recent fill percentage.
     Bins in sleep mode are marked as offline.
+
+    Results are cached for config.BINS_CACHE_TTL seconds (0 disables caching).
     """
-    sql = """
-        SELECT DISTINCT ON (b.bin_id)
-            b.bin_id,
-            b.lat,
-            b.lon,
-            b.last_seen,
-            b.last_emptied,
-            b.sleep_mode,
-            t.fill_pct,
-            t.batt_v,
-            t.temp_c,
-            t.ts as last_telemetry_ts
-        FROM bins b
-        LEFT JOIN telemetry t ON b.bin_id = t.bin_id
-        ORDER BY b.bin_id, t.ts DESC
-    """
-    with get_cursor() as cur:
-        cur.execute(sql)
-        return cur.fetchall()
+    if config.BINS_CACHE_TTL <= 0:
+        with get_cursor() as cur:
+            cur.execute(_SQL_BINS_LATEST)
+            return cur.fetchall()
+
+    if _bins_latest_cache["rows"] is not None and time.monotonic() < _bins_latest_cache["expires_at"]:
+        return _bins_latest_cache["rows"]
+
+    with _bins_latest_lock:
+        # Another thread may have refreshed the cache while we waited
+        if _bins_latest_cache["rows"] is not None and time.monotonic() < _bins_latest_cache["expires_at"]:
+            return _bins_latest_cache["rows"]
+        with get_cursor() as cur:
+            cur.execute(_SQL_BINS_LATEST)
+            rows = cur.fetchall()
+        _bins_latest_cache["rows"] = rows
+        _bins_latest_cache["expires_at"] = time.monotonic() + config.BINS_CACHE_TTL
+        return rows
+
+
+def clear_bins_latest_cache():
+    """Drop the cached get_all_bins_latest result."""
+    _bins_latest_cache["rows"] = None
+    _bins_latest_cache["expires_at"] = 0.0
 
 
 def ensure_sleep_mode_column():
@@ -128,7 +326,6 @@ def ensure_sleep_mode_column():
 
 def set_bin_sleep_mode(bin_id: str, sleep_mode: bool):
     """Set the sleep mode for a specific bin."""
-    ensure_sleep_mode_column()
     sql = """
         UPDATE bins SET sleep_mode = %s WHERE bin_id = %s
     """
@@ -137,23 +334,31 @@ def set_bin_sleep_mode(bin_id: str, sleep_mode: bool):
 
 
 def set_zone_sleep_mode(bin_ids: list, sleep_mode: bool):
-    """Set the sleep mode for multiple bins."""
-    ensure_sleep_mode_column()
+    """Set the sleep mode for multiple bins (waking also stamps last_wake_command)."""
     if not bin_ids:
         return
     sql = """
-        UPDATE bins SET sleep_mode = %s WHERE bin_id = ANY(%s)
+        UPDATE bins
+        SET sleep_mode = %(sleep_mode)s,
+            last_wake_command = CASE WHEN %(sleep_mode)s THEN last_wake_command ELSE NOW() END
+        WHERE bin_id IN (SELECT UNNEST(%(bin_ids)s::text[]))
     """
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (sleep_mode, bin_ids))
+        cur.execute(sql, {"sleep_mode": sleep_mode, "bin_ids": bin_ids})
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Telemetry Operations
 # ─────────────────────────────────────────────────────────────────────────────
 
+_SQL_INSERT_TELEMETRY = """
+    INSERT INTO telemetry (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+"""
+
+
 def insert_telemetry(
-    ts: str,
+    ts: datetime,
     bin_id: str,
     fill_pct: float,
     batt_v: float = None,
@@ -162,42 +367,712 @@ def insert_telemetry(
     lat: float = None,
     lon: float = None
 ):
-    """Insert a new telemetry record."""
+    """
+    Insert a new telemetry record.
+
+    The transaction runs with synchronous_commit off, so COMMIT returns
+    before the WAL is flushed to disk. A server crash can lose the last
+    few hundred milliseconds of readings, which is acceptable for sensor
+    data (the next reading supersedes it) but not for bin/admin records,
+    so this is only applied here. The bin's fill-rate state advances in
+    the same transaction.
+    """
+    row = (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon)
+    with get_cursor(commit=True) as cur:
+        cur.execute("SET LOCAL synchronous_commit = off")
+        execute_prepared(cur, "insert_telemetry", _SQL_INSERT_TELEMETRY, row)
+        _update_fill_rate_state(cur, [row])
+
+
+def _copy_rows(cur, copy_sql: str, rows) -> int:
+    """Stream tuples to a COPY ... FROM STDIN WITH (FORMAT csv) statement."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    count = 0
+    for row in rows:
+        writer.writerow(["" if v is None else v for v in row])
+        count += 1
+    if count == 0:
+        return 0
+    buf.seek(0)
+    cur.copy_expert(copy_sql, buf)
+    return count
+
+
+def _copy_telemetry_rows(cur, rows) -> int:
+    """COPY telemetry tuples through an open cursor."""
     sql = """
-        INSERT INTO telemetry (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        COPY telemetry (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon)
+        FROM STDIN WITH (FORMAT csv)
+    """
+    return _copy_rows(cur, sql, rows)
+
+
+# Rows for bins that don't exist (yet) are skipped instead of failing the batch
+_SQL_INSERT_TELEMETRY_ROWS = """
+    INSERT INTO telemetry (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon)
+    SELECT v.ts, v.bin_id, v.fill_pct, v.batt_v, v.temp_c, v.emptied, v.lat, v.lon
+    FROM (VALUES %s) AS v (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon)
+    JOIN bins b ON b.bin_id = v.bin_id
+"""
+# Fixed row template, so execute_values doesn't derive one from each batch
+_TELEMETRY_ROW_TEMPLATE = (
+    "(%s::timestamptz, %s::text, %s::float8, %s::float8, %s::float8, "
+    "%s::boolean, %s::float8, %s::float8)"
+)
+
+
+def _insert_telemetry_rows(cur, rows) -> int:
+    """
+    Write telemetry tuples through an open cursor, using COPY for large
+    batches. Rows for unknown bins are skipped.
+
+    Returns:
+        Number of rows inserted
+    """
+    if len(rows) >= COPY_BATCH_THRESHOLD:
+        # COPY into a scratch table, then keep only rows for known bins
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS telemetry_stage (
+                ts TIMESTAMPTZ, bin_id TEXT, fill_pct DOUBLE PRECISION,
+                batt_v DOUBLE PRECISION, temp_c DOUBLE PRECISION, emptied BOOLEAN,
+                lat DOUBLE PRECISION, lon DOUBLE PRECISION
+            ) ON COMMIT DROP
+        """)
+        _copy_rows(cur, "COPY telemetry_stage FROM STDIN WITH (FORMAT csv)", rows)
+        cur.execute("""
+            INSERT INTO telemetry (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon)
+            SELECT s.ts, s.bin_id, s.fill_pct, s.batt_v, s.temp_c, s.emptied, s.lat, s.lon
+            FROM telemetry_stage s
+            JOIN bins b ON b.bin_id = s.bin_id
+        """)
+        inserted = cur.rowcount
+        cur.execute("TRUNCATE telemetry_stage")
+        return inserted
+    # One statement for the whole batch (batches stay below COPY_BATCH_THRESHOLD)
+    execute_values(cur, _SQL_INSERT_TELEMETRY_ROWS, rows,
+                   template=_TELEMETRY_ROW_TEMPLATE, page_size=len(rows))
+    return cur.rowcount
+
+
+def insert_telemetry_copy(rows) -> int:
+    """
+    Bulk-load telemetry rows with COPY FROM STDIN.
+
+    Intended for backfills and large bursts where per-row INSERTs dominate.
+    Each row is a tuple of (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon);
+    None values are loaded as NULL. Like insert_telemetry, this runs with
+    synchronous_commit off and advances fill-rate state in the same transaction.
+
+    Returns:
+        Number of rows copied
+    """
+    rows = list(rows)
+    with get_cursor(commit=True) as cur:
+        cur.execute("SET LOCAL synchronous_commit = off")
+        copied = _copy_telemetry_rows(cur, rows)
+        _update_fill_rate_state(cur, rows)
+        return copied
+
+
+# Batches at least this large are loaded with COPY instead of a multi-row INSERT;
+# below it COPY's per-call setup costs more than it saves
+COPY_BATCH_THRESHOLD = config.COPY_BATCH_THRESHOLD
+
+
+def insert_telemetry_batch(rows) -> int:
+    """
+    Insert many telemetry rows in one statement.
+
+    Rows are (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon) tuples;
+    rows for unknown bins are skipped. Runs with synchronous_commit off (see
+    insert_telemetry); very large batches are loaded with COPY.
+
+    Returns:
+        Number of rows inserted
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    with get_cursor(commit=True) as cur:
+        cur.execute("SET LOCAL synchronous_commit = off")
+        return _write_telemetry_rows(cur, rows)
+
+
+def ensure_telemetry_partitions(months_ahead: int = 2):
+    """
+    Create monthly telemetry partitions from the current month up to
+    `months_ahead` months out.
+
+    If the default partition already holds rows for a missing month (the
+    month started before its partition existed), they are moved into the
+    new partition. Each month is handled under its own savepoint, so one
+    failure is logged without blocking the others.
+
+    Does nothing unless telemetry has been converted to a partitioned table
+    (see migrations/001_partition_telemetry.sql). Safe to call repeatedly.
+    """
+    with get_cursor(commit=True) as cur:
+        cur.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('telemetry')"
+        )
+        if cur.fetchone() is None:
+            return
+
+        cur.execute("""
+            SELECT c.oid::regclass::text AS name
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass('telemetry')
+              AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT'
+        """)
+        row = cur.fetchone()
+        default_partition = row['name'] if row else None
+
+        month = datetime.now(timezone.utc).date().replace(day=1)
+        for _ in range(months_ahead + 1):
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            name = f"telemetry_{month:%Y_%m}"
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (name,))
+            if not cur.fetchone()['present']:
+                cur.execute("SAVEPOINT telemetry_partition")
+                try:
+                    _create_telemetry_partition(cur, name, month, next_month, default_partition)
+                    cur.execute("RELEASE SAVEPOINT telemetry_partition")
+                except Exception as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT telemetry_partition")
+                    logger.error(f"Could not create telemetry partition {name}: {e}")
+            month = next_month
+
+
+def _create_telemetry_partition(cur, name: str, start, end, default_partition: str = None):
+    """Create one monthly partition, moving its rows out of the default partition first."""
+    table = pgsql.Identifier(name)
+    stranded = False
+    if default_partition:
+        cur.execute(
+            pgsql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE ts >= %s AND ts < %s) AS stranded")
+            .format(pgsql.SQL(default_partition)),
+            (start, end)
+        )
+        stranded = cur.fetchone()['stranded']
+    if not stranded:
+        cur.execute(
+            pgsql.SQL("CREATE TABLE {} PARTITION OF telemetry FOR VALUES FROM (%s) TO (%s)")
+            .format(table),
+            (start, end)
+        )
+        return
+    cur.execute(
+        pgsql.SQL("CREATE TABLE {} (LIKE telemetry INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        .format(table)
+    )
+    cur.execute(
+        pgsql.SQL("""
+            WITH moved AS (
+                DELETE FROM {} WHERE ts >= %s AND ts < %s RETURNING *
+            )
+            INSERT INTO {} SELECT * FROM moved
+        """).format(pgsql.SQL(default_partition), table),
+        (start, end)
+    )
+    logger.warning(f"Moved {cur.rowcount} telemetry rows from {default_partition} into {name}")
+    cur.execute(
+        pgsql.SQL("ALTER TABLE telemetry ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)")
+        .format(table),
+        (start, end)
+    )
+
+
+def drop_expired_telemetry_partitions(retention_months: int = None) -> list:
+    """
+    Drop monthly telemetry partitions that end before the retention window,
+    so old history is removed with DROP TABLE instead of a large DELETE.
+
+    retention_months defaults to config.TELEMETRY_RETENTION_MONTHS; 0 keeps
+    everything. Only telemetry_YYYY_MM partitions are considered (never the
+    default partition). Returns the names of the dropped partitions.
+    """
+    if retention_months is None:
+        retention_months = config.TELEMETRY_RETENTION_MONTHS
+    if retention_months <= 0:
+        return []
+
+    cutoff = datetime.now(timezone.utc).date().replace(day=1)
+    for _ in range(retention_months):
+        cutoff = (cutoff - timedelta(days=1)).replace(day=1)
+    cutoff_name = f"telemetry_{cutoff:%Y_%m}"
+
+    dropped = []
+    with get_cursor(commit=True) as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass('telemetry')
+              AND c.relname ~ '^telemetry_[0-9]{4}_[0-9]{2}$'
+        """)
+        for row in cur.fetchall():
+            # Zero-padded names sort chronologically
+            if row['relname'] < cutoff_name:
+                cur.execute(pgsql.SQL("DROP TABLE {}").format(pgsql.Identifier(row['relname'])))
+                dropped.append(row['relname'])
+    if dropped:
+        logger.info(f"Dropped expired telemetry partitions: {', '.join(sorted(dropped))}")
+    return dropped
+
+
+# Seconds between partition maintenance runs in the ingest writer
+PARTITION_MAINTENANCE_INTERVAL = 6 * 3600
+
+
+def maintain_telemetry_partitions():
+    """
+    Create upcoming telemetry partitions and drop expired ones. Runs at
+    startup and periodically from the ingest writer; failures are logged,
+    never raised, so they can't block other startup work or ingest.
+    """
+    try:
+        ensure_telemetry_partitions()
+    except Exception as e:
+        logger.error(f"Telemetry partition creation failed: {e}")
+    try:
+        drop_expired_telemetry_partitions()
+    except Exception as e:
+        logger.error(f"Telemetry partition cleanup failed: {e}")
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Ingest Write-Behind Queue
+# ─────────────────────────────────────────────────────────────────────────────
+# MQTT handlers queue bin sightings, telemetry, heartbeat and power rows here,
+# and the command publisher queues its command log entries; one background
+# thread drains them and writes each batch in a single transaction. Shadow
+# reports are coalesced per bin and ride along at most once per interval.
+
+INGEST_QUEUE = queue.Queue(maxsize=config.TELEMETRY_QUEUE_MAX)
+_ingest_writer = None
+_ingest_writer_stop = threading.Event()
+
+# bin_id -> [merged reported state, number of reports], flushed by the writer
+_pending_shadows = {}
+_pending_shadows_lock = threading.Lock()
+_shadows_flushed_at = 0.0
+
+
+def _enqueue(kind: str, row) -> bool:
+    """
+    Queue a row for the background writer.
+
+    When the queue is full the oldest row is dropped to make room, so a
+    database stall never blocks the MQTT callback thread.
+
+    Returns:
+        False if an older row had to be dropped
+    """
+    item = (kind, row)
+    try:
+        INGEST_QUEUE.put_nowait(item)
+        return True
+    except queue.Full:
+        try:
+            INGEST_QUEUE.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            INGEST_QUEUE.put_nowait(item)
+        except queue.Full:
+            pass
+        logger.warning("Ingest queue full, dropped oldest row")
+        return False
+
+
+def enqueue_bin_seen(bin_id: str, lat: float, lon: float, last_seen: datetime,
+                     emptied_at: datetime = None) -> bool:
+    """Queue a bin upsert (see upsert_bin); the bin is also marked online."""
+    return _enqueue("bin", (bin_id, lat, lon, last_seen, emptied_at))
+
+
+def enqueue_shadow_reported(bin_id: str, state: dict) -> bool:
+    """
+    Merge a reported state into the pending shadow update for this bin. The
+    writer flushes pending shadows every SHADOW_FLUSH_INTERVAL, so a bin's
+    shadow is written at most once per interval however often it reports.
+    """
+    with _pending_shadows_lock:
+        entry = _pending_shadows.get(bin_id)
+        if entry is None:
+            _pending_shadows[bin_id] = [dict(state), 1]
+        else:
+            entry[0].update(state)
+            entry[1] += 1
+    return True
+
+
+def _take_pending_shadows(force: bool = False) -> dict:
+    """Swap out pending shadow updates once SHADOW_FLUSH_INTERVAL has passed."""
+    global _pending_shadows, _shadows_flushed_at
+    now = time.monotonic()
+    if not force and now - _shadows_flushed_at < config.SHADOW_FLUSH_INTERVAL:
+        return {}
+    with _pending_shadows_lock:
+        pending, _pending_shadows = _pending_shadows, {}
+    _shadows_flushed_at = now
+    return pending
+
+
+def enqueue_telemetry(row) -> bool:
+    """Queue a (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon) telemetry row."""
+    return _enqueue("telemetry", row)
+
+
+def enqueue_heartbeat(bin_id: str, rssi: int = None, uptime_seconds: int = None,
+                      free_memory_kb: int = None, firmware_version: str = None) -> bool:
+    """Queue a heartbeat; the bin is marked online when the batch is written."""
+    return _enqueue("heartbeat", (bin_id, rssi, uptime_seconds, free_memory_kb, firmware_version))
+
+
+def enqueue_power_reading(bin_id: str, batt_v: float, batt_pct: float = None,
+                          charging: bool = False, power_source: str = 'battery') -> bool:
+    """Queue a battery reading for power profiling."""
+    return _enqueue("power", (bin_id, batt_v, batt_pct, charging, power_source))
+
+
+def enqueue_command_log(bin_id: str, command_type: str, payload: dict) -> bool:
+    """Queue a commands_log entry, stamped with the time it was sent."""
+    return _enqueue("command", (bin_id, command_type, payload, datetime.utcnow()))
+
+
+def _insert_command_log_rows(cur, rows):
+    """Write (bin_id, command_type, payload, sent_at) tuples through an open cursor."""
+    execute_values(
+        cur,
+        "INSERT INTO commands_log (bin_id, command_type, payload, sent_at) VALUES %s",
+        [(bin_id, command_type, Json(payload), sent_at)
+         for bin_id, command_type, payload, sent_at in rows],
+        page_size=len(rows)
+    )
+
+
+def _merge_bin_rows(rows) -> dict:
+    """
+    Collapse (bin_id, lat, lon, last_seen, emptied_at) tuples to one per bin.
+    The newest last_seen wins, and any emptied_at in the batch is kept (the
+    last to arrive, if several), even when it came on an older row.
+    """
+    merged = {}
+    for bin_id, lat, lon, last_seen, emptied_at in rows:
+        prev = merged.get(bin_id)
+        if prev is not None:
+            try:
+                newer = last_seen >= prev[3]
+            except TypeError:  # naive vs aware stamps: fall back to arrival order
+                newer = True
+            if emptied_at is None:
+                emptied_at = prev[4]
+            if not newer:
+                merged[bin_id] = prev[:4] + (emptied_at,)
+                continue
+        merged[bin_id] = (bin_id, lat, lon, last_seen, emptied_at)
+    return merged
+
+
+def _upsert_bin_rows(cur, rows):
+    """
+    Upsert (bin_id, lat, lon, last_seen, emptied_at) tuples through an open
+    cursor and mark the bins online, one row per bin (see _merge_bin_rows).
+    last_seen never moves backwards.
+    """
+    merged = _merge_bin_rows(rows)
+    execute_values(
+        cur,
+        """
+        INSERT INTO bins (bin_id, lat, lon, last_seen, last_emptied, sleep_mode, device_status)
+        VALUES %s
+        ON CONFLICT (bin_id) DO UPDATE SET
+            lat = EXCLUDED.lat,
+            lon = EXCLUDED.lon,
+            last_seen = GREATEST(bins.last_seen, EXCLUDED.last_seen),
+            last_emptied = COALESCE(EXCLUDED.last_emptied, bins.last_emptied),
+            sleep_mode = FALSE,
+            device_status = 'online'
+        """,
+        list(merged.values()),
+        template="(%s, %s, %s, %s, %s, FALSE, 'online')",
+        page_size=len(merged)
+    )
+    return any(row[4] is not None for row in merged.values())
+
+
+def _merge_shadow_rows(cur, merged: dict):
+    """
+    Write {bin_id: [state, reports]} into device_shadow through an open cursor;
+    version advances by the number of reports merged.
+    """
+    execute_values(
+        cur,
+        """
+        INSERT INTO device_shadow (bin_id, reported_state, last_reported_at, version)
+        SELECT v.bin_id, v.state, NOW(), v.reports
+        FROM (VALUES %s) AS v (bin_id, state, reports)
+        JOIN bins b ON b.bin_id = v.bin_id
+        ON CONFLICT (bin_id) DO UPDATE SET
+            reported_state = device_shadow.reported_state || EXCLUDED.reported_state,
+            last_reported_at = NOW(),
+            version = device_shadow.version + EXCLUDED.version
+        """,
+        [(bin_id, Json(state), reports) for bin_id, (state, reports) in merged.items()],
+        template="(%s, %s::jsonb, %s::int)",
+        page_size=len(merged)
+    )
+
+
+def _drain_ingest_queue(block: bool = True) -> list:
+    """Collect up to TELEMETRY_BATCH_SIZE items, waiting at most TELEMETRY_FLUSH_INTERVAL."""
+    batch = []
+    deadline = time.monotonic() + config.TELEMETRY_FLUSH_INTERVAL
+    while len(batch) < config.TELEMETRY_BATCH_SIZE:
+        timeout = deadline - time.monotonic()
+        try:
+            if block and timeout > 0:
+                batch.append(INGEST_QUEUE.get(timeout=timeout))
+            else:
+                batch.append(INGEST_QUEUE.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _write_telemetry_rows(cur, rows) -> int:
+    """Insert telemetry and advance the bins' fill-rate state; returns rows inserted."""
+    inserted = _insert_telemetry_rows(cur, rows)
+    _update_fill_rate_state(cur, rows)
+    return inserted
+
+
+def _write_shadow_rows(cur, rows):
+    """Merge (bin_id, [state, reports]) pairs into device_shadow."""
+    _merge_shadow_rows(cur, dict(rows))
+
+
+# Writer per queued kind, in write order: bins first, the other tables reference them
+_INGEST_WRITERS = (
+    ("bin", _upsert_bin_rows),
+    ("telemetry", _write_telemetry_rows),
+    ("shadow", _write_shadow_rows),
+    ("heartbeat", _insert_heartbeat_rows),
+    ("power", _insert_power_rows),
+    ("command", _insert_command_log_rows),
+)
+
+
+def _is_connection_error(e: Exception) -> bool:
+    """True if the database is unreachable, as opposed to a row being rejected."""
+    if isinstance(e, psycopg2.InterfaceError):
+        return True
+    return (isinstance(e, psycopg2.OperationalError)
+            and not isinstance(e, psycopg2.extensions.QueryCanceledError))
+
+
+def _write_in_savepoint(cur, writer, rows):
+    """
+    Run writer(cur, rows) under a savepoint.
+
+    Returns:
+        None on success, otherwise the error (the savepoint is rolled back)
+    """
+    cur.execute("SAVEPOINT ingest_rows")
+    try:
+        writer(cur, rows)
+    except Exception as e:
+        if _is_connection_error(e):
+            raise
+        cur.execute("ROLLBACK TO SAVEPOINT ingest_rows")
+        return e
+    cur.execute("RELEASE SAVEPOINT ingest_rows")
+    return None
+
+
+def _write_ingest_groups(groups: list, isolate: bool):
+    """
+    Write (kind, writer, rows) groups in one transaction. With isolate, each
+    group runs under its own savepoint and a failing group is retried row by
+    row, so a bad row only loses itself.
     """
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon))
+        cur.execute("SET LOCAL synchronous_commit = off")
+        for kind, writer, rows in groups:
+            if not isolate:
+                writer(cur, rows)
+                continue
+            if _write_in_savepoint(cur, writer, rows) is None:
+                continue
+            dropped, error = 0, None
+            for row in rows:
+                row_error = _write_in_savepoint(cur, writer, [row])
+                if row_error is not None:
+                    dropped += 1
+                    error = row_error
+            if dropped:
+                logger.error(f"Dropped {dropped} of {len(rows)} queued {kind} rows: {error}")
+
+
+def _flush_ingest_batch(batch: list, shadows: dict = None):
+    """
+    Write one drained batch (synchronous_commit off). The whole batch goes in
+    one transaction; if that fails on a rejected row, it is written again
+    with each kind, and then each row, isolated under savepoints.
+
+    Connection errors propagate so the writer can keep the batch and retry.
+    """
+    by_kind = {kind: [] for kind, _ in _INGEST_WRITERS}
+    for kind, row in batch:
+        by_kind[kind].append(row)
+    if shadows:
+        by_kind["shadow"] = list(shadows.items())
+    groups = [(kind, writer, by_kind[kind]) for kind, writer in _INGEST_WRITERS if by_kind[kind]]
+    if not groups:
+        return
+
+    try:
+        _write_ingest_groups(groups, isolate=False)
+    except Exception as e:
+        if _is_connection_error(e):
+            raise
+        logger.warning(f"Ingest batch rejected ({e}); writing row groups separately")
+        _write_ingest_groups(groups, isolate=True)
+
+    if any(row[4] is not None for row in by_kind["bin"]):
+        clear_bins_latest_cache()
+    if by_kind["telemetry"]:
+        # Only now can a forecast see the new samples; drop rates cached before them
+        from . import ml_prediction
+        for bin_id in {row[1] for row in by_kind["telemetry"]}:
+            ml_prediction.invalidate_ewma_cache(bin_id)
+
+
+# Longest pause between attempts while the database is unreachable
+INGEST_RETRY_MAX_DELAY = 30.0
+
+
+def _ingest_writer_loop():
+    """
+    Background thread: flush queued rows in batches until stopped.
+
+    While the database is unreachable the current batch is kept and retried
+    with exponential backoff (new rows keep queueing, oldest dropped first
+    once the queue is full). On shutdown a batch that still can't be written
+    is dropped.
+    """
+    batch, shadows = [], {}
+    delay = 0.0
+    # Startup already ran partition maintenance (init_all_iot_tables)
+    next_maintenance = time.monotonic() + PARTITION_MAINTENANCE_INTERVAL
+    while (not _ingest_writer_stop.is_set() or batch or shadows
+           or not INGEST_QUEUE.empty() or _pending_shadows):
+        stopping = _ingest_writer_stop.is_set()
+        if not stopping and time.monotonic() >= next_maintenance:
+            # Keep next month's partition in place however long the process runs
+            maintain_telemetry_partitions()
+            next_maintenance = time.monotonic() + PARTITION_MAINTENANCE_INTERVAL
+        if not batch and not shadows:
+            # Take shadows before draining so the bin rows they need are already queued
+            shadows = _take_pending_shadows(force=stopping)
+            batch = _drain_ingest_queue(block=not stopping)
+            if not batch and not shadows:
+                continue
+        try:
+            _flush_ingest_batch(batch, shadows)
+        except Exception as e:
+            if _is_connection_error(e) and not stopping:
+                delay = min(delay * 2 or 1.0, INGEST_RETRY_MAX_DELAY)
+                logger.warning(f"Database unavailable, retrying {len(batch)} queued ingest rows "
+                               f"and {len(shadows)} shadow updates in {delay:.0f}s: {e}")
+                _ingest_writer_stop.wait(delay)
+                continue
+            logger.error(f"Failed to write {len(batch)} queued ingest rows "
+                         f"and {len(shadows)} shadow updates: {e}")
+        batch, shadows = [], {}
+        delay = 0.0
+
+
+def start_ingest_writer():
+    """Start the background ingest writer thread (idempotent)."""
+    global _ingest_writer
+    if _ingest_writer is not None and _ingest_writer.is_alive():
+        return
+    _ingest_writer_stop.clear()
+    _ingest_writer = threading.Thread(
+        target=_ingest_writer_loop, name="ingest-writer", daemon=True
+    )
+    _ingest_writer.start()
+    logger.info("Ingest writer started")
+
+
+def stop_ingest_writer(timeout: float = 10.0):
+    """Flush remaining queued rows and stop the writer thread."""
+    global _ingest_writer
+    if _ingest_writer is None:
+        return
+    _ingest_writer_stop.set()
+    _ingest_writer.join(timeout)
+    _ingest_writer = None
+    logger.info("Ingest writer stopped")
+
+
+_SQL_GET_RECENT_TELEMETRY = """
+    SELECT id, ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon, received_at
+    FROM telemetry
+    WHERE bin_id = $1
+    ORDER BY ts DESC
+    LIMIT $2
+"""
 
 
 def get_recent_telemetry(bin_id: str, limit: int = 100):
     """Get the most recent telemetry records for a specific bin."""
+    with get_cursor() as cur:
+        execute_prepared(cur, "get_recent_telemetry", _SQL_GET_RECENT_TELEMETRY, (bin_id, limit))
+        return cur.fetchall()
+
+
+def get_recent_telemetry_fillseries(bin_id: str, limit: int = 100):
+    """
+    Get the most recent (ts, fill_pct) pairs for a bin, newest first.
+    Returns plain tuples; use get_recent_telemetry when the full row is needed.
+    """
     sql = """
-        SELECT id, ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon, received_at
+        SELECT ts, fill_pct
         FROM telemetry
         WHERE bin_id = %s
         ORDER BY ts DESC
         LIMIT %s
     """
-    with get_cursor() as cur:
+    with get_cursor(cursor_factory=None) as cur:
         cur.execute(sql, (bin_id, limit))
         return cur.fetchall()
 
 
+_SQL_ALL_RECENT_TELEMETRY = """
+    SELECT id, ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon, received_at
+    FROM telemetry
+    ORDER BY ts DESC
+    LIMIT %s
+"""
+
+
 def get_all_recent_telemetry(limit: int = 500):
     """Get the most recent telemetry records across all bins."""
-    sql = """
-        SELECT id, ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon, received_at
-        FROM telemetry
-        ORDER BY ts DESC
-        LIMIT %s
-    """
     with get_cursor() as cur:
-        cur.execute(sql, (limit,))
+        cur.execute(_SQL_ALL_RECENT_TELEMETRY, (limit,))
         return cur.fetchall()
 
 
+def iter_all_recent_telemetry(limit: int = None):
+    """Stream recent telemetry across all bins (no limit by default)."""
+    return stream_rows(_SQL_ALL_RECENT_TELEMETRY, (limit,))
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Device Management Operations
 # ─────────────────────────────────────────────────────────────────────────────
@@ -228,11 +1103,13 @@ def register_device(
         cur.execute(sql, (bin_id, user_id, user_name, user_phone, wifi_ssid, lat, lon))
 
 
+_SQL_UPDATE_DEVICE_STATUS = "UPDATE bins SET device_status = $1 WHERE bin_id = $2"
+
+
 def update_device_status(bin_id: str, status: str):
     """Update device online/offline status."""
-    sql = "UPDATE bins SET device_status = %s WHERE bin_id = %s"
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (status, bin_id))
+        execute_prepared(cur, "update_device_status", _SQL_UPDATE_DEVICE_STATUS, (status, bin_id))
 
 
 def get_user_bins(user_id: str):
@@ -263,28 +1140,20 @@ def create_alert(bin_id: str, alert_type: str, severity: str, message: str) -> i
         return cur.fetchone()['id']
 
 
+_SQL_UNRESOLVED_ALERTS = """
+    SELECT id, bin_id, alert_type, severity, message, created_at
+    FROM alerts
+    WHERE resolved = FALSE
+      AND (%(bin_id)s::text IS NULL OR bin_id = %(bin_id)s)
+    ORDER BY created_at DESC
+"""
+
+
 def get_unresolved_alerts(bin_id: str = None):
     """Get unresolved alerts, optionally filtered by bin_id."""
-    if bin_id:
-        sql = """
-            SELECT id, bin_id, alert_type, severity, message, created_at
-            FROM alerts
-            WHERE bin_id = %s AND resolved = FALSE
-            ORDER BY created_at DESC
-        """
-        with get_cursor() as cur:
-            cur.execute(sql, (bin_id,))
-            return cur.fetchall()
-    else:
-        sql = """
-            SELECT id, bin_id, alert_type, severity, message, created_at
-            FROM alerts
-            WHERE resolved = FALSE
-            ORDER BY created_at DESC
-        """
-        with get_cursor() as cur:
-            cur.execute(sql)
-            return cur.fetchall()
+    with get_cursor() as cur:
+        cur.execute(_SQL_UNRESOLVED_ALERTS, {"bin_id": bin_id or None})
+        return cur.fetchall()
 
 
 def resolve_alert(alert_id: int):
@@ -304,9 +1173,8 @@ def log_command(bin_id: str, command_type: str, payload: dict):
         INSERT INTO commands_log (bin_id, command_type, payload)
         VALUES (%s, %s, %s)
     """
-    import json
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (bin_id, command_type, json.dumps(payload)))
+        cur.execute(sql, (bin_id, command_type, Json(payload)))
 
 
 def get_command_history(bin_id: str, limit: int = 50):
@@ -332,46 +1200,57 @@ def delete_bin(bin_id: str) -> bool:
     Delete a bin and all its associated data.
     Returns True if bin was deleted, False if not found.
     """
-    # First delete related records
-    sql_telemetry = "DELETE FROM telemetry WHERE bin_id = %s"
-    sql_alerts = "DELETE FROM alerts WHERE bin_id = %s"
-    sql_commands = "DELETE FROM commands_log WHERE bin_id = %s"
-    sql_bin = "DELETE FROM bins WHERE bin_id = %s RETURNING bin_id"
+    # Related records and the bin in one statement: one parse, one plan,
+    # one round-trip. The foreign keys are checked at end of statement, after
+    # the CTEs have removed the child rows.
+    sql = """
+        WITH t AS (DELETE FROM telemetry WHERE bin_id = %(bin_id)s),
+             a AS (DELETE FROM alerts WHERE bin_id = %(bin_id)s),
+             c AS (DELETE FROM commands_log WHERE bin_id = %(bin_id)s)
+        DELETE FROM bins WHERE bin_id = %(bin_id)s RETURNING bin_id
+    """
     
     with get_cursor(commit=True) as cur:
-        cur.execute(sql_telemetry, (bin_id,))
-        cur.execute(sql_alerts, (bin_id,))
-        cur.execute(sql_commands, (bin_id,))
-        cur.execute(sql_bin, (bin_id,))
+        cur.execute(sql, {"bin_id": bin_id})
         result = cur.fetchone()
-        return result is not None
+    clear_bins_latest_cache()
+    return result is not None
+
+
+_SQL_GET_BIN_BY_ID = """
+    SELECT bin_id, lat, lon, last_seen, last_emptied, device_status,
+           user_id, user_name, registered_at
+    FROM bins
+    WHERE bin_id = $1
+"""
 
 
 def get_bin_by_id(bin_id: str):
     """Get a specific bin by ID."""
-    sql = """
-        SELECT bin_id, lat, lon, last_seen, last_emptied, device_status,
-               user_id, user_name, registered_at
-        FROM bins
-        WHERE bin_id = %s
-    """
     with get_cursor() as cur:
-        cur.execute(sql, (bin_id,))
+        execute_prepared(cur, "get_bin_by_id", _SQL_GET_BIN_BY_ID, (bin_id,))
         return cur.fetchone()
 
 
+_SQL_ALL_BINS = """
+    SELECT bin_id, lat, lon, last_seen, device_status
+    FROM bins
+    ORDER BY bin_id
+"""
+
+
 def get_all_bins():
     """Get all bins (basic info only)."""
-    sql = """
-        SELECT bin_id, lat, lon, last_seen, device_status
-        FROM bins
-        ORDER BY bin_id
-    """
     with get_cursor() as cur:
-        cur.execute(sql)
+        cur.execute(_SQL_ALL_BINS)
         return cur.fetchall()
 
 
+def iter_all_bins():
+    """Stream all bins (basic info only) without loading them all at once."""
+    return stream_rows(_SQL_ALL_BINS)
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Admin Authentication
 # ─────────────────────────────────────────────────────────────────────────────
@@ -405,15 +1284,17 @@ def create_admin_user(username: str, password_hash: str) -> bool:
         return result is not None
 
 
+_SQL_GET_ADMIN_BY_USERNAME = """
+    SELECT id, username, password_hash, created_at, last_login
+    FROM admin_users
+    WHERE username = $1
+"""
+
+
 def get_admin_by_username(username: str):
     """Get admin user by username."""
-    sql = """
-        SELECT id, username, password_hash, created_at, last_login
-        FROM admin_users
-        WHERE username = %s
-    """
     with get_cursor() as cur:
-        cur.execute(sql, (username,))
+        execute_prepared(cur, "get_admin_by_username", _SQL_GET_ADMIN_BY_USERNAME, (username,))
         return cur.fetchone()
 
 
@@ -461,9 +1342,6 @@ def start_collection_session(zone_id: str, zone_name: str, bins_total: int, admi
     Returns:
         Session ID
     """
-    # First, make sure the table exists
-    init_collection_sessions_table()
-    
     sql = """
         INSERT INTO collection_sessions (zone_id, zone_name, status, bins_total, admin_user)
         VALUES (%s, %s, 'started', %s, %s)
@@ -529,70 +1407,59 @@ def get_active_collection_session(zone_id: str):
         return cur.fetchone()
 
 
+_SQL_ZONE_BINS_STATUS = """
+    SELECT b.bin_id, b.last_seen, b.sleep_mode, t.fill_pct,
+           COALESCE(b.last_seen > NOW() - INTERVAL '2 hours', FALSE) AS responded,
+           COUNT(*) OVER () AS total,
+           COUNT(*) FILTER (WHERE b.last_seen > NOW() - INTERVAL '2 hours') OVER () AS responded_total
+    FROM bins b
+    LEFT JOIN LATERAL (
+        SELECT fill_pct
+        FROM telemetry
+        WHERE bin_id = b.bin_id
+        ORDER BY ts DESC
+        LIMIT 1
+    ) t ON TRUE
+    WHERE b.bin_id LIKE ANY(%s)
+"""
+
+
 def get_zone_bins_status(zone_id: str) -> dict:
     """
     Get status of bins in a zone for collection tracking.
     
     Returns:
         Dictionary with bins info including which have responded recently
+        (reported in the last 2 hours)
     """
     from . import mqtt_commands
     
-    bins = mqtt_commands.get_bins_in_zone(zone_id)
-    
-    if not bins:
-        return {
-            "total": 0,
-            "responded": 0,
-            "pending": 0,
-            "bins": []
-        }
-    
-    # Get bins that have reported in the last 2 hours
-    sql = """
-        SELECT b.bin_id, b.last_seen, b.sleep_mode, t.fill_pct
-        FROM bins b
-        LEFT JOIN (
-            SELECT DISTINCT ON (bin_id) bin_id, fill_pct
-            FROM telemetry
-            ORDER BY bin_id, ts DESC
-        ) t ON b.bin_id = t.bin_id
-        WHERE b.bin_id = ANY(%s)
-    """
-    
-    with get_cursor() as cur:
-        cur.execute(sql, (bins,))
-        rows = cur.fetchall()
-    
-    from datetime import datetime, timedelta, timezone
-    now = datetime.now(timezone.utc)
-    threshold = now - timedelta(hours=2)
-    
-    responded = 0
-    bins_status = []
+    patterns = mqtt_commands.ZONE_PATTERNS.get(zone_id)
+    rows = []
+    if patterns:
+        with get_cursor() as cur:
+            cur.execute(_SQL_ZONE_BINS_STATUS, (patterns,))
+            rows = cur.fetchall()
+    else:
+        logger.warning(f"No prefix mapping found for zone: {zone_id}")
     
-    for row in rows:
-        last_seen = row['last_seen']
-        # Make timezone-aware comparison
-        if last_seen and last_seen.tzinfo is None:
-            last_seen = last_seen.replace(tzinfo=timezone.utc)
-        is_recent = last_seen and last_seen > threshold
-        if is_recent:
-            responded += 1
-        
-        bins_status.append({
-            "bin_id": row['bin_id'],
-            "last_seen": row['last_seen'].isoformat() if row['last_seen'] else None,
-            "fill_pct": float(row['fill_pct']) if row['fill_pct'] else None,
-            "sleep_mode": row['sleep_mode'],
-            "responded": is_recent
-        })
+    total = rows[0]['total'] if rows else 0
+    responded = rows[0]['responded_total'] if rows else 0
     
     return {
-        "total": len(bins),
+        "total": total,
         "responded": responded,
-        "pending": len(bins) - responded,
-        "bins": bins_status
+        "pending": total - responded,
+        "bins": [
+            {
+                "bin_id": row['bin_id'],
+                "last_seen": row['last_seen'].isoformat() if row['last_seen'] else None,
+                "fill_pct": float(row['fill_pct']) if row['fill_pct'] else None,
+                "sleep_mode": row['sleep_mode'],
+                "responded": row['responded']
+            }
+            for row in rows
+        ]
     }
 
 
@@ -600,7 +1467,16 @@ def get_zone_bins_status(zone_id: str) -> dict:
 # Device Heartbeat System
 # ─────────────────────────────────────────────────────────────────────────────
 
-def init_heartbeat_table():
+def _execute_ddl(sql: str, cur=None):
+    """Run schema DDL on the given cursor, or in its own transaction."""
+    if cur is not None:
+        cur.execute(sql)
+        return
+    with get_cursor(commit=True) as cur:
+        cur.execute(sql)
+
+
+def init_heartbeat_table(cur=None):
     """Initialize the device_heartbeats table."""
     sql = """
         CREATE TABLE IF NOT EXISTS device_heartbeats (
@@ -615,24 +1491,64 @@ def init_heartbeat_table():
         CREATE INDEX IF NOT EXISTS idx_heartbeats_bin_id ON device_heartbeats(bin_id);
         CREATE INDEX IF NOT EXISTS idx_heartbeats_received_at ON device_heartbeats(received_at);
     """
-    with get_cursor(commit=True) as cur:
-        cur.execute(sql)
+    _execute_ddl(sql, cur)
 
 
-def record_heartbeat(bin_id: str, rssi: int = None, uptime_seconds: int = None, 
-                     free_memory_kb: int = None, firmware_version: str = None):
-    """Record a device heartbeat."""
-    sql = """
+# Writable CTE: the heartbeat insert and the bin update run as one statement
+_SQL_RECORD_HEARTBEAT = """
+    WITH h AS (
         INSERT INTO device_heartbeats (bin_id, rssi, uptime_seconds, free_memory_kb, firmware_version)
         VALUES (%s, %s, %s, %s, %s)
-    """
-    with get_cursor(commit=True) as cur:
-        cur.execute(sql, (bin_id, rssi, uptime_seconds, free_memory_kb, firmware_version))
-    
-    # Update bin's last_seen and device_status
-    update_sql = "UPDATE bins SET last_seen = NOW(), device_status = 'online' WHERE bin_id = %s"
+        RETURNING bin_id
+    )
+    UPDATE bins SET last_seen = NOW(), device_status = 'online'
+    FROM h
+    WHERE bins.bin_id = h.bin_id
+"""
+
+
+def record_heartbeat(bin_id: str, rssi: int = None, uptime_seconds: int = None, 
+                     free_memory_kb: int = None, firmware_version: str = None):
+    """Record a device heartbeat and update the bin's last_seen/device_status."""
     with get_cursor(commit=True) as cur:
-        cur.execute(update_sql, (bin_id,))
+        cur.execute(_SQL_RECORD_HEARTBEAT, (bin_id, rssi, uptime_seconds, free_memory_kb, firmware_version))
+
+
+def _insert_heartbeat_rows(cur, rows):
+    """
+    Write heartbeat tuples through an open cursor and mark their bins online.
+    Heartbeats from unknown bins are skipped rather than failing the batch.
+    """
+    if len(rows) >= COPY_BATCH_THRESHOLD:
+        # COPY into a scratch table, then keep only rows for known bins
+        cur.execute("""
+            CREATE TEMP TABLE heartbeat_stage (
+                bin_id VARCHAR(50), rssi INT, uptime_seconds INT,
+                free_memory_kb INT, firmware_version VARCHAR(50)
+            ) ON COMMIT DROP
+        """)
+        _copy_rows(cur, "COPY heartbeat_stage FROM STDIN WITH (FORMAT csv)", rows)
+        cur.execute("""
+            INSERT INTO device_heartbeats (bin_id, rssi, uptime_seconds, free_memory_kb, firmware_version)
+            SELECT s.bin_id, s.rssi, s.uptime_seconds, s.free_memory_kb, s.firmware_version
+            FROM heartbeat_stage s
+            JOIN bins b ON b.bin_id = s.bin_id
+        """)
+    else:
+        sql = """
+            INSERT INTO device_heartbeats (bin_id, rssi, uptime_seconds, free_memory_kb, firmware_version)
+            SELECT v.bin_id, v.rssi, v.uptime_seconds, v.free_memory_kb, v.firmware_version
+            FROM (VALUES %s) AS v (bin_id, rssi, uptime_seconds, free_memory_kb, firmware_version)
+            JOIN bins b ON b.bin_id = v.bin_id
+        """
+        execute_values(cur, sql, rows, template="(%s, %s::int, %s::int, %s::int, %s::varchar)",
+                       page_size=len(rows))
+    bin_ids = list({row[0] for row in rows})
+    cur.execute(
+        "UPDATE bins SET last_seen = NOW(), device_status = 'online' "
+        "WHERE bin_id IN (SELECT UNNEST(%s::text[]))",
+        (bin_ids,)
+    )
 
 
 def get_devices_needing_heartbeat(timeout_minutes: int = 5) -> list:
@@ -652,6 +1568,23 @@ def get_devices_needing_heartbeat(timeout_minutes: int = 5) -> list:
         return cur.fetchall()
 
 
+def mark_stale_devices_offline(timeout_minutes: int = 5) -> list:
+    """
+    Mark awake devices without a heartbeat in the last timeout_minutes as
+    offline, in one statement. Returns the bin_ids that were marked.
+    """
+    sql = """
+        UPDATE bins SET device_status = 'offline'
+        WHERE sleep_mode = FALSE
+        AND (last_seen < NOW() - make_interval(mins => %s) OR last_seen IS NULL)
+        AND device_status IS DISTINCT FROM 'offline'
+        RETURNING bin_id
+    """
+    with get_cursor(commit=True, cursor_factory=None) as cur:
+        cur.execute(sql, (timeout_minutes,))
+        return [row[0] for row in cur.fetchall()]
+
+
 def get_device_heartbeat_history(bin_id: str, limit: int = 100) -> list:
     """Get heartbeat history for a device."""
     sql = """
@@ -670,7 +1603,7 @@ def get_device_heartbeat_history(bin_id: str, limit: int = 100) -> list:
 # Command ACK/Retry System
 # ─────────────────────────────────────────────────────────────────────────────
 
-def init_command_ack_table():
+def init_command_ack_table(cur=None):
     """Initialize the command_acknowledgments table."""
     sql = """
         CREATE TABLE IF NOT EXISTS command_acknowledgments (
@@ -689,20 +1622,18 @@ def init_command_ack_table():
         CREATE INDEX IF NOT EXISTS idx_cmd_ack_bin_id ON command_acknowledgments(bin_id);
         CREATE INDEX IF NOT EXISTS idx_cmd_ack_status ON command_acknowledgments(status);
     """
-    with get_cursor(commit=True) as cur:
-        cur.execute(sql)
+    _execute_ddl(sql, cur)
 
 
 def create_pending_command(command_id: str, bin_id: str, command_type: str, payload: dict = None) -> int:
     """Create a pending command that expects acknowledgment."""
-    import json
     sql = """
         INSERT INTO command_acknowledgments (command_id, bin_id, command_type, payload)
         VALUES (%s, %s, %s, %s)
         RETURNING id
     """
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (command_id, bin_id, command_type, json.dumps(payload) if payload else None))
+        cur.execute(sql, (command_id, bin_id, command_type, Json(payload) if payload else None))
         result = cur.fetchone()
         return result['id'] if result else None
 
@@ -742,33 +1673,96 @@ def get_pending_commands(bin_id: str = None, older_than_seconds: int = 30) -> li
         return cur.fetchall()
 
 
-def increment_command_retry(command_id: str):
-    """Increment retry count for a command."""
+@contextmanager
+def claim_pending_commands(older_than_seconds: int = 30, limit: int = 100):
+    """
+    Lock up to `limit` due pending commands for this worker.
+
+    Yields (cursor, rows). Rows are locked FOR UPDATE SKIP LOCKED, so
+    concurrent retry workers each get a disjoint set instead of blocking on
+    or double-sending the same commands. Update them through the yielded
+    cursor (increment_command_retry / mark_command_failed with cur=...);
+    everything commits together when the block exits. Publish only after
+    that, so ACKs for these rows never wait on the broker.
+    """
     sql = """
-        UPDATE command_acknowledgments
-        SET retry_count = retry_count + 1, sent_at = NOW()
-        WHERE command_id = %s
+        SELECT * FROM command_acknowledgments
+        WHERE status = 'pending' AND sent_at < NOW() - make_interval(secs => %s)
+        ORDER BY sent_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
     """
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (command_id,))
+        cur.execute(sql, (older_than_seconds, limit))
+        yield cur, cur.fetchall()
 
 
-def mark_command_failed(command_id: str, error_message: str = "Max retries exceeded"):
-    """Mark a command as failed after max retries."""
-    sql = """
-        UPDATE command_acknowledgments
-        SET status = 'failed', error_message = %s
-        WHERE command_id = %s
-    """
+_SQL_INCREMENT_COMMAND_RETRY = """
+    UPDATE command_acknowledgments
+    SET retry_count = retry_count + 1, sent_at = NOW()
+    WHERE command_id = ANY(%s)
+"""
+
+
+def increment_command_retry(command_id: str, cur=None):
+    """Increment retry count for a command (optionally within an open cursor)."""
+    increment_command_retries([command_id], cur=cur)
+
+
+def increment_command_retries(command_ids: list, cur=None):
+    """Increment retry counts for many commands in one statement."""
+    if not command_ids:
+        return
+    if cur is not None:
+        cur.execute(_SQL_INCREMENT_COMMAND_RETRY, (list(command_ids),))
+        return
+    with get_cursor(commit=True) as cur:
+        cur.execute(_SQL_INCREMENT_COMMAND_RETRY, (list(command_ids),))
+
+
+_SQL_RELEASE_COMMAND_CLAIMS = """
+    UPDATE command_acknowledgments
+    SET retry_count = GREATEST(retry_count - 1, 0)
+    WHERE command_id = ANY(%s) AND status = 'pending'
+"""
+
+
+def release_command_claims(command_ids: list):
+    """Undo the retry-count bump for claimed commands that could not be published."""
+    if not command_ids:
+        return
+    with get_cursor(commit=True) as cur:
+        cur.execute(_SQL_RELEASE_COMMAND_CLAIMS, (list(command_ids),))
+
+
+_SQL_MARK_COMMAND_FAILED = """
+    UPDATE command_acknowledgments
+    SET status = 'failed', error_message = %s
+    WHERE command_id = ANY(%s)
+"""
+
+
+def mark_command_failed(command_id: str, error_message: str = "Max retries exceeded", cur=None):
+    """Mark a command as failed after max retries (optionally within an open cursor)."""
+    mark_commands_failed([command_id], error_message, cur=cur)
+
+
+def mark_commands_failed(command_ids: list, error_message: str = "Max retries exceeded", cur=None):
+    """Mark many commands as failed in one statement."""
+    if not command_ids:
+        return
+    if cur is not None:
+        cur.execute(_SQL_MARK_COMMAND_FAILED, (error_message, list(command_ids)))
+        return
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (error_message, command_id))
+        cur.execute(_SQL_MARK_COMMAND_FAILED, (error_message, list(command_ids)))
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Device Shadow/Twin
 # ─────────────────────────────────────────────────────────────────────────────
 
-def init_device_shadow_table():
+def init_device_shadow_table(cur=None):
     """Initialize the device_shadow table for offline state queries."""
     sql = """
         CREATE TABLE IF NOT EXISTS device_shadow (
@@ -781,40 +1775,35 @@ def init_device_shadow_table():
             metadata JSONB DEFAULT '{}'
         );
     """
-    with get_cursor(commit=True) as cur:
-        cur.execute(sql)
+    _execute_ddl(sql, cur)
 
 
 def update_device_shadow_reported(bin_id: str, state: dict):
     """Update the reported state of a device shadow."""
-    import json
     sql = """
         INSERT INTO device_shadow (bin_id, reported_state, last_reported_at, version)
-        VALUES (%s, %s, NOW(), 1)
+        VALUES (%(bin_id)s, %(state)s, NOW(), 1)
         ON CONFLICT (bin_id) DO UPDATE SET
-            reported_state = device_shadow.reported_state || %s,
+            reported_state = device_shadow.reported_state || %(state)s,
             last_reported_at = NOW(),
             version = device_shadow.version + 1
     """
-    state_json = json.dumps(state)
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (bin_id, state_json, state_json))
+        cur.execute(sql, {"bin_id": bin_id, "state": Json(state)})
 
 
 def update_device_shadow_desired(bin_id: str, state: dict):
     """Update the desired state of a device shadow."""
-    import json
     sql = """
         INSERT INTO device_shadow (bin_id, desired_state, last_desired_at, version)
-        VALUES (%s, %s, NOW(), 1)
+        VALUES (%(bin_id)s, %(state)s, NOW(), 1)
         ON CONFLICT (bin_id) DO UPDATE SET
-            desired_state = device_shadow.desired_state || %s,
+            desired_state = device_shadow.desired_state || %(state)s,
             last_desired_at = NOW(),
             version = device_shadow.version + 1
     """
-    state_json = json.dumps(state)
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (bin_id, state_json, state_json))
+        cur.execute(sql, {"bin_id": bin_id, "state": Json(state)})
 
 
 def get_device_shadow(bin_id: str) -> dict:
@@ -828,33 +1817,160 @@ def get_device_shadow(bin_id: str) -> dict:
         return None
 
 
+_SQL_SHADOW_DELTA = """
+    SELECT s.version,
+           COALESCE((
+               SELECT jsonb_object_agg(d.key, d.value)
+               FROM jsonb_each(COALESCE(s.desired_state, '{}'::jsonb)) AS d
+               WHERE COALESCE(s.reported_state, '{}'::jsonb) -> d.key IS DISTINCT FROM d.value
+           ), '{}'::jsonb) AS delta
+    FROM device_shadow s
+    WHERE s.bin_id = %s
+"""
+
+
 def get_device_shadow_delta(bin_id: str) -> dict:
-    """Get the delta between reported and desired state."""
-    shadow = get_device_shadow(bin_id)
-    if not shadow:
+    """Get the delta between reported and desired state (diffed server-side)."""
+    with get_cursor() as cur:
+        cur.execute(_SQL_SHADOW_DELTA, (bin_id,))
+        row = cur.fetchone()
+    if not row:
         return None
-    
-    reported = shadow.get('reported_state', {})
-    desired = shadow.get('desired_state', {})
-    
-    delta = {}
-    for key, value in desired.items():
-        if key not in reported or reported[key] != value:
-            delta[key] = value
-    
+
+    delta = row['delta']
     return {
         "bin_id": bin_id,
         "delta": delta,
         "has_delta": len(delta) > 0,
-        "version": shadow.get('version')
+        "version": row['version']
     }
 
 
+# ─────────────────────────────────────────────────────────────────────────────
+# Fill Rate State
+# ─────────────────────────────────────────────────────────────────────────────
+# Rolling per-bin EWMA of the fill rate, advanced as telemetry is written so
+# predictions read one row instead of replaying 30 days of history.
+
+def init_fill_rate_state_table(cur=None):
+    """Initialize the bin_fill_rate_state table."""
+    sql = """
+        CREATE TABLE IF NOT EXISTS bin_fill_rate_state (
+            bin_id TEXT PRIMARY KEY REFERENCES bins(bin_id) ON DELETE CASCADE,
+            ewma_rate FLOAT,
+            last_ts TIMESTAMPTZ NOT NULL,
+            last_fill FLOAT NOT NULL,
+            n_samples INT NOT NULL DEFAULT 1,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """
+    _execute_ddl(sql, cur)
+
+
+# Rows for bins that don't exist are skipped, like their telemetry
+_SQL_UPSERT_FILL_RATE_STATE = """
+    INSERT INTO bin_fill_rate_state (bin_id, ewma_rate, last_ts, last_fill, n_samples)
+    SELECT v.bin_id, v.ewma_rate, v.last_ts, v.last_fill, v.n_samples
+    FROM (VALUES %s) AS v (bin_id, ewma_rate, last_ts, last_fill, n_samples)
+    JOIN bins b ON b.bin_id = v.bin_id
+    ON CONFLICT (bin_id) DO UPDATE SET
+        ewma_rate = EXCLUDED.ewma_rate,
+        last_ts = EXCLUDED.last_ts,
+        last_fill = EXCLUDED.last_fill,
+        n_samples = EXCLUDED.n_samples,
+        updated_at = NOW()
+    WHERE bin_fill_rate_state.last_ts <= EXCLUDED.last_ts
+"""
+_FILL_RATE_STATE_TEMPLATE = "(%s::text, %s::float8, %s::timestamptz, %s::float8, %s::int)"
+
+
+def _update_fill_rate_state(cur, rows):
+    """
+    Advance the rolling fill-rate EWMA for the bins in a batch of telemetry
+    rows (same tuple layout as _insert_telemetry_rows). Uses the same rate
+    filter and alpha as ml_prediction. Runs under a savepoint so a failure
+    here never loses the telemetry written in the same transaction.
+    """
+    from .ml_prediction import EWMA_ALPHA, MAX_RATE_PER_HOUR
+
+    samples = []
+    for ts, bin_id, fill_pct, *_ in rows:
+        if fill_pct is None:
+            continue
+        if isinstance(ts, str):
+            ts = datetime.fromisoformat(ts)
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        samples.append((bin_id, ts, float(fill_pct)))
+    if not samples:
+        return
+    samples.sort(key=lambda sample: (sample[0], sample[1]))
+
+    cur.execute("SAVEPOINT fill_rate_state")
+    try:
+        cur.execute(
+            "SELECT bin_id, ewma_rate, last_ts, last_fill, n_samples FROM bin_fill_rate_state "
+            "WHERE bin_id IN (SELECT UNNEST(%s::text[])) FOR UPDATE",
+            (list({sample[0] for sample in samples}),)
+        )
+        state = {
+            row['bin_id']: (row['ewma_rate'], row['last_ts'], row['last_fill'], row['n_samples'])
+            for row in cur.fetchall()
+        }
+
+        for bin_id, ts, fill in samples:
+            if bin_id not in state:
+                state[bin_id] = (None, ts, fill, 1)
+                continue
+            ewma, last_ts, last_fill, n_samples = state[bin_id]
+            if ts <= last_ts:
+                continue  # late or duplicate sample
+            rate = (fill - last_fill) / ((ts - last_ts).total_seconds() / 3600)
+            # Filling up only; larger jumps are sensor errors
+            if 0 <= rate <= MAX_RATE_PER_HOUR:
+                ewma = rate if ewma is None else EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * ewma
+            state[bin_id] = (ewma, ts, fill, n_samples + 1)
+
+        execute_values(
+            cur, _SQL_UPSERT_FILL_RATE_STATE,
+            [(bin_id, *values) for bin_id, values in state.items()],
+            template=_FILL_RATE_STATE_TEMPLATE, page_size=len(state)
+        )
+        cur.execute("RELEASE SAVEPOINT fill_rate_state")
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT fill_rate_state")
+        logger.error(f"Failed to update fill rate state: {e}")
+
+
+def save_fill_rate_states(rows: list):
+    """
+    Seed fill-rate state from full recomputes, as
+    (bin_id, ewma_rate, last_ts, last_fill, n_samples) tuples.
+    Never moves a bin's state back to an older sample.
+    """
+    if not rows:
+        return
+    with get_cursor(commit=True) as cur:
+        execute_values(cur, _SQL_UPSERT_FILL_RATE_STATE, rows,
+                       template=_FILL_RATE_STATE_TEMPLATE, page_size=len(rows))
+
+
+def get_fill_rate_state(bin_id: str = None):
+    """Get fill-rate state for one bin (dict or None) or all bins (bin_id -> dict)."""
+    sql = "SELECT bin_id, ewma_rate, last_ts, last_fill, n_samples FROM bin_fill_rate_state"
+    with get_cursor() as cur:
+        if bin_id is not None:
+            cur.execute(sql + " WHERE bin_id = %s", (bin_id,))
+            return cur.fetchone()
+        cur.execute(sql)
+        return {row['bin_id']: row for row in cur.fetchall()}
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Power Profiling
 # ─────────────────────────────────────────────────────────────────────────────
 
-def init_power_profile_table():
+def init_power_profile_table(cur=None):
     """Initialize the power_profiles table for battery tracking."""
     sql = """
         CREATE TABLE IF NOT EXISTS power_profiles (
@@ -870,68 +1986,70 @@ def init_power_profile_table():
         CREATE INDEX IF NOT EXISTS idx_power_bin_id ON power_profiles(bin_id);
         CREATE INDEX IF NOT EXISTS idx_power_recorded_at ON power_profiles(recorded_at);
     """
-    with get_cursor(commit=True) as cur:
-        cur.execute(sql)
+    _execute_ddl(sql, cur)
+
+
+# Battery estimate for a source row aliased `v` (bin_id, batt_v): the voltage
+# drain per day is the regression slope of the bin's last 7 days of readings,
+# and the device is assumed to die at 3.0V. NULL when there is no drain yet.
+_SQL_BATTERY_DRAIN_LATERAL = """
+    LEFT JOIN LATERAL (
+        SELECT -regr_slope(p.batt_v, EXTRACT(EPOCH FROM p.recorded_at) / 86400) AS v_per_day
+        FROM power_profiles p
+        WHERE p.bin_id = v.bin_id AND p.recorded_at > NOW() - INTERVAL '7 days'
+    ) d ON TRUE
+"""
+_SQL_BATTERY_DAYS = """
+    CASE WHEN d.v_per_day > 0
+         THEN round(((v.batt_v - 3.0) / d.v_per_day)::numeric, 1)::float8
+    END
+"""
 
 
 def record_power_reading(bin_id: str, batt_v: float, batt_pct: float = None, 
                          charging: bool = False, power_source: str = 'battery'):
-    """Record a power/battery reading."""
-    # Calculate estimated days remaining based on drain rate
-    estimated_days = calculate_battery_days_remaining(bin_id, batt_v)
-    
-    sql = """
+    """Record a power/battery reading (days remaining is estimated in the same statement)."""
+    sql = f"""
         INSERT INTO power_profiles (bin_id, batt_v, batt_pct, charging, power_source, estimated_days_remaining)
-        VALUES (%s, %s, %s, %s, %s, %s)
+        SELECT v.bin_id, v.batt_v, v.batt_pct, v.charging, v.power_source, {_SQL_BATTERY_DAYS}
+        FROM (VALUES (%s, %s::float8, %s::float8, %s::boolean, %s::varchar))
+             AS v (bin_id, batt_v, batt_pct, charging, power_source)
+        {_SQL_BATTERY_DRAIN_LATERAL}
     """
     with get_cursor(commit=True) as cur:
-        cur.execute(sql, (bin_id, batt_v, batt_pct, charging, power_source, estimated_days))
+        cur.execute(sql, (bin_id, batt_v, batt_pct, charging, power_source))
+
+
+def _insert_power_rows(cur, rows):
+    """
+    Write (bin_id, batt_v, batt_pct, charging, power_source) tuples through
+    an open cursor, estimating days remaining server-side.
+    Rows for unknown bins are skipped.
+    """
+    sql = f"""
+        INSERT INTO power_profiles (bin_id, batt_v, batt_pct, charging, power_source, estimated_days_remaining)
+        SELECT v.bin_id, v.batt_v, v.batt_pct, v.charging, v.power_source, {_SQL_BATTERY_DAYS}
+        FROM (VALUES %s) AS v (bin_id, batt_v, batt_pct, charging, power_source)
+        JOIN bins b ON b.bin_id = v.bin_id
+        {_SQL_BATTERY_DRAIN_LATERAL}
+    """
+    execute_values(
+        cur, sql, rows,
+        template="(%s, %s::float8, %s::float8, %s::boolean, %s::varchar)",
+        page_size=len(rows)
+    )
 
 
 def calculate_battery_days_remaining(bin_id: str, current_voltage: float) -> float:
     """Calculate estimated days of battery remaining based on drain rate."""
-    from datetime import datetime, timedelta, timezone
-    
-    # Get readings from the last 7 days
-    sql = """
-        SELECT batt_v, recorded_at
-        FROM power_profiles
-        WHERE bin_id = %s AND recorded_at > NOW() - INTERVAL '7 days'
-        ORDER BY recorded_at ASC
-        LIMIT 100
+    sql = f"""
+        SELECT {_SQL_BATTERY_DAYS}
+        FROM (VALUES (%s, %s::float8)) AS v (bin_id, batt_v)
+        {_SQL_BATTERY_DRAIN_LATERAL}
     """
-    with get_cursor() as cur:
-        cur.execute(sql, (bin_id,))
-        readings = cur.fetchall()
-    
-    if len(readings) < 2:
-        return None
-    
-    # Calculate voltage drain rate (V per day)
-    first = readings[0]
-    last = readings[-1]
-    
-    if first['recorded_at'] and last['recorded_at']:
-        # Make both timezone-aware if needed
-        first_time = first['recorded_at']
-        last_time = last['recorded_at']
-        if first_time.tzinfo is None:
-            first_time = first_time.replace(tzinfo=timezone.utc)
-        if last_time.tzinfo is None:
-            last_time = last_time.replace(tzinfo=timezone.utc)
-            
-        time_diff = (last_time - first_time).total_seconds() / 86400  # days
-        if time_diff > 0:
-            voltage_drop = first['batt_v'] - last['batt_v']
-            drain_rate = voltage_drop / time_diff  # V per day
-            
-            if drain_rate > 0:
-                # Assume device dies at 3.0V
-                remaining_voltage = current_voltage - 3.0
-                days_remaining = remaining_voltage / drain_rate
-                return round(days_remaining, 1)
-    
-    return None
+    with get_cursor(cursor_factory=None) as cur:
+        cur.execute(sql, (bin_id, current_voltage))
+        return cur.fetchone()[0]
 
 
 def get_power_profile(bin_id: str, days: int = 30) -> dict:
@@ -943,10 +2061,10 @@ def get_power_profile(bin_id: str, days: int = 30) -> dict:
             MAX(batt_v) as max_voltage,
             COUNT(*) as reading_count
         FROM power_profiles
-        WHERE bin_id = %s AND recorded_at > NOW() - INTERVAL '%s days'
+        WHERE bin_id = $1 AND recorded_at > NOW() - make_interval(days => $2)
     """
     with get_cursor() as cur:
-        cur.execute(sql, (bin_id, days))
+        execute_prepared(cur, "power_profile_stats", sql, (bin_id, days))
         stats = cur.fetchone()
     
     # Get recent readings
@@ -973,7 +2091,7 @@ def get_power_profile(bin_id: str, days: int = 30) -> dict:
 # OTA Firmware Updates
 # ─────────────────────────────────────────────────────────────────────────────
 
-def init_firmware_table():
+def init_firmware_table(cur=None):
     """Initialize firmware tracking tables."""
     sql = """
         CREATE TABLE IF NOT EXISTS firmware_versions (
@@ -1001,9 +2119,12 @@ def init_firmware_table():
         );
         CREATE INDEX IF NOT EXISTS idx_fw_updates_bin_id ON firmware_updates(bin_id);
         CREATE INDEX IF NOT EXISTS idx_fw_updates_status ON firmware_updates(status);
+        -- bin_id LIKE 'PREFIX%' on pending rows; text_pattern_ops makes the
+        -- prefix match index-usable regardless of the database collation
+        CREATE INDEX IF NOT EXISTS idx_fw_updates_pending_bin_pattern
+            ON firmware_updates (bin_id text_pattern_ops) WHERE status = 'pending';
     """
-    with get_cursor(commit=True) as cur:
-        cur.execute(sql)
+    _execute_ddl(sql, cur)
 
 
 def create_firmware_version(version: str, file_url: str = None, file_size_kb: int = None,
@@ -1023,13 +2144,40 @@ def create_firmware_version(version: str, file_url: str = None, file_size_kb: in
     with get_cursor(commit=True) as cur:
         cur.execute(sql, (version, file_url, file_size_kb, checksum, changelog, is_stable))
         result = cur.fetchone()
-        return result['id'] if result else None
+    clear_latest_firmware_cache()
+    return result['id'] if result else None
 
 
-def get_latest_firmware(stable_only: bool = True) -> dict:
-    """Get the latest firmware version."""
-    sql = """
-        SELECT * FROM firmware_versions
+# (stable_only, include_changelog) -> (monotonic expiry, row); firmware is
+# published rarely, so OTA checks share one lookup per FIRMWARE_CACHE_TTL
+_latest_firmware_cache = {}
+
+
+def get_latest_firmware(stable_only: bool = True, include_changelog: bool = False) -> dict:
+    """Get the latest firmware version (changelog text only if asked for)."""
+    key = (stable_only, include_changelog)
+    cached = _latest_firmware_cache.get(key)
+    if cached is not None and time.monotonic() < cached[0]:
+        return dict(cached[1]) if cached[1] else None
+
+    firmware = _fetch_latest_firmware(stable_only, include_changelog)
+    if config.FIRMWARE_CACHE_TTL > 0:
+        _latest_firmware_cache[key] = (time.monotonic() + config.FIRMWARE_CACHE_TTL, firmware)
+    return dict(firmware) if firmware else None
+
+
+def clear_latest_firmware_cache():
+    """Drop cached get_latest_firmware results."""
+    _latest_firmware_cache.clear()
+
+
+def _fetch_latest_firmware(stable_only: bool, include_changelog: bool) -> dict:
+    """Query the latest firmware version."""
+    columns = "id, version, release_date, file_url, file_size_kb, checksum, is_stable, min_battery_pct"
+    if include_changelog:
+        columns += ", changelog"
+    sql = f"""
+        SELECT {columns} FROM firmware_versions
         WHERE is_stable = TRUE OR %s = FALSE
         ORDER BY release_date DESC
         LIMIT 1
@@ -1053,18 +2201,46 @@ def create_firmware_update(bin_id: str, target_version: str, current_version: st
         return result['id'] if result else None
 
 
+def create_firmware_updates_bulk(bin_ids: list, target_version: str) -> dict:
+    """
+    Create firmware update jobs for many bins in one statement, taking each
+    bin's current version from its reported shadow state.
+    Returns {bin_id: {"id": ..., "current_version": ...}}.
+    """
+    if not bin_ids:
+        return {}
+    sql = """
+        INSERT INTO firmware_updates (bin_id, target_version, current_version)
+        SELECT b.bin_id, %(version)s, s.reported_state ->> 'firmware_version'
+        FROM UNNEST(%(bin_ids)s::text[]) AS b(bin_id)
+        LEFT JOIN device_shadow s ON s.bin_id = b.bin_id
+        RETURNING id, bin_id, current_version
+    """
+    with get_cursor(commit=True) as cur:
+        cur.execute(sql, {"bin_ids": list(bin_ids), "version": target_version})
+        return {
+            row['bin_id']: {"id": row['id'], "current_version": row['current_version']}
+            for row in cur.fetchall()
+        }
+
+
 def update_firmware_progress(bin_id: str, progress_pct: int, status: str = None):
     """Update firmware update progress."""
     if status:
+        # UPDATE has no ORDER BY/LIMIT; pick the bin's latest unfinished job by id
         sql = """
             UPDATE firmware_updates
-            SET progress_pct = %s, status = %s, completed_at = CASE WHEN %s IN ('completed', 'failed') THEN NOW() ELSE NULL END
-            WHERE bin_id = %s AND status NOT IN ('completed', 'failed')
-            ORDER BY started_at DESC
-            LIMIT 1
+            SET progress_pct = %(progress_pct)s, status = %(status)s,
+                completed_at = CASE WHEN %(status)s IN ('completed', 'failed') THEN NOW() ELSE completed_at END
+            WHERE id = (
+                SELECT id FROM firmware_updates
+                WHERE bin_id = %(bin_id)s AND status NOT IN ('completed', 'failed')
+                ORDER BY started_at DESC
+                LIMIT 1
+            )
         """
         with get_cursor(commit=True) as cur:
-            cur.execute(sql, (progress_pct, status, status, bin_id))
+            cur.execute(sql, {"progress_pct": progress_pct, "status": status, "bin_id": bin_id})
     else:
         sql = """
             UPDATE firmware_updates
@@ -1075,37 +2251,72 @@ def update_firmware_progress(bin_id: str, progress_pct: int, status: str = None)
             cur.execute(sql, (progress_pct, bin_id))
 
 
+def update_firmware_progress_batch(updates: list):
+    """
+    Apply many (bin_id, progress_pct, status) progress updates in one statement.
+    Same semantics as update_firmware_progress: with a status, the bin's most
+    recent unfinished job is updated; with status None, every in-progress job
+    for the bin gets the new percentage. Later entries for a bin win.
+    """
+    latest = {bin_id: (bin_id, progress_pct, status) for bin_id, progress_pct, status in updates}
+    if not latest:
+        return
+    sql = """
+        WITH v (bin_id, progress_pct, status) AS (VALUES %s),
+        target AS (
+            (SELECT DISTINCT ON (fu.bin_id) fu.id, v.progress_pct, v.status
+             FROM firmware_updates fu
+             JOIN v ON v.bin_id = fu.bin_id
+             WHERE v.status IS NOT NULL AND fu.status NOT IN ('completed', 'failed')
+             ORDER BY fu.bin_id, fu.started_at DESC)
+            UNION ALL
+            SELECT fu.id, v.progress_pct, v.status
+            FROM firmware_updates fu
+            JOIN v ON v.bin_id = fu.bin_id
+            WHERE v.status IS NULL AND fu.status = 'in_progress'
+        )
+        UPDATE firmware_updates fu
+        SET progress_pct = t.progress_pct,
+            status = COALESCE(t.status, fu.status),
+            completed_at = CASE WHEN t.status IN ('completed', 'failed') THEN NOW() ELSE fu.completed_at END
+        FROM target t
+        WHERE fu.id = t.id
+    """
+    with get_cursor(commit=True) as cur:
+        execute_values(cur, sql, list(latest.values()),
+                       template="(%s, %s::int, %s::varchar)", page_size=len(latest))
+
+
+# psycopg2 binds values client-side, so the planner sees a literal NULL or
+# pattern and folds the OR away: still a prefix range on the pattern index
+_SQL_PENDING_FIRMWARE_UPDATES = """
+    SELECT fu.id, fu.bin_id, fu.target_version, fu.current_version, fu.status,
+           fu.started_at, fu.progress_pct, b.last_seen, b.device_status
+    FROM firmware_updates fu
+    JOIN bins b ON fu.bin_id = b.bin_id
+    WHERE fu.status = 'pending'
+      AND (%(pattern)s::text IS NULL OR fu.bin_id LIKE %(pattern)s)
+    ORDER BY fu.started_at ASC
+"""
+
+
 def get_pending_firmware_updates(zone_prefix: str = None) -> list:
-    """Get pending firmware updates, optionally filtered by zone."""
+    """Get pending firmware updates, optionally filtered by bin_id prefix."""
+    pattern = None
     if zone_prefix:
-        sql = """
-            SELECT fu.*, b.last_seen, b.device_status
-            FROM firmware_updates fu
-            JOIN bins b ON fu.bin_id = b.bin_id
-            WHERE fu.status = 'pending' AND fu.bin_id LIKE %s
-            ORDER BY fu.started_at ASC
-        """
-        with get_cursor() as cur:
-            cur.execute(sql, (f"{zone_prefix}%",))
-            return cur.fetchall()
-    else:
-        sql = """
-            SELECT fu.*, b.last_seen, b.device_status
-            FROM firmware_updates fu
-            JOIN bins b ON fu.bin_id = b.bin_id
-            WHERE fu.status = 'pending'
-            ORDER BY fu.started_at ASC
-        """
-        with get_cursor() as cur:
-            cur.execute(sql)
-            return cur.fetchall()
+        # Escape LIKE wildcards so the prefix is matched literally and the
+        # pattern stays a pure left-anchored range on the text_pattern_ops index
+        pattern = re.sub(r"([\\%_])", r"\\\1", zone_prefix) + "%"
+    with get_cursor() as cur:
+        cur.execute(_SQL_PENDING_FIRMWARE_UPDATES, {"pattern": pattern})
+        return cur.fetchall()
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Diagnostic Mode
 # ─────────────────────────────────────────────────────────────────────────────
 
-def init_diagnostics_table():
+def init_diagnostics_table(cur=None):
     """Initialize diagnostics table."""
     sql = """
         CREATE TABLE IF NOT EXISTS device_diagnostics (
@@ -1118,9 +2329,10 @@ def init_diagnostics_table():
             status VARCHAR(20) DEFAULT 'pending'
         );
         CREATE INDEX IF NOT EXISTS idx_diag_bin_id ON device_diagnostics(bin_id);
+        -- jsonb_path_ops serves @>, @? and @@; only key-existence (?) needs jsonb_ops
+        CREATE INDEX IF NOT EXISTS idx_diag_data_gin ON device_diagnostics USING GIN (data jsonb_path_ops);
     """
-    with get_cursor(commit=True) as cur:
-        cur.execute(sql)
+    _execute_ddl(sql, cur)
 
 
 def request_diagnostic(bin_id: str, diagnostic_type: str = 'full') -> int:
@@ -1138,7 +2350,6 @@ def request_diagnostic(bin_id: str, diagnostic_type: str = 'full') -> int:
 
 def store_diagnostic_result(bin_id: str, data: dict, diagnostic_id: int = None):
     """Store diagnostic result from device."""
-    import json
     if diagnostic_id:
         sql = """
             UPDATE device_diagnostics
@@ -1146,24 +2357,66 @@ def store_diagnostic_result(bin_id: str, data: dict, diagnostic_id: int = None):
             WHERE id = %s
         """
         with get_cursor(commit=True) as cur:
-            cur.execute(sql, (json.dumps(data), diagnostic_id))
+            cur.execute(sql, (Json(data), diagnostic_id))
     else:
         # Update most recent pending diagnostic for this bin
         sql = """
             UPDATE device_diagnostics
             SET received_at = NOW(), data = %s, status = 'received'
-            WHERE bin_id = %s AND status = 'pending'
-            ORDER BY requested_at DESC
-            LIMIT 1
+            WHERE id = (
+                SELECT id FROM device_diagnostics
+                WHERE bin_id = %s AND status = 'pending'
+                ORDER BY requested_at DESC
+                LIMIT 1
+            )
         """
         with get_cursor(commit=True) as cur:
-            cur.execute(sql, (json.dumps(data), bin_id))
+            cur.execute(sql, (Json(data), bin_id))
 
 
-def get_device_diagnostics(bin_id: str, limit: int = 10) -> list:
-    """Get diagnostic history for a device."""
+def store_diagnostic_results_batch(results: list):
+    """
+    Store many (bin_id, data, diagnostic_id) results in one statement.
+    Rows without a diagnostic_id fill the bin's most recent pending request.
+    """
+    if not results:
+        return
+    rows = [(bin_id, Json(data), diagnostic_id) for bin_id, data, diagnostic_id in results]
     sql = """
-        SELECT * FROM device_diagnostics
+        WITH v (bin_id, data, diagnostic_id) AS (VALUES %s),
+        target AS (
+            SELECT v.diagnostic_id AS id, v.data
+            FROM v
+            WHERE v.diagnostic_id IS NOT NULL
+            UNION ALL
+            (
+                SELECT DISTINCT ON (d.bin_id) d.id, v.data
+                FROM device_diagnostics d
+                JOIN v ON v.bin_id = d.bin_id AND v.diagnostic_id IS NULL
+                WHERE d.status = 'pending'
+                ORDER BY d.bin_id, d.requested_at DESC
+            )
+        )
+        UPDATE device_diagnostics d
+        SET received_at = NOW(), data = t.data, status = 'received'
+        FROM target t
+        WHERE d.id = t.id
+    """
+    with get_cursor(commit=True) as cur:
+        execute_values(cur, sql, rows, template="(%s, %s::jsonb, %s::int)", page_size=len(rows))
+
+
+def get_device_diagnostics(bin_id: str, limit: int = 10, include_data: bool = False) -> list:
+    """
+    Get diagnostic history for a device.
+    The JSONB payload is left out unless include_data is set; fetch a single
+    report's payload with get_diagnostic_detail().
+    """
+    columns = "id, bin_id, requested_at, received_at, diagnostic_type, status"
+    if include_data:
+        columns += ", data"
+    sql = f"""
+        SELECT {columns} FROM device_diagnostics
         WHERE bin_id = %s
         ORDER BY requested_at DESC
         LIMIT %s
@@ -1173,11 +2426,43 @@ def get_device_diagnostics(bin_id: str, limit: int = 10) -> list:
         return [dict(r) for r in cur.fetchall()]
 
 
+def search_diagnostics(jsonpath: str, bin_id: str = None, limit: int = 50) -> list:
+    """
+    Find diagnostic reports whose data matches a jsonpath expression,
+    e.g. '$.errors[*] ? (@.code == "SENSOR_TIMEOUT")'.
+    The @? match is answered from the idx_diag_data_gin index.
+    """
+    sql = """
+        SELECT id, bin_id, requested_at, received_at, diagnostic_type, status
+        FROM device_diagnostics
+        WHERE data @? %(path)s::jsonpath
+          AND (%(bin_id)s::text IS NULL OR bin_id = %(bin_id)s)
+        ORDER BY requested_at DESC
+        LIMIT %(limit)s
+    """
+    with get_cursor() as cur:
+        cur.execute(sql, {"path": jsonpath, "bin_id": bin_id, "limit": limit})
+        return [dict(r) for r in cur.fetchall()]
+
+
+def get_diagnostic_detail(diagnostic_id: int) -> dict:
+    """Get one diagnostic report including its data payload."""
+    sql = """
+        SELECT id, bin_id, requested_at, received_at, diagnostic_type, status, data
+        FROM device_diagnostics
+        WHERE id = %s
+    """
+    with get_cursor() as cur:
+        cur.execute(sql, (diagnostic_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Device Provisioning
 # ─────────────────────────────────────────────────────────────────────────────
 
-def init_provisioning_table():
+def init_provisioning_table(cur=None):
     """Initialize device provisioning table."""
     sql = """
         CREATE TABLE IF NOT EXISTS device_credentials (
@@ -1190,8 +2475,7 @@ def init_provisioning_table():
             revoked_at TIMESTAMP
         );
     """
-    with get_cursor(commit=True) as cur:
-        cur.execute(sql)
+    _execute_ddl(sql, cur)
 
 
 def provision_device(bin_id: str, mqtt_username: str, mqtt_password_hash: str, 
@@ -1245,10 +2529,34 @@ def get_device_credentials(bin_id: str) -> dict:
 
 def init_all_iot_tables():
     """Initialize all IoT-related tables."""
-    init_heartbeat_table()
-    init_command_ack_table()
-    init_device_shadow_table()
-    init_power_profile_table()
-    init_firmware_table()
-    init_diagnostics_table()
-    init_provisioning_table()
+    maintain_telemetry_partitions()
+    # One transaction for all IoT DDL: a single commit at startup, and a
+    # failed upgrade leaves the schema untouched instead of half-applied
+    with get_cursor(commit=True) as cur:
+        init_heartbeat_table(cur)
+        init_command_ack_table(cur)
+        init_device_shadow_table(cur)
+        init_fill_rate_state_table(cur)
+        init_power_profile_table(cur)
+        init_firmware_table(cur)
+        init_diagnostics_table(cur)
+        init_provisioning_table(cur)
+
+
+_SCHEMA_INITIALIZED = False
+
+
+def initialize_schema():
+    """
+    Run all idempotent schema setup once per process.
+    Called at startup so hot paths (sleep toggles, collection sessions)
+    don't issue DDL on every call.
+    """
+    global _SCHEMA_INITIALIZED
+    if _SCHEMA_INITIALIZED:
+        return
+    ensure_sleep_mode_column()
+    init_admin_table()
+    init_collection_sessions_table()
+    init_all_iot_tables()
+    _SCHEMA_INITIALIZED = True
@@ -9,6 +9,8 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from .api import router
+from . import async_db
+from . import db
 from . import mqtt_ingest
 from . import mqtt_commands
 
@@ -21,10 +23,20 @@ from . import mqtt_commands
 async def lifespan(app: FastAPI):
     """
     Manage application lifespan.
-    Starts MQTT ingest and command publisher on startup, stops on shutdown.
+    Starts the ingest writer, MQTT ingest and command publisher on startup,
+    stops them on shutdown (the writer last, so queued rows are flushed).
     """
     # Startup
     print("Starting CleanRoute Backend...")
+    try:
+        db.initialize_schema()
+    except Exception as e:
+        print(f"Could not initialize database schema: {e}")
+    db.start_ingest_writer()
+    try:
+        await async_db.init_pool()
+    except Exception as e:
+        print(f"Could not create async database pool: {e}")
     mqtt_ingest.start_mqtt_ingest()
     mqtt_commands.init_command_client()
     
@@ -34,6 +46,8 @@ async def lifespan(app: FastAPI):
     print("Shutting down CleanRoute Backend...")
     mqtt_ingest.stop_mqtt_ingest()
     mqtt_commands.stop_command_client()
+    await async_db.close_pool()
+    db.stop_ingest_writer()
 
 
 # ─────────────────────────────────────────────────────────────────────────────
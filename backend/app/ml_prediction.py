@@ -10,10 +10,12 @@ Data Sources:
 """
 import logging
 import os
-import csv
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
 from typing import List, Dict, Any, Optional, Tuple
-from dateutil import parser as date_parser
+import numpy as np
+import pandas as pd
 from . import db
 
 logger = logging.getLogger(__name__)
@@ -25,6 +27,10 @@ EWMA_ALPHA = 0.3  # Smoothing factor (0-1), higher = more weight on recent data
 MIN_DATA_POINTS = 5  # Minimum historical points needed for prediction
 MAX_HISTORY_DAYS = 30  # Look back up to 30 days
 DEFAULT_FILL_RATE = 1.5  # Default fill rate (% per hour) if no history
+MAX_RATE_PER_HOUR = 10  # Faster fill rates are treated as sensor errors
+HISTORY_STREAM_ITERSIZE = 5000  # Rows per round-trip when streaming all-bin history
+VECTORIZE_MIN_POINTS = 8  # Use the NumPy EWMA path from this many points up
+EWMA_CACHE_TTL = float(os.getenv("EWMA_CACHE_TTL", 300))  # Seconds to reuse a bin's fill rate (0 = off)
 
 # CSV data source (optional)
 CSV_DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "mock_data")
@@ -35,6 +41,51 @@ USE_CSV_DATA = os.getenv("USE_CSV_DATA", "false").lower() == "true"
 # CSV Data Source (Alternative to Database)
 # ─────────────────────────────────────────────────────────────────────────────
 
+# (path, mtime, frame) of the last parsed telemetry CSV
+_csv_cache: Optional[Tuple[str, float, pd.DataFrame]] = None
+
+
+def _load_csv_frame() -> Optional[pd.DataFrame]:
+    """
+    Parse the telemetry CSV once (re-read only when the file changes).
+    Returns a frame indexed by bin_id with 'ts' and 'fill_pct', sorted by
+    bin_id then ts, or None if the file is missing.
+    """
+    global _csv_cache
+    csv_path = os.path.join(CSV_DATA_DIR, "telemetry_data.csv")
+    
+    if not os.path.exists(csv_path):
+        logger.warning(f"CSV file not found: {csv_path}")
+        return None
+    
+    mtime = os.path.getmtime(csv_path)
+    if _csv_cache is not None and _csv_cache[0] == csv_path and _csv_cache[1] == mtime:
+        return _csv_cache[2]
+    
+    df = pd.read_csv(
+        csv_path,
+        usecols=['bin_id', 'ts', 'fill_pct'],
+        dtype={'bin_id': 'category', 'fill_pct': 'float64'}
+    )
+    df['ts'] = pd.to_datetime(df['ts'])
+    df = df.sort_values(['bin_id', 'ts']).set_index('bin_id')
+    _csv_cache = (csv_path, mtime, df)
+    logger.info(f"Loaded {len(df)} telemetry records from {csv_path}")
+    return df
+
+
+def _csv_records(df: pd.DataFrame, days: int) -> List[Dict]:
+    """Rows newer than `days` as [{'ts': datetime, 'fill_pct': float}], oldest first."""
+    cutoff = pd.Timestamp.utcnow() - pd.Timedelta(days=days)
+    if df['ts'].dt.tz is None:
+        cutoff = cutoff.tz_localize(None)
+    recent = df[df['ts'] >= cutoff]
+    return [
+        {'ts': ts, 'fill_pct': fill}
+        for ts, fill in zip(recent['ts'].dt.to_pydatetime(), recent['fill_pct'].tolist())
+    ]
+
+
 def load_telemetry_from_csv(bin_id: str, days: int = MAX_HISTORY_DAYS) -> List[Dict]:
     """
     Load historical telemetry from CSV file (alternative to database).
@@ -46,29 +97,12 @@ def load_telemetry_from_csv(bin_id: str, days: int = MAX_HISTORY_DAYS) -> List[D
     Returns:
         List of telemetry records
     """
-    csv_path = os.path.join(CSV_DATA_DIR, "telemetry_data.csv")
-    
-    if not os.path.exists(csv_path):
-        logger.warning(f"CSV file not found: {csv_path}")
-        return []
-    
     try:
-        records = []
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        
-        with open(csv_path, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if row['bin_id'] == bin_id:
-                    ts = date_parser.parse(row['ts'])
-                    if ts >= cutoff_date:
-                        records.append({
-                            'ts': ts,
-                            'fill_pct': float(row['fill_pct'])
-                        })
+        df = _load_csv_frame()
+        if df is None or bin_id not in df.index:
+            return []
         
-        # Sort by timestamp
-        records.sort(key=lambda x: x['ts'])
+        records = _csv_records(df.loc[[bin_id]], days)
         logger.info(f"Loaded {len(records)} records from CSV for {bin_id}")
         return records
         
@@ -77,6 +111,28 @@ def load_telemetry_from_csv(bin_id: str, days: int = MAX_HISTORY_DAYS) -> List[D
         return []
 
 
+def load_all_telemetry_from_csv(days: int = MAX_HISTORY_DAYS) -> Dict[str, List[Dict]]:
+    """
+    Load historical telemetry for every bin from the CSV file in one pass.
+    
+    Returns:
+        Dict of bin_id -> records sorted by timestamp
+    """
+    try:
+        df = _load_csv_frame()
+        if df is None:
+            return {}
+        
+        return {
+            str(bin_id): _csv_records(group, days)
+            for bin_id, group in df.groupby(level='bin_id', observed=True)
+        }
+        
+    except Exception as e:
+        logger.error(f"Error loading CSV data: {e}")
+        return {}
+
+
 def get_historical_data(bin_id: str, days: int = MAX_HISTORY_DAYS) -> List[Dict]:
     """
     Get historical telemetry data from database or CSV.
@@ -94,11 +150,11 @@ def get_historical_data(bin_id: str, days: int = MAX_HISTORY_DAYS) -> List[Dict]
         # Use database (existing logic)
         try:
             with db.get_cursor() as cur:
-                cur.execute("""
+                db.execute_prepared(cur, "bin_fill_history", """
                     SELECT ts, fill_pct
                     FROM telemetry
-                    WHERE bin_id = %s
-                        AND ts >= NOW() - INTERVAL '%s days'
+                    WHERE bin_id = $1
+                        AND ts >= NOW() - make_interval(days => $2)
                         AND fill_pct IS NOT NULL
                     ORDER BY ts ASC
                 """, (bin_id, days))
@@ -109,10 +165,193 @@ def get_historical_data(bin_id: str, days: int = MAX_HISTORY_DAYS) -> List[Dict]
             return []
 
 
+def get_all_historical_data(days: int = MAX_HISTORY_DAYS,
+                            bin_ids: Optional[List[str]] = None) -> Dict[str, List[Dict]]:
+    """
+    Get historical telemetry for all bins (or only `bin_ids`) in a single
+    query (or CSV pass).
+    
+    Returns:
+        Dict of bin_id -> records with 'ts' and 'fill_pct', oldest first
+    """
+    if USE_CSV_DATA:
+        history = load_all_telemetry_from_csv(days)
+        if bin_ids is not None:
+            history = {bin_id: history[bin_id] for bin_id in bin_ids if bin_id in history}
+        return history
+    
+    # bin_id DESC, ts ASC is a backward walk of the (bin_id, ts DESC) covering
+    # index, so no sort is needed; bin order doesn't matter for grouping.
+    # Rows stream from a server-side cursor as plain tuples, so only the
+    # compact per-bin records are ever held in memory.
+    # psycopg2 binds client-side, so with no bin_ids the planner sees a
+    # literal NULL and drops the filter
+    rows = db.stream_rows("""
+        SELECT bin_id, ts, fill_pct
+        FROM telemetry
+        WHERE ts >= NOW() - make_interval(days => %(days)s)
+            AND fill_pct IS NOT NULL
+            AND (%(bin_ids)s::text[] IS NULL OR bin_id = ANY(%(bin_ids)s::text[]))
+        ORDER BY bin_id DESC, ts ASC
+    """, {"days": days, "bin_ids": list(bin_ids) if bin_ids is not None else None},
+        itersize=HISTORY_STREAM_ITERSIZE, cursor_factory=None)
+    
+    return {
+        bin_id: [{'ts': ts, 'fill_pct': fill_pct} for _, ts, fill_pct in bin_rows]
+        for bin_id, bin_rows in groupby(rows, key=lambda r: r[0])
+    }
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Core EWMA Calculation
 # ─────────────────────────────────────────────────────────────────────────────
 
+def _ewma_rate(bin_id: str, history: List[Dict], alpha: float = EWMA_ALPHA) -> Tuple[Optional[float], str]:
+    """
+    EWMA fill rate over already-fetched history (oldest first).
+    See calculate_ewma_fill_rate for the return values.
+    """
+    if len(history) < MIN_DATA_POINTS:
+        logger.warning(f"Insufficient data for {bin_id}: {len(history)} points (need {MIN_DATA_POINTS})")
+        return None, "insufficient_data"
+    
+    if len(history) >= VECTORIZE_MIN_POINTS:
+        ewma_rate = _ewma_rate_vectorized(history, alpha)
+    else:
+        ewma_rate = _ewma_rate_scalar(history, alpha)
+    
+    if ewma_rate is None:
+        logger.warning(f"No valid fill rates calculated for {bin_id}")
+        return None, "no_valid_rates"
+    
+    confidence = _confidence(len(history))
+    logger.info(f"Bin {bin_id}: EWMA fill rate = {ewma_rate:.3f}% per hour ({confidence} confidence)")
+    
+    return ewma_rate, confidence
+
+
+def _confidence(n_samples: int) -> str:
+    """Confidence level from the number of readings behind a fill rate."""
+    if n_samples < 10:
+        return "low"
+    if n_samples < 15:
+        return "medium"
+    return "high"
+
+
+def _rate_from_state(state: Optional[Dict]) -> Optional[Tuple[Optional[float], str]]:
+    """
+    (fill_rate, confidence) from a bin's persisted rolling EWMA, or None when
+    the state is missing, stale or too thin to trust (recompute from history).
+    """
+    if not state or state['n_samples'] < MIN_DATA_POINTS:
+        return None
+    last_ts = state['last_ts']
+    if last_ts is None or last_ts < datetime.now(timezone.utc) - timedelta(days=MAX_HISTORY_DAYS):
+        return None
+    if state['ewma_rate'] is None:
+        return None, "no_valid_rates"
+    return state['ewma_rate'], _confidence(state['n_samples'])
+
+
+def _state_row(bin_id: str, history: List[Dict], fill_rate: Optional[float]) -> Optional[Tuple]:
+    """Rolling-state row for a full recompute, or None when there is nothing to seed."""
+    if USE_CSV_DATA or not history:
+        return None
+    last_ts = history[-1]['ts']
+    if last_ts.tzinfo is None:
+        last_ts = last_ts.replace(tzinfo=timezone.utc)
+    return (bin_id, fill_rate, last_ts, history[-1]['fill_pct'], len(history))
+
+
+def _seed_states(rows: List[Tuple]):
+    """Store full recomputes as rolling state so later calls skip history."""
+    try:
+        db.save_fill_rate_states(rows)
+    except Exception as e:
+        logger.error(f"Error saving fill rate state: {e}")
+
+
+def _ewma_rate_scalar(history: List[Dict], alpha: float) -> Optional[float]:
+    """Pure-Python EWMA of the hourly fill rates (short histories)."""
+    # Calculate fill rates between consecutive readings
+    fill_rates = []
+    
+    for i in range(1, len(history)):
+        prev_ts = history[i-1]['ts']
+        curr_ts = history[i]['ts']
+        prev_fill = history[i-1]['fill_pct']
+        curr_fill = history[i]['fill_pct']
+        
+        # Calculate time difference in hours
+        time_diff = (curr_ts - prev_ts).total_seconds() / 3600
+        
+        if time_diff > 0:
+            # Calculate fill change rate (% per hour)
+            fill_change = curr_fill - prev_fill
+            rate = fill_change / time_diff
+            
+            # Only consider positive rates (filling up, not being emptied)
+            # Filter out unrealistic rates (sensor errors)
+            if 0 <= rate <= MAX_RATE_PER_HOUR:
+                fill_rates.append(rate)
+    
+    if not fill_rates:
+        return None
+    
+    # Apply EWMA smoothing
+    ewma_rate = fill_rates[0]
+    for rate in fill_rates[1:]:
+        ewma_rate = alpha * rate + (1 - alpha) * ewma_rate
+    return ewma_rate
+
+
+def _ewma_rate_vectorized(history: List[Dict], alpha: float) -> Optional[float]:
+    """NumPy EWMA of the hourly fill rates; same result as _ewma_rate_scalar."""
+    ts = np.array([r['ts'].timestamp() for r in history], dtype=np.float64)
+    fill = np.array([r['fill_pct'] for r in history], dtype=np.float64)
+    
+    dt_hours = np.diff(ts) / 3600
+    valid_dt = dt_hours > 0
+    rates = np.diff(fill)[valid_dt] / dt_hours[valid_dt]
+    # Filling up only; larger jumps are sensor errors
+    rates = rates[(rates >= 0) & (rates <= MAX_RATE_PER_HOUR)]
+    if rates.size == 0:
+        return None
+    
+    # Unrolled recursion e = alpha*r + (1-alpha)*e seeded with rates[0]:
+    # rates[k] (k >= 1) is weighted alpha*(1-alpha)^(n-1-k), rates[0] by (1-alpha)^(n-1)
+    weights = alpha * (1 - alpha) ** np.arange(rates.size - 1, -1, -1, dtype=np.float64)
+    weights[0] = (1 - alpha) ** (rates.size - 1)
+    return float(np.dot(weights, rates))
+
+
+# bin_id -> (monotonic expiry, fill_rate, confidence); default alpha only
+_ewma_cache: Dict[str, Tuple[float, Optional[float], str]] = {}
+
+
+def _get_cached_ewma(bin_id: str) -> Optional[Tuple[Optional[float], str]]:
+    """Return a live cached (fill_rate, confidence) for bin_id, or None."""
+    entry = _ewma_cache.get(bin_id)
+    if entry is not None and time.monotonic() < entry[0]:
+        return entry[1], entry[2]
+    return None
+
+
+def _store_ewma(bin_id: str, fill_rate: Optional[float], confidence: str):
+    """Cache a computed fill rate (errors are never cached)."""
+    if EWMA_CACHE_TTL > 0 and confidence != "error":
+        _ewma_cache[bin_id] = (time.monotonic() + EWMA_CACHE_TTL, fill_rate, confidence)
+
+
+def invalidate_ewma_cache(bin_id: str = None):
+    """Drop the cached fill rate for one bin (after a new fill sample), or all bins."""
+    if bin_id is None:
+        _ewma_cache.clear()
+    else:
+        _ewma_cache.pop(bin_id, None)
+
+
 def calculate_ewma_fill_rate(bin_id: str, alpha: float = EWMA_ALPHA) -> Tuple[Optional[float], str]:
     """
     Calculate exponentially weighted moving average of fill rate for a bin.
@@ -126,55 +365,29 @@ def calculate_ewma_fill_rate(bin_id: str, alpha: float = EWMA_ALPHA) -> Tuple[Op
         fill_rate_per_hour: Percentage increase per hour (e.g., 2.5 = 2.5% per hour)
         confidence_level: 'high', 'medium', 'low', or None if insufficient data
     """
+    use_cache = alpha == EWMA_ALPHA
+    if use_cache:
+        cached = _get_cached_ewma(bin_id)
+        if cached is not None:
+            return cached
+    
     try:
+        # Rolling state kept up to date by the ingest writer: one row lookup
+        if use_cache and not USE_CSV_DATA:
+            from_state = _rate_from_state(db.get_fill_rate_state(bin_id))
+            if from_state is not None:
+                _store_ewma(bin_id, *from_state)
+                return from_state
+        
         # Get historical telemetry data (database or CSV)
         history = get_historical_data(bin_id, MAX_HISTORY_DAYS)
-        
-        if len(history) < MIN_DATA_POINTS:
-            logger.warning(f"Insufficient data for {bin_id}: {len(history)} points (need {MIN_DATA_POINTS})")
-            return None, "insufficient_data"
-        
-        # Calculate fill rates between consecutive readings
-        fill_rates = []
-        
-        for i in range(1, len(history)):
-            prev_ts = history[i-1]['ts']
-            curr_ts = history[i]['ts']
-            prev_fill = history[i-1]['fill_pct']
-            curr_fill = history[i]['fill_pct']
-            
-            # Calculate time difference in hours
-            time_diff = (curr_ts - prev_ts).total_seconds() / 3600
-            
-            if time_diff > 0:
-                # Calculate fill change rate (% per hour)
-                fill_change = curr_fill - prev_fill
-                rate = fill_change / time_diff
-                
-                # Only consider positive rates (filling up, not being emptied)
-                # Filter out unrealistic rates (sensor errors)
-                if 0 <= rate <= 10:  # Max 10% per hour is reasonable
-                    fill_rates.append(rate)
-        
-        if not fill_rates:
-            logger.warning(f"No valid fill rates calculated for {bin_id}")
-            return None, "no_valid_rates"
-        
-        # Apply EWMA smoothing
-        ewma_rate = fill_rates[0]
-        for rate in fill_rates[1:]:
-            ewma_rate = alpha * rate + (1 - alpha) * ewma_rate
-        
-        # Determine confidence based on data quality
-        confidence = "high"
-        if len(history) < 15:
-            confidence = "medium"
-        if len(history) < 10:
-            confidence = "low"
-        
-        logger.info(f"Bin {bin_id}: EWMA fill rate = {ewma_rate:.3f}% per hour ({confidence} confidence)")
-        
-        return ewma_rate, confidence
+        fill_rate, confidence = _ewma_rate(bin_id, history, alpha)
+        if use_cache:
+            _store_ewma(bin_id, fill_rate, confidence)
+            seed = _state_row(bin_id, history, fill_rate)
+            if seed:
+                _seed_states([seed])
+        return fill_rate, confidence
     
     except Exception as e:
         logger.error(f"Error calculating EWMA for {bin_id}: {e}")
@@ -185,13 +398,15 @@ def calculate_ewma_fill_rate(bin_id: str, alpha: float = EWMA_ALPHA) -> Tuple[Op
 # Prediction Functions
 # ─────────────────────────────────────────────────────────────────────────────
 
-def predict_fill_at_time(bin_id: str, target_time: datetime) -> Dict[str, Any]:
+def predict_fill_at_time(bin_id: str, target_time: datetime,
+                         threshold_pct: float = 80.0) -> Dict[str, Any]:
     """
     Predict what fill level a bin will have at a specific future time.
     
     Args:
         bin_id: Bin identifier
         target_time: Future datetime to predict fill level
+        threshold_pct: Fill percentage threshold for collection (default 80%)
     
     Returns:
         Dictionary with prediction details
@@ -218,60 +433,93 @@ def predict_fill_at_time(bin_id: str, target_time: datetime) -> Dict[str, Any]:
         if not bin_data:
             return {"error": "Bin not found", "bin_id": bin_id}
         
-        current_fill = bin_data['current_fill']
+        if bin_data['current_fill'] is None:
+            return _no_telemetry_prediction(bin_id)
         
-        if current_fill is None:
-            return {
-                "bin_id": bin_id,
-                "error": "No telemetry data",
-                "needs_collection": False,
-                "confidence": "none"
-            }
+        # Already at threshold: needs collection whatever the fill rate is
+        if bin_data['current_fill'] >= threshold_pct:
+            return _full_bin_prediction(bin_data, target_time)
         
         # Calculate fill rate
         fill_rate, confidence = calculate_ewma_fill_rate(bin_id)
-        
-        # If no valid fill rate, use current fill (assume no change)
-        if fill_rate is None:
-            predicted_fill = current_fill
-            confidence = "low"
-        else:
-            # Calculate hours until target time
-            current_time = datetime.utcnow()
-            hours_until_target = (target_time - current_time).total_seconds() / 3600
-            
-            # Predict future fill level
-            predicted_fill = current_fill + (fill_rate * hours_until_target)
-            
-            # Cap at 100% (can't overflow beyond capacity)
-            predicted_fill = min(predicted_fill, 100.0)
-            
-            # If prediction is less than current (decreasing trend), use current
-            if predicted_fill < current_fill:
-                predicted_fill = current_fill
-        
-        return {
-            "bin_id": bin_id,
-            "lat": bin_data['lat'],
-            "lon": bin_data['lon'],
-            "current_fill": round(current_fill, 1),
-            "predicted_fill": round(predicted_fill, 1),
-            "fill_rate_per_hour": round(fill_rate, 3) if fill_rate else None,
-            "prediction_time": target_time.isoformat(),
-            "confidence": confidence,
-            "device_status": bin_data['device_status'],
-            "needs_collection": predicted_fill >= 80.0,  # Default threshold
-            "last_seen": bin_data['last_seen'].isoformat() if bin_data['last_seen'] else None
-        }
+        prediction = _build_prediction(bin_data, fill_rate, confidence, target_time)
+        prediction['needs_collection'] = prediction['predicted_fill'] >= threshold_pct
+        return prediction
     
     except Exception as e:
         logger.error(f"Error predicting fill for {bin_id}: {e}")
         return {"error": str(e), "bin_id": bin_id}
 
 
+def _no_telemetry_prediction(bin_id: str) -> Dict[str, Any]:
+    """Prediction result for a bin that has never reported."""
+    return {
+        "bin_id": bin_id,
+        "error": "No telemetry data",
+        "needs_collection": False,
+        "confidence": "none"
+    }
+
+
+def _full_bin_prediction(bin_data: Dict, target_time: datetime) -> Dict[str, Any]:
+    """
+    Prediction for a bin already at or above the collection threshold.
+    Fill never goes down before collection, so no fill rate is needed.
+    """
+    prediction = _build_prediction(bin_data, None, "high", target_time)
+    prediction['confidence'] = "high"
+    prediction['needs_collection'] = True
+    return prediction
+
+
+def _build_prediction(bin_data: Dict, fill_rate: Optional[float], confidence: str,
+                      target_time: datetime) -> Dict[str, Any]:
+    """
+    Extrapolate a bin's current fill to target_time.
+    bin_data carries bin_id, lat, lon, last_seen, device_status and current_fill.
+    """
+    bin_id = bin_data['bin_id']
+    current_fill = bin_data['current_fill']
+    
+    # If no valid fill rate, use current fill (assume no change)
+    if fill_rate is None:
+        predicted_fill = current_fill
+        confidence = "low"
+    else:
+        # Calculate hours until target time
+        current_time = datetime.utcnow()
+        hours_until_target = (target_time - current_time).total_seconds() / 3600
+        
+        # Predict future fill level
+        predicted_fill = current_fill + (fill_rate * hours_until_target)
+        
+        # Cap at 100% (can't overflow beyond capacity)
+        predicted_fill = min(predicted_fill, 100.0)
+        
+        # If prediction is less than current (decreasing trend), use current
+        if predicted_fill < current_fill:
+            predicted_fill = current_fill
+    
+    return {
+        "bin_id": bin_id,
+        "lat": bin_data['lat'],
+        "lon": bin_data['lon'],
+        "current_fill": round(current_fill, 1),
+        "predicted_fill": round(predicted_fill, 1),
+        "fill_rate_per_hour": round(fill_rate, 3) if fill_rate else None,
+        "prediction_time": target_time.isoformat(),
+        "confidence": confidence,
+        "device_status": bin_data['device_status'],
+        "needs_collection": predicted_fill >= 80.0,  # Default threshold
+        "last_seen": bin_data['last_seen'].isoformat() if bin_data['last_seen'] else None
+    }
+
+
 def forecast_all_bins(target_time: datetime, threshold_pct: float = 80.0) -> Dict[str, Any]:
     """
     Predict fill levels for ALL bins at a specific future time.
+    Fetches current state and history for every bin up front (two queries)
+    instead of querying per bin.
     
     Args:
         target_time: Future datetime to predict
@@ -281,26 +529,73 @@ def forecast_all_bins(target_time: datetime, threshold_pct: float = 80.0) -> Dic
         Dictionary with predictions for all bins
     """
     try:
-        # Get all bins
+        # Current state of every bin
         with db.get_cursor() as cur:
-            cur.execute("SELECT bin_id FROM bins ORDER BY bin_id")
+            cur.execute("""
+                SELECT b.bin_id, b.lat, b.lon, b.last_seen, b.device_status,
+                       t.fill_pct as current_fill, t.ts as current_ts
+                FROM bins b
+                LEFT JOIN LATERAL (
+                    SELECT fill_pct, ts
+                    FROM telemetry
+                    WHERE bin_id = b.bin_id
+                    ORDER BY ts DESC
+                    LIMIT 1
+                ) t ON true
+                ORDER BY b.bin_id
+            """)
             all_bins = cur.fetchall()
         
+        reporting = [b for b in all_bins if b['current_fill'] is not None]
+        # Bins already at threshold need no fill rate at all
+        rates = {b['bin_id']: _get_cached_ewma(b['bin_id'])
+                 for b in reporting if b['current_fill'] < threshold_pct}
+        
+        # Then the persisted rolling EWMA state
+        if not USE_CSV_DATA and any(rate is None for rate in rates.values()):
+            states = db.get_fill_rate_state()
+            for bin_id, rate in rates.items():
+                if rate is None:
+                    rates[bin_id] = _rate_from_state(states.get(bin_id))
+        
+        # History is only fetched when some bin has neither
+        history_by_bin = {}
+        if any(rate is None for rate in rates.values()):
+            history_by_bin = get_all_historical_data(MAX_HISTORY_DAYS)
+        
         predictions = []
         bins_needing_collection = 0
+        seeds = []
         
-        for bin_row in all_bins:
-            bin_id = bin_row['bin_id']
-            prediction = predict_fill_at_time(bin_id, target_time)
+        for bin_data in reporting:
+            bin_id = bin_data['bin_id']
+            try:
+                if bin_id not in rates:
+                    prediction = _full_bin_prediction(bin_data, target_time)
+                else:
+                    if rates[bin_id] is not None:
+                        fill_rate, confidence = rates[bin_id]
+                    else:
+                        history = history_by_bin.get(bin_id, [])
+                        fill_rate, confidence = _ewma_rate(bin_id, history)
+                        _store_ewma(bin_id, fill_rate, confidence)
+                        seed = _state_row(bin_id, history, fill_rate)
+                        if seed:
+                            seeds.append(seed)
+                    prediction = _build_prediction(bin_data, fill_rate, confidence, target_time)
+            except Exception as e:
+                logger.error(f"Error predicting fill for {bin_id}: {e}")
+                continue
             
-            if "error" not in prediction:
-                # Update needs_collection based on custom threshold
-                prediction['needs_collection'] = prediction['predicted_fill'] >= threshold_pct
-                
-                if prediction['needs_collection']:
-                    bins_needing_collection += 1
-                
-                predictions.append(prediction)
+            # Update needs_collection based on custom threshold
+            prediction['needs_collection'] = prediction['predicted_fill'] >= threshold_pct
+            
+            if prediction['needs_collection']:
+                bins_needing_collection += 1
+            
+            predictions.append(prediction)
+        
+        _seed_states(seeds)
         
         return {
             "target_time": target_time.isoformat(),
@@ -315,6 +610,95 @@ def forecast_all_bins(target_time: datetime, threshold_pct: float = 80.0) -> Dic
         return {"error": str(e)}
 
 
+_SQL_COLLECTION_CANDIDATES = """
+    WITH candidates AS (
+        SELECT b.bin_id, b.lat, b.lon, b.last_seen, b.device_status,
+               COALESCE(t.fill_pct, s.last_fill) AS current_fill, s.n_samples,
+               -- Rolling rate only counts while the bin reported within the window
+               CASE WHEN s.last_ts >= NOW() - make_interval(days => %(days)s)
+                    THEN s.ewma_rate END AS fill_rate,
+               -- Bins whose state can't stand in for a history replay,
+               -- including state that lags the bin's latest reading
+               (s.bin_id IS NULL
+                    OR (s.n_samples < %(min_points)s
+                        AND s.last_ts >= NOW() - make_interval(days => %(days)s))
+                    OR t.ts > s.last_ts
+               ) AS needs_recompute
+        FROM bins b
+        LEFT JOIN bin_fill_rate_state s ON s.bin_id = b.bin_id
+        -- Latest fill reading: one idx_telemetry_bin_ts probe per bin
+        LEFT JOIN LATERAL (
+            SELECT ts, fill_pct FROM telemetry
+            WHERE bin_id = b.bin_id AND fill_pct IS NOT NULL
+            ORDER BY ts DESC
+            LIMIT 1
+        ) t ON true
+        WHERE b.lat IS NOT NULL AND b.lon IS NOT NULL
+          AND b.device_status IS DISTINCT FROM 'offline'
+          AND (s.bin_id IS NOT NULL OR t.ts IS NOT NULL)
+    )
+    SELECT *
+    FROM candidates
+    WHERE needs_recompute
+       OR GREATEST(LEAST(current_fill + COALESCE(fill_rate, 0) * %(hours)s, 100), current_fill)
+          >= %(threshold)s - 0.05
+"""
+
+
+def _bins_needing_collection_from_state(target_time: datetime,
+                                        threshold_pct: float) -> List[Dict[str, Any]]:
+    """
+    Answer get_bins_needing_collection from the rolling fill-rate state in a
+    single query. Bins whose state can't be used are recomputed from their
+    own history (and their state seeded), the same way forecast_all_bins does.
+    """
+    hours_until_target = (target_time - datetime.utcnow()).total_seconds() / 3600
+    with db.get_cursor() as cur:
+        cur.execute(_SQL_COLLECTION_CANDIDATES, {
+            "days": MAX_HISTORY_DAYS,
+            "min_points": MIN_DATA_POINTS,
+            "hours": hours_until_target,
+            "threshold": threshold_pct,
+        })
+        rows = cur.fetchall()
+    
+    # Bins already at threshold need no fill rate at all
+    recompute = {row['bin_id']: _get_cached_ewma(row['bin_id']) for row in rows
+                 if row['needs_recompute'] and row['current_fill'] < threshold_pct}
+    history_by_bin = {}
+    if any(rate is None for rate in recompute.values()):
+        history_by_bin = get_all_historical_data(
+            MAX_HISTORY_DAYS, [bin_id for bin_id, rate in recompute.items() if rate is None]
+        )
+    
+    bins_to_collect = []
+    seeds = []
+    for row in rows:
+        bin_id = row['bin_id']
+        if row['current_fill'] >= threshold_pct:
+            prediction = _full_bin_prediction(row, target_time)
+        else:
+            if bin_id not in recompute:
+                fill_rate = row['fill_rate']
+                confidence = "low" if fill_rate is None else _confidence(row['n_samples'])
+            elif recompute[bin_id] is not None:
+                fill_rate, confidence = recompute[bin_id]
+            else:
+                history = history_by_bin.get(bin_id, [])
+                fill_rate, confidence = _ewma_rate(bin_id, history)
+                _store_ewma(bin_id, fill_rate, confidence)
+                seed = _state_row(bin_id, history, fill_rate)
+                if seed:
+                    seeds.append(seed)
+            prediction = _build_prediction(row, fill_rate, confidence, target_time)
+        prediction['needs_collection'] = prediction['predicted_fill'] >= threshold_pct
+        if prediction['needs_collection']:
+            bins_to_collect.append(prediction)
+    
+    _seed_states(seeds)
+    return bins_to_collect
+
+
 def get_bins_needing_collection(target_time: datetime, threshold_pct: float = 80.0) -> List[Dict[str, Any]]:
     """
     Get list of bins that will need collection at target time.
@@ -327,6 +711,19 @@ def get_bins_needing_collection(target_time: datetime, threshold_pct: float = 80
     Returns:
         List of bins that need collection with their predicted states
     """
+    # Fast path: one query over the persisted fill-rate state
+    if not USE_CSV_DATA:
+        try:
+            bins_to_collect = _bins_needing_collection_from_state(target_time, threshold_pct)
+        except Exception as e:
+            logger.error(f"Error reading fill rate state: {e}")
+            bins_to_collect = None
+        if bins_to_collect is not None:
+            bins_to_collect.sort(key=lambda x: x['predicted_fill'], reverse=True)
+            logger.info(f"Found {len(bins_to_collect)} bins needing collection at {target_time}")
+            return bins_to_collect
+    
+    # CSV data, or the state query failed: full forecast
     forecast = forecast_all_bins(target_time, threshold_pct)
     
     if "error" in forecast:
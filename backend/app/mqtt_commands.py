@@ -15,34 +15,126 @@ Command Types:
 
 Security: Supports TLS encryption and username/password authentication.
 """
+import itertools
 import json
 import logging
+import socket
 import ssl
 import os
+import threading
+import time
+import uuid
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
+from urllib.parse import urlsplit
 
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
 from . import config
 from . import db
 
 logger = logging.getLogger(__name__)
 
+
+# (epoch second, ISO string) of the last formatted timestamp
+_iso_cache = (0, "")
+
+
+def _now_iso() -> str:
+    """Current UTC time as ISO-8601, formatted at most once per second."""
+    global _iso_cache
+    now = int(time.time())
+    cached = _iso_cache
+    if cached[0] != now:
+        cached = _iso_cache = (now, datetime.utcfromtimestamp(now).isoformat())
+    return cached[1]
+
+
+def _dumps(payload: Dict[str, Any]) -> bytes:
+    """Serialize a command payload to the bytes that go on the wire."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def _loads(data) -> Any:
+    """Parse a JSON payload stored as text (orjson when available)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# Short keys for the compact command schema (MQTT_COMPACT_COMMANDS)
+_COMPACT_KEYS = {
+    "command": "c",
+    "zone_id": "z",
+    "command_id": "id",
+    "collection_hours": "ch",
+    "telemetry_interval_minutes": "ti",
+}
+
+
+def _encode_command(message: Dict[str, Any]) -> bytes:
+    """
+    Encode a {"command", "timestamp", "params", ...} message for publishing.
+    In compact mode keys are shortened, params are flattened into the top
+    level (and dropped when empty) and the timestamp is epoch seconds.
+    The verbose form is what gets logged either way.
+    """
+    if not config.MQTT_COMPACT_COMMANDS:
+        return _dumps(message)
+    compact = {}
+    for key, value in message.items():
+        if key == "params":
+            for param, param_value in (value or {}).items():
+                compact[_COMPACT_KEYS.get(param, param)] = param_value
+        elif key == "timestamp":
+            compact["t"] = int(time.time())
+        else:
+            compact[_COMPACT_KEYS.get(key, key)] = value
+    return _dumps(compact)
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Global MQTT Client for Commands
 # ─────────────────────────────────────────────────────────────────────────────
 command_client = None
+_command_client_lock = threading.Lock()
+
+
+def _on_command_disconnect(client, userdata, rc):
+    """Log unexpected disconnects; the network loop reconnects with backoff."""
+    if rc != 0:
+        logger.warning(f"Command publisher disconnected (rc={rc}), reconnecting")
 
 
 def init_command_client():
     """
     Initialize a separate MQTT client for publishing commands.
     Supports TLS + authentication when MQTT_USE_TLS=true.
+    Safe to call from several threads; only the first call connects.
     """
     global command_client
-    if command_client is None:
-        command_client = mqtt.Client(client_id="cleanroute_command_publisher")
+    with _command_client_lock:
+        if command_client is not None:
+            return
+        # A persistent session resends QoS 1 commands still unacknowledged when
+        # the connection drops, but the broker allows one session per client id:
+        # only use it with a configured id, else a unique id per process
+        if config.MQTT_COMMAND_CLIENT_ID:
+            client = mqtt.Client(client_id=config.MQTT_COMMAND_CLIENT_ID, clean_session=False)
+        else:
+            client = mqtt.Client(
+                client_id=f"cleanroute_command_publisher_{socket.gethostname()}_{os.getpid()}",
+                clean_session=True
+            )
+        client.enable_logger(logger)
+        # Fan-out batches publish back-to-back; keep their PUBACKs pipelined
+        client.max_inflight_messages_set(config.MQTT_MAX_INFLIGHT)
         
         # Determine connection mode
         if config.MQTT_USE_TLS:
@@ -58,13 +150,13 @@ def init_command_client():
                 logger.error(f"CA certificate not found: {ca_cert_path}")
                 raise FileNotFoundError(f"CA certificate not found: {ca_cert_path}")
             
-            command_client.tls_set(
+            client.tls_set(
                 ca_certs=ca_cert_path,
                 tls_version=ssl.PROTOCOL_TLSv1_2
             )
             
             # Set username/password authentication
-            command_client.username_pw_set(
+            client.username_pw_set(
                 config.MQTT_USERNAME,
                 config.MQTT_PASSWORD
             )
@@ -74,33 +166,75 @@ def init_command_client():
             port = config.MQTT_PORT
             logger.info("WARNING: Command client running in insecure mode")
         
+        # The loop thread keeps reconnecting (1s..30s backoff) after a drop or
+        # a failed first connect; publishes queue up meanwhile
+        client.reconnect_delay_set(min_delay=1, max_delay=30)
+        client.max_queued_messages_set(config.MQTT_MAX_QUEUED)
+        client.on_disconnect = _on_command_disconnect
+        
         try:
-            command_client.connect(config.MQTT_BROKER, port, keepalive=60)
-            command_client.loop_start()
+            client.connect_async(config.MQTT_BROKER, port, keepalive=60)
+            client.loop_start()
             logger.info(f"Command publisher initialized on {config.MQTT_BROKER}:{port}")
         except Exception as e:
             logger.error(f"Failed to initialize command client: {e}")
             raise
+        command_client = client
 
 
 def stop_command_client():
     """Stop the command client."""
     global command_client
-    if command_client:
-        command_client.loop_stop()
-        command_client.disconnect()
-        logger.info("Command publisher stopped")
+    with _command_client_lock:
+        if command_client:
+            command_client.loop_stop()
+            command_client.disconnect()
+            command_client = None
+            logger.info("Command publisher stopped")
 
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Command Functions
 # ─────────────────────────────────────────────────────────────────────────────
 
+# Default QoS per command type. Status/heartbeat requests only matter to
+# devices that are online right now and are simply re-requested, so they go
+# fire-and-forget. wake_up stays at QoS 1: the broker only queues QoS>0
+# messages for sleeping devices' persistent sessions. Unlisted types use 1.
+_COMMAND_QOS = {
+    "get_status": 0,
+    "heartbeat": 0,
+    "sleep": 0,
+    "wake_up": 1,
+    "update_config": 1,
+    "firmware_update": 1,
+    "shadow_delta": 1,
+    "diagnostic": 1,
+}
+
+
+# bin_id -> command topic; the fleet is finite, so fan-outs stop rebuilding them
+_command_topics = {}
+
+
+def _command_topic(bin_id: str) -> str:
+    """Command topic for a bin."""
+    topic = _command_topics.get(bin_id)
+    if topic is None:
+        topic = _command_topics[bin_id] = f"cleanroute/bins/{bin_id}/command"
+    return topic
+
+
+def command_qos(command_type: str) -> int:
+    """Default MQTT QoS for a command type."""
+    return _COMMAND_QOS.get(command_type, 1)
+
+
 def send_command(
     bin_id: str,
     command_type: str,
     payload: Optional[Dict[str, Any]] = None,
-    qos: int = 1,
+    qos: Optional[int] = None,
     retain: bool = False
 ) -> bool:
     """
@@ -110,7 +244,7 @@ def send_command(
         bin_id: Target bin ID or "broadcast" for all bins
         command_type: Type of command (wake_up, sleep, etc.)
         payload: Additional command parameters
-        qos: MQTT QoS level (0, 1, or 2)
+        qos: MQTT QoS level (0, 1, or 2); defaults to command_qos(command_type)
         retain: Whether to retain the message
     
     Returns:
@@ -118,25 +252,27 @@ def send_command(
     """
     if command_client is None:
         init_command_client()
+    if qos is None:
+        qos = command_qos(command_type)
     
-    topic = f"cleanroute/bins/{bin_id}/command"
+    topic = _command_topic(bin_id)
     
     command_payload = {
         "command": command_type,
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": _now_iso(),
         "params": payload or {}
     }
     
     try:
         result = command_client.publish(
             topic,
-            json.dumps(command_payload),
+            _encode_command(command_payload),
             qos=qos,
             retain=retain
         )
         
-        # Log command
-        db.log_command(bin_id, command_type, command_payload)
+        # Log command (written behind by the ingest writer, off the publish path)
+        db.enqueue_command_log(bin_id, command_type, command_payload)
         
         logger.info(f"Sent {command_type} to {bin_id} (QoS={qos})")
         return result.rc == mqtt.MQTT_ERR_SUCCESS
@@ -146,6 +282,70 @@ def send_command(
         return False
 
 
+def _confirm_publish(info, qos: int, deadline: float) -> bool:
+    """
+    Wait (until the monotonic deadline) for a publish to be acknowledged.
+    QoS 0 publishes count as delivered once accepted by the client.
+    """
+    if info.rc != mqtt.MQTT_ERR_SUCCESS:
+        return False
+    if qos == 0:
+        return True
+    try:
+        info.wait_for_publish(timeout=max(deadline - time.monotonic(), 0))
+    except (ValueError, RuntimeError) as e:
+        logger.error(f"Publish failed: {e}")
+    return info.is_published()
+
+
+def send_commands(commands: List[tuple], qos: Optional[int] = None) -> List[bool]:
+    """
+    Send many (bin_id, command_type, payload) commands at once.
+    All publishes go out back-to-back and the QoS 1 acknowledgments are
+    awaited together, instead of one publish per send_command call.
+    
+    Args:
+        commands: (bin_id, command_type, payload) tuples
+        qos: QoS for every command; defaults to command_qos() per type
+    
+    Returns:
+        Whether each command was delivered, in the order given
+    """
+    if command_client is None:
+        init_command_client()
+    
+    timestamp = _now_iso()
+    results = [False] * len(commands)
+    sent = []
+    # Fan-outs usually repeat one payload object; serialize it once
+    encoded = {}
+    for index, (bin_id, command_type, payload) in enumerate(commands):
+        command_payload = {
+            "command": command_type,
+            "timestamp": timestamp,
+            "params": payload or {}
+        }
+        key = (command_type, id(payload))
+        if key not in encoded:
+            encoded[key] = _encode_command(command_payload)
+        message_qos = command_qos(command_type) if qos is None else qos
+        try:
+            info = command_client.publish(_command_topic(bin_id), encoded[key], qos=message_qos)
+        except Exception as e:
+            logger.error(f"Failed to send command to {bin_id}: {e}")
+            continue
+        sent.append((index, bin_id, command_type, command_payload, message_qos, info))
+    
+    # All publishes are in flight; one barrier with a shared deadline
+    deadline = time.monotonic() + config.MQTT_PUBLISH_TIMEOUT
+    for index, bin_id, command_type, command_payload, message_qos, info in sent:
+        results[index] = _confirm_publish(info, message_qos, deadline)
+        db.enqueue_command_log(bin_id, command_type, command_payload)
+    
+    logger.info(f"Sent {len(sent)} commands ({sum(results)} delivered)")
+    return results
+
+
 def wake_up_bin(bin_id: str, collection_hours: int = 12) -> bool:
     """
     Send wake-up command to bin.
@@ -157,35 +357,52 @@ def wake_up_bin(bin_id: str, collection_hours: int = 12) -> bool:
     }
     
     # Update database
-    with db.get_cursor(commit=True) as cur:
-        cur.execute(
-            "UPDATE bins SET last_wake_command = NOW(), sleep_mode = FALSE WHERE bin_id = %s",
-            (bin_id,)
-        )
+    db.set_zone_sleep_mode([bin_id], False)
     
-    return send_command(bin_id, "wake_up", payload, qos=1)
+    return send_command(bin_id, "wake_up", payload)
+
+
+def wake_up_bins_bulk(bin_ids: List[str], collection_hours: int = 12) -> Dict[str, bool]:
+    """
+    Wake several bins: one bins UPDATE for all of them, then their wake-up
+    commands as one pipelined batch. Returns bin_id -> delivered.
+    """
+    if not bin_ids:
+        return {}
+    payload = {
+        "collection_hours": collection_hours,
+        "telemetry_interval_minutes": 60
+    }
+    db.set_zone_sleep_mode(bin_ids, False)
+    sent = send_commands([(bin_id, "wake_up", payload) for bin_id in bin_ids])
+    return dict(zip(bin_ids, sent))
 
 
 def sleep_bin(bin_id: str) -> bool:
     """Send sleep command to bin. Device enters low-power mode."""
-    with db.get_cursor(commit=True) as cur:
-        cur.execute(
-            "UPDATE bins SET sleep_mode = TRUE WHERE bin_id = %s",
-            (bin_id,)
-        )
+    db.set_zone_sleep_mode([bin_id], True)
     
-    return send_command(bin_id, "sleep", qos=1)
+    return send_command(bin_id, "sleep")
+
+
+def sleep_bins_bulk(bin_ids: List[str]) -> Dict[str, bool]:
+    """Put several bins to sleep with one UPDATE and one command batch."""
+    if not bin_ids:
+        return {}
+    db.set_zone_sleep_mode(bin_ids, True)
+    sent = send_commands([(bin_id, "sleep", None) for bin_id in bin_ids])
+    return dict(zip(bin_ids, sent))
 
 
 def reset_emptied_flag(bin_id: str) -> bool:
     """Reset the emptied flag on the device."""
     payload = {"emptied": False}
-    return send_command(bin_id, "reset_emptied", payload, qos=1)
+    return send_command(bin_id, "reset_emptied", payload)
 
 
 def request_status(bin_id: str) -> bool:
     """Request immediate status update from device."""
-    return send_command(bin_id, "get_status", qos=1)
+    return send_command(bin_id, "get_status")
 
 
 def update_device_config(
@@ -200,7 +417,7 @@ def update_device_config(
     if battery_threshold:
         payload["battery_threshold_v"] = battery_threshold
     
-    return send_command(bin_id, "update_config", payload, qos=1)
+    return send_command(bin_id, "update_config", payload)
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -221,7 +438,7 @@ def broadcast_wake_up(collection_hours: int = 12) -> bool:
         )
     
     logger.info(f"Broadcasting wake_up to all bins")
-    return send_command("broadcast", "wake_up", payload, qos=1)
+    return send_command("broadcast", "wake_up", payload)
 
 
 def broadcast_sleep() -> bool:
@@ -230,7 +447,7 @@ def broadcast_sleep() -> bool:
         cur.execute("UPDATE bins SET sleep_mode = TRUE")
     
     logger.info(f"Broadcasting sleep to all bins")
-    return send_command("broadcast", "sleep", qos=1)
+    return send_command("broadcast", "sleep")
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -268,7 +485,7 @@ def start_collection_day(collection_hours: int = 12) -> Dict[str, Any]:
         "success": success,
         "bins_notified": len(bins),
         "collection_hours": collection_hours,
-        "started_at": datetime.utcnow().isoformat()
+        "started_at": _now_iso()
     }
 
 
@@ -282,7 +499,7 @@ def end_collection_day() -> Dict[str, Any]:
     
     return {
         "success": success,
-        "ended_at": datetime.utcnow().isoformat()
+        "ended_at": _now_iso()
     }
 
 
@@ -290,6 +507,46 @@ def end_collection_day() -> Dict[str, Any]:
 # Zone-Specific Commands
 # ─────────────────────────────────────────────────────────────────────────────
 
+# Zone to bin_id prefix mapping
+ZONE_PREFIX_MAP = {
+    # Colombo zones
+    "colombo_zone1": ["COL1"],
+    "colombo_zone2": ["COL2"],
+    "colombo_zone3": ["COL3"],
+    "colombo_zone4": ["COL4"],
+    # Legacy/other Colombo bins
+    "colombo": ["COL", "B0"],
+    # Other districts
+    "kurunegala_zone1": ["KUR1"],
+    "kurunegala_zone2": ["KUR2"],
+    "kurunegala_zone3": ["KUR3"],
+    "galle_zone1": ["GAL1"],
+    "galle_zone2": ["GAL2"],
+    "kandy_zone1": ["KAN1"],
+    "kandy_zone2": ["KAN2"],
+    "matara_zone1": ["MAT1"],
+}
+
+
+# LIKE patterns per zone, built once: "bin_id LIKE ANY(patterns)"
+ZONE_PATTERNS = {
+    zone_id: [f"{prefix}%" for prefix in prefixes]
+    for zone_id, prefixes in ZONE_PREFIX_MAP.items()
+}
+
+# zone_id -> (monotonic expiry, bin_ids); zone workflows look the same zone
+# up several times (wake, status, sleep) within a collection day
+_zone_bins_cache = {}
+
+
+def get_zone_prefixes(zone_id: str) -> list:
+    """Get the bin_id prefixes for a zone (empty if the zone is unknown)."""
+    prefixes = ZONE_PREFIX_MAP.get(zone_id, [])
+    if not prefixes:
+        logger.warning(f"No prefix mapping found for zone: {zone_id}")
+    return prefixes
+
+
 def get_bins_in_zone(zone_id: str) -> list:
     """
     Get all bins within a specific zone based on their bin_id prefix.
@@ -300,41 +557,59 @@ def get_bins_in_zone(zone_id: str) -> list:
     - colombo_zone3: COL3xx (Wellawatta/Dehiwala)
     - colombo_zone4: COL4xx (Nugegoda/Kotte)
     """
-    # Map zone IDs to bin prefixes
-    zone_prefix_map = {
-        # Colombo zones
-        "colombo_zone1": ["COL1"],
-        "colombo_zone2": ["COL2"],
-        "colombo_zone3": ["COL3"],
-        "colombo_zone4": ["COL4"],
-        # Legacy/other Colombo bins
-        "colombo": ["COL", "B0"],
-        # Other districts
-        "kurunegala_zone1": ["KUR1"],
-        "kurunegala_zone2": ["KUR2"],
-        "kurunegala_zone3": ["KUR3"],
-        "galle_zone1": ["GAL1"],
-        "galle_zone2": ["GAL2"],
-        "kandy_zone1": ["KAN1"],
-        "kandy_zone2": ["KAN2"],
-        "matara_zone1": ["MAT1"],
-    }
+    cached = _zone_bins_cache.get(zone_id)
+    if cached is not None and time.monotonic() < cached[0]:
+        return list(cached[1])
     
-    prefixes = zone_prefix_map.get(zone_id, [])
-    if not prefixes:
+    patterns = ZONE_PATTERNS.get(zone_id)
+    if not patterns:
         logger.warning(f"No prefix mapping found for zone: {zone_id}")
         return []
     
-    bins = []
-    with db.get_cursor() as cur:
-        # Build query to match any of the prefixes
-        conditions = " OR ".join([f"bin_id LIKE %s" for _ in prefixes])
-        params = [f"{prefix}%" for prefix in prefixes]
-        
-        cur.execute(f"SELECT bin_id FROM bins WHERE {conditions}", params)
-        bins = [row['bin_id'] for row in cur.fetchall()]
+    with db.get_cursor(cursor_factory=None) as cur:
+        cur.execute("SELECT bin_id FROM bins WHERE bin_id LIKE ANY(%s)", (patterns,))
+        bins = [row[0] for row in cur.fetchall()]
     
-    return bins
+    if config.ZONE_BINS_CACHE_TTL > 0:
+        _zone_bins_cache[zone_id] = (time.monotonic() + config.ZONE_BINS_CACHE_TTL, bins)
+    return list(bins)
+
+
+def clear_zone_bins_cache():
+    """Drop cached get_bins_in_zone results (e.g. after bins are removed)."""
+    _zone_bins_cache.clear()
+
+
+def _broadcast_zone_command(zone_id: str, bins: List[str], command_type: str,
+                            params: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Publish one command to the zone topic every bin in the zone subscribes to,
+    and log it against each bin. Returns True once the broker has the message
+    (acknowledged for QoS 1, within MQTT_PUBLISH_TIMEOUT).
+    """
+    if command_client is None:
+        init_command_client()
+    
+    zone_topic = f"cleanroute/zones/{zone_id}/command"
+    payload = {
+        "command": command_type,
+        "zone_id": zone_id,
+        "timestamp": _now_iso(),
+        "params": params or {}
+    }
+    
+    qos = command_qos(command_type)
+    try:
+        info = command_client.publish(zone_topic, _encode_command(payload), qos=qos)
+    except Exception as e:
+        logger.error(f"Zone broadcast failed: {e}")
+        return False
+    
+    for bin_id in bins:
+        db.enqueue_command_log(bin_id, command_type, payload)
+    
+    logger.info(f"Broadcast {command_type} to zone {zone_id} ({len(bins)} bins)")
+    return _confirm_publish(info, qos, time.monotonic() + config.MQTT_PUBLISH_TIMEOUT)
 
 
 def wake_up_zone(zone_id: str, zone_name: str = None) -> Dict[str, Any]:
@@ -360,45 +635,25 @@ def wake_up_zone(zone_id: str, zone_name: str = None) -> Dict[str, Any]:
             "bins_count": 0
         }
     
-    # Send wake-up command to each bin in the zone
-    success_count = 0
-    failed_bins = []
-    
-    for bin_id in bins:
-        try:
-            if wake_up_bin(bin_id, collection_hours=12):
-                success_count += 1
-            else:
-                failed_bins.append(bin_id)
-        except Exception as e:
-            logger.error(f"Failed to wake up {bin_id}: {e}")
-            failed_bins.append(bin_id)
-    
-    # Also send a zone broadcast for any bins we might have missed
-    zone_topic = f"cleanroute/zones/{zone_id}/command"
-    payload = {
-        "command": "wake_up",
-        "zone_id": zone_id,
-        "timestamp": datetime.utcnow().isoformat(),
-        "params": {"collection_hours": 12}
-    }
-    
+    # One bins UPDATE and one zone broadcast instead of a round trip per bin
     try:
-        if command_client is None:
-            init_command_client()
-        command_client.publish(zone_topic, json.dumps(payload), qos=1)
-        logger.info(f"Broadcast wake_up to zone {zone_id}")
+        db.set_zone_sleep_mode(bins, False)
     except Exception as e:
-        logger.error(f"Zone broadcast failed: {e}")
+        logger.error(f"Failed to mark zone {zone_id} awake: {e}")
+    
+    sent = _broadcast_zone_command(zone_id, bins, "wake_up", {
+        "collection_hours": 12,
+        "telemetry_interval_minutes": 60
+    })
     
     return {
-        "success": success_count > 0,
+        "success": sent,
         "zone_id": zone_id,
         "zone_name": zone_name,
-        "bins_awakened": success_count,
-        "bins_failed": failed_bins,
+        "bins_awakened": len(bins) if sent else 0,
+        "bins_failed": [] if sent else bins,
         "total_bins": len(bins),
-        "started_at": datetime.utcnow().isoformat()
+        "started_at": _now_iso()
     }
 
 
@@ -424,44 +679,22 @@ def sleep_zone(zone_id: str, zone_name: str = None) -> Dict[str, Any]:
             "bins_count": 0
         }
     
-    # Send sleep command to each bin
-    success_count = 0
-    failed_bins = []
-    
-    for bin_id in bins:
-        try:
-            if sleep_bin(bin_id):
-                success_count += 1
-            else:
-                failed_bins.append(bin_id)
-        except Exception as e:
-            logger.error(f"Failed to sleep {bin_id}: {e}")
-            failed_bins.append(bin_id)
-    
-    # Zone broadcast
-    zone_topic = f"cleanroute/zones/{zone_id}/command"
-    payload = {
-        "command": "sleep",
-        "zone_id": zone_id,
-        "timestamp": datetime.utcnow().isoformat()
-    }
-    
+    # One bins UPDATE and one zone broadcast instead of a round trip per bin
     try:
-        if command_client is None:
-            init_command_client()
-        command_client.publish(zone_topic, json.dumps(payload), qos=1)
-        logger.info(f"Broadcast sleep to zone {zone_id}")
+        db.set_zone_sleep_mode(bins, True)
     except Exception as e:
-        logger.error(f"Zone broadcast failed: {e}")
+        logger.error(f"Failed to mark zone {zone_id} asleep: {e}")
+    
+    sent = _broadcast_zone_command(zone_id, bins, "sleep")
     
     return {
-        "success": success_count > 0,
+        "success": sent,
         "zone_id": zone_id,
         "zone_name": zone_name,
-        "bins_asleep": success_count,
-        "bins_failed": failed_bins,
+        "bins_asleep": len(bins) if sent else 0,
+        "bins_failed": [] if sent else bins,
         "total_bins": len(bins),
-        "ended_at": datetime.utcnow().isoformat()
+        "ended_at": _now_iso()
     }
 
 
@@ -484,37 +717,16 @@ def request_zone_status(zone_id: str, zone_name: str = None) -> Dict[str, Any]:
             "bins_count": 0
         }
     
-    # Request status from each bin
-    success_count = 0
-    for bin_id in bins:
-        try:
-            if request_status(bin_id):
-                success_count += 1
-        except Exception as e:
-            logger.error(f"Failed to request status from {bin_id}: {e}")
-    
-    # Zone broadcast
-    zone_topic = f"cleanroute/zones/{zone_id}/command"
-    payload = {
-        "command": "get_status",
-        "zone_id": zone_id,
-        "timestamp": datetime.utcnow().isoformat()
-    }
-    
-    try:
-        if command_client is None:
-            init_command_client()
-        command_client.publish(zone_topic, json.dumps(payload), qos=1)
-    except Exception as e:
-        logger.error(f"Zone broadcast failed: {e}")
+    # One zone broadcast reaches every bin; no per-bin publishes
+    sent = _broadcast_zone_command(zone_id, bins, "get_status")
     
     return {
-        "success": success_count > 0,
+        "success": sent,
         "zone_id": zone_id,
         "zone_name": zone_name,
-        "bins_requested": success_count,
+        "bins_requested": len(bins) if sent else 0,
         "total_bins": len(bins),
-        "requested_at": datetime.utcnow().isoformat()
+        "requested_at": _now_iso()
     }
 
 
@@ -522,6 +734,17 @@ def request_zone_status(zone_id: str, zone_name: str = None) -> Dict[str, Any]:
 # IoT Enhanced Commands
 # ─────────────────────────────────────────────────────────────────────────────
 
+# Ack-tracked command ids: a random per-process prefix plus a counter is
+# unique across restarts without drawing a UUID per command
+_COMMAND_ID_PREFIX = uuid.uuid4().hex[:8]
+_command_seq = itertools.count(1)
+
+
+def _next_command_id() -> str:
+    """Return a new unique command_id for acknowledgment tracking."""
+    return f"{_COMMAND_ID_PREFIX}{next(_command_seq):08x}"
+
+
 def send_command_with_ack(
     bin_id: str,
     command_type: str,
@@ -532,9 +755,7 @@ def send_command_with_ack(
     Send a command that expects acknowledgment from the device.
     Creates a pending command record for tracking.
     """
-    import uuid
-    
-    command_id = str(uuid.uuid4())[:8]
+    command_id = _next_command_id()
     
     # Create pending command record
     db.create_pending_command(command_id, bin_id, command_type, payload)
@@ -551,13 +772,13 @@ def send_command_with_ack(
         "command_type": command_type,
         "sent": success,
         "awaiting_ack": success,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _now_iso()
     }
 
 
 def request_heartbeat(bin_id: str) -> bool:
     """Request a heartbeat from a device."""
-    return send_command(bin_id, "heartbeat", qos=1)
+    return send_command(bin_id, "heartbeat")
 
 
 def request_diagnostic(bin_id: str, diagnostic_type: str = "full") -> Dict[str, Any]:
@@ -586,14 +807,14 @@ def request_diagnostic(bin_id: str, diagnostic_type: str = "full") -> Dict[str,
         } if diagnostic_type == "full" else {diagnostic_type: True}
     }
     
-    success = send_command(bin_id, "diagnostic", payload, qos=1)
+    success = send_command(bin_id, "diagnostic", payload)
     
     return {
         "diagnostic_id": diag_id,
         "bin_id": bin_id,
         "diagnostic_type": diagnostic_type,
         "requested": success,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _now_iso()
     }
 
 
@@ -614,6 +835,14 @@ def send_firmware_update(
         checksum: SHA256 checksum of firmware file
         file_size_kb: File size in KB
     """
+    job = _prepare_firmware_update(bin_id, version, file_url, checksum, file_size_kb)
+    success = send_command(bin_id, "firmware_update", job["payload"])
+    return _firmware_update_result(bin_id, version, job, success)
+
+
+def _prepare_firmware_update(bin_id: str, version: str, file_url: str,
+                             checksum: str, file_size_kb: int) -> Dict[str, Any]:
+    """Record a firmware update job and build the command payload for it."""
     # Get current firmware version from shadow
     shadow = db.get_device_shadow(bin_id)
     current_version = None
@@ -623,24 +852,51 @@ def send_firmware_update(
     # Create update record
     update_id = db.create_firmware_update(bin_id, version, current_version)
     
+    return _firmware_update_job(update_id, current_version, version, file_url, checksum, file_size_kb)
+
+
+def cdn_rewrite(file_url: str) -> Optional[str]:
+    """Point a firmware URL at FIRMWARE_CDN_URL, keeping its path and query."""
+    if not config.FIRMWARE_CDN_URL or not file_url:
+        return None
+    parts = urlsplit(file_url)
+    return config.FIRMWARE_CDN_URL + parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+def _firmware_update_job(update_id: int, current_version: Optional[str], version: str,
+                         file_url: str, checksum: str, file_size_kb: int,
+                         stagger_s: int = 0) -> Dict[str, Any]:
+    """Firmware update job record plus the command payload sent to the device."""
     payload = {
         "update_id": update_id,
         "version": version,
         "url": file_url,
         "checksum": checksum,
         "size_kb": file_size_kb,
+        "download_chunk_kb": config.FIRMWARE_DOWNLOAD_CHUNK_KB,
+        "download_stagger_s": stagger_s,
         "action": "download_and_install"
     }
-    
-    success = send_command(bin_id, "firmware_update", payload, qos=1)
-    
+    cdn_url = cdn_rewrite(file_url)
+    if cdn_url:
+        payload["cdn_url"] = cdn_url
     return {
         "update_id": update_id,
+        "current_version": current_version,
+        "payload": payload
+    }
+
+
+def _firmware_update_result(bin_id: str, version: str, job: Dict[str, Any],
+                            success: bool) -> Dict[str, Any]:
+    """Per-device result returned by the firmware update senders."""
+    return {
+        "update_id": job["update_id"],
         "bin_id": bin_id,
         "target_version": version,
-        "current_version": current_version,
+        "current_version": job["current_version"],
         "initiated": success,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _now_iso()
     }
 
 
@@ -649,10 +905,14 @@ def send_bulk_firmware_update(
     version: str,
     file_url: str,
     checksum: str,
-    file_size_kb: int
+    file_size_kb: int,
+    window_seconds: Optional[int] = None
 ) -> Dict[str, Any]:
     """
     Send firmware update to all devices in a zone.
+    
+    Device downloads are staggered evenly across window_seconds
+    (default FIRMWARE_DOWNLOAD_WINDOW) so the zone doesn't hit the origin at once.
     """
     bins = get_bins_in_zone(zone_id)
     
@@ -663,10 +923,21 @@ def send_bulk_firmware_update(
             "zone_id": zone_id
         }
     
-    results = []
-    for bin_id in bins:
-        result = send_firmware_update(bin_id, version, file_url, checksum, file_size_kb)
-        results.append(result)
+    # All jobs (and the devices' current versions) in one round trip
+    created = db.create_firmware_updates_bulk(bins, version)
+    if window_seconds is None:
+        window_seconds = config.FIRMWARE_DOWNLOAD_WINDOW
+    jobs = {
+        bin_id: _firmware_update_job(row["id"], row["current_version"],
+                                     version, file_url, checksum, file_size_kb,
+                                     stagger_s=int(i * window_seconds / len(created)))
+        for i, (bin_id, row) in enumerate(created.items())
+    }
+    sent = send_commands([(bin_id, "firmware_update", job["payload"]) for bin_id, job in jobs.items()])
+    results = [
+        _firmware_update_result(bin_id, version, job, success)
+        for (bin_id, job), success in zip(jobs.items(), sent)
+    ]
     
     successful = sum(1 for r in results if r.get('initiated'))
     
@@ -678,7 +949,7 @@ def send_bulk_firmware_update(
         "devices_initiated": successful,
         "devices_failed": len(bins) - successful,
         "results": results,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _now_iso()
     }
 
 
@@ -694,13 +965,13 @@ def update_device_shadow_desired(bin_id: str, desired_state: Dict[str, Any]) ->
         "desired": desired_state
     }
     
-    success = send_command(bin_id, "shadow_delta", payload, qos=1)
+    success = send_command(bin_id, "shadow_delta", payload)
     
     return {
         "bin_id": bin_id,
         "desired_state": desired_state,
         "notified": success,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _now_iso()
     }
 
 
@@ -709,34 +980,38 @@ def retry_pending_commands(max_age_seconds: int = 60) -> Dict[str, Any]:
     Retry commands that haven't been acknowledged.
     Should be called periodically (e.g., every 30 seconds).
     """
-    pending = db.get_pending_commands(older_than_seconds=max_age_seconds)
-    
-    retried = 0
-    failed = 0
-    
-    for cmd in pending:
-        if cmd['retry_count'] >= cmd['max_retries']:
-            db.mark_command_failed(cmd['command_id'], "Max retries exceeded")
-            failed += 1
+    # Claim due commands: the attempt is counted and sent_at stamped, and that
+    # commits before publishing, so no row lock is held across the broker round trip.
+    # Claimed rows aren't due again for max_age_seconds, so other workers skip them.
+    with db.claim_pending_commands(older_than_seconds=max_age_seconds) as (cur, pending):
+        to_fail = [cmd for cmd in pending if cmd['retry_count'] >= cmd['max_retries']]
+        to_retry = [cmd for cmd in pending if cmd['retry_count'] < cmd['max_retries']]
+        
+        for cmd in to_fail:
             logger.warning(f"Command {cmd['command_id']} to {cmd['bin_id']} failed after {cmd['retry_count']} retries")
-        else:
-            # Retry the command
-            payload = cmd.get('payload', {})
-            if isinstance(payload, str):
-                import json
-                payload = json.loads(payload)
-            
-            success = send_command(cmd['bin_id'], cmd['command_type'], payload, qos=1)
-            if success:
-                db.increment_command_retry(cmd['command_id'])
-                retried += 1
-                logger.info(f"Retried command {cmd['command_id']} to {cmd['bin_id']} (attempt {cmd['retry_count'] + 1})")
+        db.mark_commands_failed([cmd['command_id'] for cmd in to_fail], "Max retries exceeded", cur=cur)
+        db.increment_command_retries([cmd['command_id'] for cmd in to_retry], cur=cur)
+    
+    # Resend every claimed command as one pipelined batch
+    commands = []
+    for cmd in to_retry:
+        payload = cmd.get('payload') or {}
+        if isinstance(payload, str):
+            payload = _loads(payload)
+        commands.append((cmd['bin_id'], cmd['command_type'], payload))
+    sent = send_commands(commands, qos=1)
+    
+    resent = [cmd for cmd, success in zip(to_retry, sent) if success]
+    # A failed publish isn't a delivery attempt; hand it back for the next run
+    db.release_command_claims([cmd['command_id'] for cmd, success in zip(to_retry, sent) if not success])
+    for cmd in resent:
+        logger.info(f"Retried command {cmd['command_id']} to {cmd['bin_id']} (attempt {cmd['retry_count'] + 1})")
     
     return {
         "pending_checked": len(pending),
-        "retried": retried,
-        "failed": failed,
-        "timestamp": datetime.utcnow().isoformat()
+        "retried": len(resent),
+        "failed": len(to_fail),
+        "timestamp": _now_iso()
     }
 
 
@@ -745,24 +1020,14 @@ def check_device_heartbeats(timeout_minutes: int = 5) -> Dict[str, Any]:
     Check for devices that haven't sent heartbeats and mark them offline.
     Should be called periodically.
     """
-    from . import db
-    
-    stale_devices = db.get_devices_needing_heartbeat(timeout_minutes)
-    
-    marked_offline = 0
-    for device in stale_devices:
-        # Mark as offline
-        with db.get_cursor(commit=True) as cur:
-            cur.execute(
-                "UPDATE bins SET device_status = 'offline' WHERE bin_id = %s",
-                (device['bin_id'],)
-            )
-        marked_offline += 1
-        logger.warning(f"Device {device['bin_id']} marked offline (no heartbeat for {timeout_minutes} min)")
+    # Find and mark stale devices in one UPDATE ... RETURNING
+    marked = db.mark_stale_devices_offline(timeout_minutes)
+    for bin_id in marked:
+        logger.warning(f"Device {bin_id} marked offline (no heartbeat for {timeout_minutes} min)")
     
     return {
-        "devices_checked": len(stale_devices),
-        "marked_offline": marked_offline,
+        "devices_checked": len(marked),
+        "marked_offline": len(marked),
         "timeout_minutes": timeout_minutes,
-        "timestamp": datetime.utcnow().isoformat()
+        "timestamp": _now_iso()
     }
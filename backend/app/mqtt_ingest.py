@@ -21,13 +21,21 @@ Set MQTT_USE_TLS=true to enable secure connection on port 8883.
 import json
 import logging
 import threading
+import socket
 import ssl
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dateutil import parser as date_parser
 
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # optional: falls back to the stdlib parser
+    _loads = json.loads
+
 from . import config
 from . import db
 
@@ -43,6 +51,18 @@ logger = logging.getLogger(__name__)
 mqtt_client = None
 mqtt_connected = False
 message_count = 0
+# Handlers run on several ingest workers, so the counter update must be atomic
+_message_count_lock = threading.Lock()
+# Single-threaded executors, one per ingest worker (see MQTT_INGEST_WORKERS)
+_workers = []
+
+
+def _count_message() -> int:
+    """Count one processed message and return the new total."""
+    global message_count
+    with _message_count_lock:
+        message_count += 1
+        return message_count
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -91,8 +111,6 @@ def on_message(client, userdata, msg):
     Called when a message is received from subscribed topic.
     Routes messages to appropriate handlers based on topic.
     """
-    global message_count
-    
     try:
         # Parse topic to determine message type
         # Topic formats:
@@ -105,42 +123,35 @@ def on_message(client, userdata, msg):
         # - bins/<BIN_ID>/telemetry (ESP32 format)
         # - bins/<BIN_ID>/heartbeat (ESP32 format)
         
-        topic_parts = msg.topic.split("/")
-        
         # Handle both topic formats:
-        # - cleanroute/bins/<BIN_ID>/<type> (4+ parts, bin_id at index 2)
-        # - bins/<BIN_ID>/<type> (3 parts, bin_id at index 1)
-        if len(topic_parts) >= 4 and topic_parts[0] == "cleanroute":
-            # Original format: cleanroute/bins/<BIN_ID>/<type>
+        # - cleanroute/bins/<BIN_ID>/<type> (bin_id at index 2, type may contain "/")
+        # - bins/<BIN_ID>/<type> (bin_id at index 1)
+        topic_parts = msg.topic.split("/", 3)
+        if topic_parts[0] == "cleanroute" and len(topic_parts) == 4:
             bin_id = topic_parts[2]
             message_type = topic_parts[3]
-        elif len(topic_parts) >= 3 and topic_parts[0] == "bins":
-            # ESP32 format: bins/<BIN_ID>/<type>
+        elif topic_parts[0] == "bins" and len(topic_parts) >= 3:
             bin_id = topic_parts[1]
             message_type = topic_parts[2]
         else:
             logger.warning(f"Invalid topic format: {msg.topic}")
             return
         
-        # Parse JSON payload
-        payload = json.loads(msg.payload.decode("utf-8"))
+        handler = _HANDLERS.get(message_type)
+        if handler is None:
+            logger.warning(f"Unknown message type: {message_type}")
+            return
+        
+        # Parsed straight from the raw UTF-8 bytes (orjson errors subclass
+        # json.JSONDecodeError, so the handler below catches both)
+        payload = _loads(msg.payload)
         
-        # Route to appropriate handler
-        if message_type == "telemetry":
-            handle_telemetry(bin_id, payload)
-        elif message_type == "heartbeat":
-            handle_heartbeat(bin_id, payload)
-        elif message_type == "ack":
-            handle_command_ack(bin_id, payload)
-        elif message_type == "diagnostic":
-            handle_diagnostic(bin_id, payload)
-        elif message_type == "firmware_status":
-            handle_firmware_status(bin_id, payload)
-        elif message_type == "shadow":
-            if len(topic_parts) >= 5 and topic_parts[4] == "reported":
-                handle_shadow_reported(bin_id, payload)
+        if _workers:
+            # Hand off so database calls never stall the network loop; the same
+            # bin always lands on the same worker, keeping its messages in order
+            _workers[hash(bin_id) % len(_workers)].submit(_dispatch, handler, bin_id, payload)
         else:
-            logger.warning(f"Unknown message type: {message_type}")
+            handler(bin_id, payload)
         
     except json.JSONDecodeError as e:
         logger.error(f"Invalid JSON payload: {msg.payload}")
@@ -148,6 +159,21 @@ def on_message(client, userdata, msg):
         logger.error(f"Error processing message: {e}")
 
 
+def _parse_ts(ts) -> datetime:
+    """
+    Parse a device timestamp. Firmware sends ISO-8601, which the stdlib
+    parses directly; anything else falls back to dateutil.
+    """
+    if isinstance(ts, str):
+        try:
+            if ts.endswith(("Z", "z")):
+                ts = ts[:-1] + "+00:00"
+            return datetime.fromisoformat(ts)
+        except ValueError:
+            pass
+    return date_parser.parse(ts)
+
+
 def handle_telemetry(bin_id: str, payload: dict):
     """Handle telemetry messages from bins.
     
@@ -155,8 +181,6 @@ def handle_telemetry(bin_id: str, payload: dict):
     - Original: {ts, fill_pct, batt_v, temp_c, lat, lon}
     - ESP32:    {timestamp, fill_level, battery_level, temperature, bin_id}
     """
-    global message_count
-    
     # Extract timestamp - support both field names
     ts = payload.get("ts") or payload.get("timestamp")
     
@@ -180,7 +204,7 @@ def handle_telemetry(bin_id: str, payload: dict):
     
     # Parse timestamp
     try:
-        parsed_ts = date_parser.parse(ts)
+        parsed_ts = _parse_ts(ts)
     except Exception as e:
         logger.warning(f"Invalid timestamp format from {bin_id}: {ts}")
         return
@@ -202,56 +226,38 @@ def handle_telemetry(bin_id: str, payload: dict):
     lat = payload.get("lat")
     lon = payload.get("lon")
     
-    # UPSERT bin record
-    db.upsert_bin(
+    # Everything below is queued for the background batch writer; nothing
+    # blocks this (network) thread on a database round trip.
+    # Bin upsert also marks it online and sets last_emptied if the flag is set.
+    db.enqueue_bin_seen(
         bin_id=bin_id,
         lat=lat,
         lon=lon,
-        last_seen=parsed_ts.isoformat()
+        last_seen=parsed_ts,
+        emptied_at=parsed_ts if emptied else None
     )
     
-    # Update device status to online
-    db.update_device_status(bin_id, "online")
-    
-    # If emptied flag is set, update last_emptied
-    if emptied:
-        db.update_bin_emptied(bin_id, parsed_ts.isoformat())
-    
-    # INSERT telemetry record
-    db.insert_telemetry(
-        ts=parsed_ts.isoformat(),
-        bin_id=bin_id,
-        fill_pct=fill_pct,
-        batt_v=batt_v,
-        temp_c=temp_c,
-        emptied=emptied,
-        lat=lat,
-        lon=lon
+    # Timestamps stay as datetime objects; psycopg2 adapts them directly.
+    db.enqueue_telemetry(
+        (parsed_ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon)
     )
     
     # Record power profile if battery voltage present
     if batt_v:
-        try:
-            db.record_power_reading(bin_id, batt_v)
-        except Exception as e:
-            logger.debug(f"Could not record power reading: {e}")
+        db.enqueue_power_reading(bin_id, batt_v)
     
     # Update device shadow with reported state
-    try:
-        shadow_state = {
-            "fill_pct": fill_pct,
-            "batt_v": batt_v,
-            "temp_c": temp_c,
-            "lat": lat,
-            "lon": lon,
-            "last_telemetry": parsed_ts.isoformat()
-        }
-        db.update_device_shadow_reported(bin_id, shadow_state)
-    except Exception as e:
-        logger.debug(f"Could not update device shadow: {e}")
+    db.enqueue_shadow_reported(bin_id, {
+        "fill_pct": fill_pct,
+        "batt_v": batt_v,
+        "temp_c": temp_c,
+        "lat": lat,
+        "lon": lon,
+        "last_telemetry": parsed_ts.isoformat()
+    })
     
-    message_count += 1
-    logger.info(f"Telemetry [{message_count}] from {bin_id}: fill={fill_pct}%")
+    count = _count_message()
+    logger.info(f"Telemetry [{count}] from {bin_id}: fill={fill_pct}%")
 
 
 def handle_heartbeat(bin_id: str, payload: dict):
@@ -261,8 +267,6 @@ def handle_heartbeat(bin_id: str, payload: dict):
     - Original: {rssi, uptime_seconds, free_memory_kb, firmware_version}
     - ESP32:    {rssi_dbm, uptime_seconds, timestamp, bin_id}
     """
-    global message_count
-    
     # Support both rssi and rssi_dbm field names
     rssi = payload.get("rssi") or payload.get("rssi_dbm")
     uptime = payload.get("uptime_seconds")
@@ -270,17 +274,15 @@ def handle_heartbeat(bin_id: str, payload: dict):
     firmware_version = payload.get("firmware_version")
     
     try:
-        db.record_heartbeat(bin_id, rssi, uptime, free_memory, firmware_version)
-        message_count += 1
-        logger.info(f"Heartbeat [{message_count}] from {bin_id} (RSSI={rssi}, uptime={uptime}s)")
+        db.enqueue_heartbeat(bin_id, rssi, uptime, free_memory, firmware_version)
+        count = _count_message()
+        logger.info(f"Heartbeat [{count}] from {bin_id} (RSSI={rssi}, uptime={uptime}s)")
     except Exception as e:
         logger.error(f"Failed to record heartbeat from {bin_id}: {e}")
 
 
 def handle_command_ack(bin_id: str, payload: dict):
     """Handle command acknowledgment messages."""
-    global message_count
-    
     command_id = payload.get("command_id")
     success = payload.get("success", True)
     error_message = payload.get("error")
@@ -291,39 +293,35 @@ def handle_command_ack(bin_id: str, payload: dict):
     
     try:
         db.acknowledge_command(command_id, success, error_message)
-        message_count += 1
+        count = _count_message()
         status = "OK" if success else "FAILED"
-        logger.info(f"{status} [{message_count}] ACK from {bin_id} for command {command_id}")
+        logger.info(f"{status} [{count}] ACK from {bin_id} for command {command_id}")
     except Exception as e:
         logger.error(f"Failed to process ACK from {bin_id}: {e}")
 
 
 def handle_diagnostic(bin_id: str, payload: dict):
     """Handle diagnostic response messages."""
-    global message_count
-    
     diagnostic_id = payload.get("diagnostic_id")
     
     try:
         db.store_diagnostic_result(bin_id, payload, diagnostic_id)
-        message_count += 1
-        logger.info(f"Diagnostic [{message_count}] Diagnostic from {bin_id}")
+        count = _count_message()
+        logger.info(f"Diagnostic [{count}] Diagnostic from {bin_id}")
     except Exception as e:
         logger.error(f"Failed to store diagnostic from {bin_id}: {e}")
 
 
 def handle_firmware_status(bin_id: str, payload: dict):
     """Handle firmware update status messages."""
-    global message_count
-    
     progress = payload.get("progress_pct", 0)
     status = payload.get("status")  # downloading, installing, completed, failed
     error = payload.get("error")
     
     try:
         db.update_firmware_progress(bin_id, progress, status)
-        message_count += 1
-        logger.info(f"Firmware [{message_count}] Firmware update {bin_id}: {status} ({progress}%)")
+        count = _count_message()
+        logger.info(f"Firmware [{count}] Firmware update {bin_id}: {status} ({progress}%)")
         
         if status == "failed" and error:
             logger.error(f"Firmware update failed for {bin_id}: {error}")
@@ -333,16 +331,33 @@ def handle_firmware_status(bin_id: str, payload: dict):
 
 def handle_shadow_reported(bin_id: str, payload: dict):
     """Handle device shadow reported state updates."""
-    global message_count
-    
     try:
         db.update_device_shadow_reported(bin_id, payload)
-        message_count += 1
-        logger.info(f"Shadow [{message_count}] Shadow update from {bin_id}")
+        count = _count_message()
+        logger.info(f"Shadow [{count}] Shadow update from {bin_id}")
     except Exception as e:
         logger.error(f"Failed to update shadow for {bin_id}: {e}")
 
 
+# Topic message type -> handler, looked up once per message in on_message
+_HANDLERS = {
+    "telemetry": handle_telemetry,
+    "heartbeat": handle_heartbeat,
+    "ack": handle_command_ack,
+    "diagnostic": handle_diagnostic,
+    "firmware_status": handle_firmware_status,
+    "shadow/reported": handle_shadow_reported,
+}
+
+
+def _dispatch(handler, bin_id: str, payload: dict):
+    """Run a handler on an ingest worker, logging instead of losing errors."""
+    try:
+        handler(bin_id, payload)
+    except Exception as e:
+        logger.error(f"Error processing message from {bin_id}: {e}")
+
+
 # ─────────────────────────────────────────────────────────────────────────────
 # Ingest Control
 # ─────────────────────────────────────────────────────────────────────────────
@@ -356,9 +371,26 @@ def start_mqtt_ingest():
     - Insecure (default): Plain MQTT on port 1883
     - Secure (MQTT_USE_TLS=true): TLS + Auth on port 8883
     """
-    global mqtt_client
-    
-    mqtt_client = mqtt.Client()
+    global mqtt_client, _workers
+    
+    _workers = [
+        ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"mqtt-ingest-{i}")
+        for i in range(config.MQTT_INGEST_WORKERS)
+    ]
+    
+    # The broker allows one session per client id, so a fixed id (and with it
+    # the persistent session that keeps QoS 1 telemetry while we are
+    # disconnected) is only used when configured; otherwise every process
+    # gets its own id and a clean session instead of taking over another's
+    if config.MQTT_INGEST_CLIENT_ID:
+        mqtt_client = mqtt.Client(client_id=config.MQTT_INGEST_CLIENT_ID, clean_session=False)
+    else:
+        mqtt_client = mqtt.Client(
+            client_id=f"cleanroute_ingest_{socket.gethostname()}_{os.getpid()}",
+            clean_session=True
+        )
+    mqtt_client.enable_logger(logger)
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
     mqtt_client.on_connect = on_connect
     mqtt_client.on_disconnect = on_disconnect
     mqtt_client.on_message = on_message
@@ -406,11 +438,15 @@ def start_mqtt_ingest():
 
 def stop_mqtt_ingest():
     """Stop the MQTT ingest service."""
-    global mqtt_client
+    global mqtt_client, _workers
     if mqtt_client:
         mqtt_client.loop_stop()
         mqtt_client.disconnect()
         logger.info("MQTT ingest service stopped")
+    # Finish messages already handed off before the ingest writer drains
+    workers, _workers = _workers, []
+    for worker in workers:
+        worker.shutdown(wait=True)
 
 
 def get_ingest_status():
@@ -422,5 +458,7 @@ def get_ingest_status():
         "topic": config.MQTT_TOPIC,
         "messages_processed": message_count,
         "tls_enabled": config.MQTT_USE_TLS,
-        "authenticated": config.MQTT_USE_TLS  # Auth is required with TLS
+        "authenticated": config.MQTT_USE_TLS,  # Auth is required with TLS
+        "ingest_queue_depth": db.INGEST_QUEUE.qsize(),
+        "db_pool": db.get_pool_stats()
     }
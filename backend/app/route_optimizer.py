@@ -8,6 +8,18 @@ import logging
 import math
 from typing import List, Dict, Any, Tuple, Optional
 
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # optional: falls back to the NumPy search
+    njit = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # optional: large routes fall back to the linear scan
+    cKDTree = None
+
 logger = logging.getLogger(__name__)
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -16,6 +28,14 @@ logger = logging.getLogger(__name__)
 DEFAULT_DEPOT = {"lat": 6.9271, "lon": 79.8612, "name": "Municipal Office"}
 AVERAGE_SPEED_KMH = 30  # Average driving speed in city
 SERVICE_TIME_MINUTES = 5  # Time to empty one bin
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.radians(1) * EARTH_RADIUS_KM
+# Longitude scale for planar distances, fixed at the service area's latitude
+_COS_LAT_REF = math.cos(math.radians(DEFAULT_DEPOT["lat"]))
+# Routes with at least this many bins use k-d tree queries (when scipy is installed)
+KDTREE_MIN_BINS = 500
+# Detour (km) worth taking per predicted fill % in priority_based_route
+ROUTE_PRIORITY_ALPHA = 0.02
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Zone Definitions for Colombo
@@ -81,9 +101,6 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     Returns:
         Distance in kilometers
     """
-    # Earth radius in kilometers
-    R = 6371.0
-    
     # Convert to radians
     lat1_rad = math.radians(lat1)
     lat2_rad = math.radians(lat2)
@@ -92,10 +109,124 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     
     # Haversine formula
     a = math.sin(delta_lat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = R * c
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def planar_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    Equirectangular approximation of the distance in kilometers.
     
-    return distance
+    Within the service area (one city, close to the reference latitude) this
+    stays well under 0.5% of the haversine distance at a fraction of the cost.
+    """
+    return math.hypot((lon2 - lon1) * KM_PER_DEGREE * _COS_LAT_REF,
+                      (lat2 - lat1) * KM_PER_DEGREE)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# Nearest Neighbor Kernels
+# ─────────────────────────────────────────────────────────────────────────────
+# Both take bin positions projected to planar km (see planar_distance) and
+# return the visiting order plus the leg length (km) to each bin. A non-zero
+# bonus (km) makes a bin that much cheaper to pick next: the step minimizes
+# distance - bonus instead of distance. The Numba kernel fuses the distance
+# and argmin into one scan without per-step allocations.
+
+def _nn_order_numpy(x: np.ndarray, y: np.ndarray, start_x: float, start_y: float,
+                    bonus: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Nearest-neighbor order with one vectorized distance pass per step."""
+    n = len(x)
+    weighted = bool(bonus.any())
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    legs = np.empty(n, dtype=np.float64)
+    cur_x, cur_y = start_x, start_y
+    for step in range(n):
+        d2 = (x - cur_x) ** 2 + (y - cur_y) ** 2
+        d2[visited] = np.inf
+        if weighted:
+            idx = int(np.argmin(np.sqrt(d2) - bonus))
+        else:
+            idx = int(np.argmin(d2))
+        visited[idx] = True
+        order[step] = idx
+        legs[step] = math.sqrt(d2[idx])
+        cur_x, cur_y = x[idx], y[idx]
+    return order, legs
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _nn_order_jit(x, y, start_x, start_y, bonus):
+        n = x.shape[0]
+        weighted = np.any(bonus != 0.0)
+        visited = np.zeros(n, dtype=np.bool_)
+        order = np.empty(n, dtype=np.int64)
+        legs = np.empty(n, dtype=np.float64)
+        cur_x, cur_y = start_x, start_y
+        for step in range(n):
+            best = 0
+            best_cost = np.inf
+            best_d2 = np.inf
+            for j in range(n):
+                if visited[j]:
+                    continue
+                dx = x[j] - cur_x
+                dy = y[j] - cur_y
+                d2 = dx * dx + dy * dy
+                cost = math.sqrt(d2) - bonus[j] if weighted else d2
+                if cost < best_cost:
+                    best_cost = cost
+                    best_d2 = d2
+                    best = j
+            visited[best] = True
+            order[step] = best
+            legs[step] = math.sqrt(best_d2)
+            cur_x, cur_y = x[best], y[best]
+        return order, legs
+
+    _nn_order = _nn_order_jit
+else:
+    _nn_order = _nn_order_numpy
+
+
+def _nn_order_kdtree(x: np.ndarray, y: np.ndarray,
+                     start_x: float, start_y: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Nearest-neighbor order from k-d tree queries instead of full scans.
+    
+    Each step asks for the k nearest bins, doubling k until one is unvisited.
+    The tree is rebuilt over the unvisited bins whenever more than half of
+    it has been visited, so queries stay small as the route fills in.
+    """
+    n = len(x)
+    points = np.column_stack((x, y))
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    legs = np.empty(n, dtype=np.float64)
+    remaining = np.arange(n)  # tree row -> bin index
+    tree = cKDTree(points)
+    current = (start_x, start_y)
+    for step in range(n):
+        if 2 * (n - step) < len(remaining):
+            remaining = np.flatnonzero(~visited)
+            tree = cKDTree(points[remaining])
+        k = min(8, len(remaining))
+        while True:
+            dist, rows = tree.query(current, k=k)
+            dist, rows = np.atleast_1d(dist), np.atleast_1d(rows)
+            hits = np.flatnonzero(~visited[remaining[rows]])
+            # The tree holds every unvisited bin, so k == len(remaining) always hits
+            if hits.size or k == len(remaining):
+                break
+            k = min(2 * k, len(remaining))
+        hit = hits[0]
+        idx = int(remaining[rows[hit]])
+        visited[idx] = True
+        order[step] = idx
+        legs[step] = dist[hit]
+        current = points[idx]
+    return order, legs
 
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -104,7 +235,8 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
 
 def greedy_nearest_neighbor(
     bins: List[Dict[str, Any]],
-    start_location: Dict[str, float]
+    start_location: Dict[str, float],
+    priority_weight: float = 0.0
 ) -> List[Dict[str, Any]]:
     """
     Find near-optimal route using greedy nearest-neighbor algorithm.
@@ -118,6 +250,8 @@ def greedy_nearest_neighbor(
     Args:
         bins: List of bin dictionaries with 'bin_id', 'lat', 'lon', 'predicted_fill'
         start_location: Starting point {'lat': ..., 'lon': ..., 'name': ...}
+        priority_weight: km of detour worth taking per predicted fill %
+            (0 = pure nearest neighbor)
     
     Returns:
         Ordered list of waypoints (depot, bins, depot)
@@ -136,8 +270,20 @@ def greedy_nearest_neighbor(
         "cumulative_distance_km": 0
     }]
     
-    # Create list of unvisited bins
-    unvisited = bins.copy()
+    # Visiting order and leg lengths from the kernel; only the output
+    # dicts are built in Python
+    lon_scale = KM_PER_DEGREE * _COS_LAT_REF
+    x = np.array([b['lon'] for b in bins], dtype=np.float64) * lon_scale
+    y = np.array([b['lat'] for b in bins], dtype=np.float64) * KM_PER_DEGREE
+    start_x = start_location['lon'] * lon_scale
+    start_y = start_location['lat'] * KM_PER_DEGREE
+    if priority_weight:
+        bonus = priority_weight * np.array([b['predicted_fill'] for b in bins], dtype=np.float64)
+        visit_order, legs = _nn_order(x, y, start_x, start_y, bonus)
+    elif cKDTree is not None and len(bins) >= KDTREE_MIN_BINS:
+        visit_order, legs = _nn_order_kdtree(x, y, start_x, start_y)
+    else:
+        visit_order, legs = _nn_order(x, y, start_x, start_y, np.zeros(len(bins)))
     
     # Current position starts at depot
     current_lat = start_location['lat']
@@ -146,23 +292,8 @@ def greedy_nearest_neighbor(
     
     # Visit bins one by one
     order = 1
-    while unvisited:
-        # Find nearest unvisited bin
-        nearest_bin = None
-        min_distance = float('inf')
-        
-        for bin_data in unvisited:
-            distance = haversine_distance(
-                current_lat, current_lon,
-                bin_data['lat'], bin_data['lon']
-            )
-            
-            if distance < min_distance:
-                min_distance = distance
-                nearest_bin = bin_data
-        
-        if nearest_bin is None:
-            break
+    for idx, min_distance in zip(visit_order.tolist(), legs.tolist()):
+        nearest_bin = bins[idx]
         
         # Add to route
         cumulative_distance += min_distance
@@ -183,13 +314,10 @@ def greedy_nearest_neighbor(
         # Update current position
         current_lat = nearest_bin['lat']
         current_lon = nearest_bin['lon']
-        
-        # Remove from unvisited
-        unvisited.remove(nearest_bin)
         order += 1
     
     # Return to depot
-    return_distance = haversine_distance(
+    return_distance = planar_distance(
         current_lat, current_lon,
         start_location['lat'], start_location['lon']
     )
@@ -293,20 +421,14 @@ def priority_based_route(
     Generate route prioritizing high-fill bins while considering distance.
     
     Algorithm:
-    1. Sort bins by predicted fill (highest first)
-    2. Apply greedy nearest-neighbor within each fill bracket
-    
-    This is more advanced than pure greedy but still simple.
+    Greedy nearest-neighbor where each step picks the bin minimizing
+    distance - ROUTE_PRIORITY_ALPHA * predicted_fill, so fuller bins are
+    worth a short detour. Runs in the same single pass as plain greedy.
     """
     if not bins:
         return []
     
-    # Sort bins by predicted fill (descending)
-    sorted_bins = sorted(bins, key=lambda b: b['predicted_fill'], reverse=True)
-    
-    # For simplicity, just apply greedy to sorted list
-    # (In practice, you'd divide into priority brackets)
-    return greedy_nearest_neighbor(sorted_bins, start_location)
+    return greedy_nearest_neighbor(bins, start_location, priority_weight=ROUTE_PRIORITY_ALPHA)
 
 
 def calculate_route_stats(route: List[Dict[str, Any]]) -> Dict[str, float]:
@@ -342,7 +464,7 @@ def assign_bin_to_zone(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     
     for zone_key, zone in COLOMBO_ZONES.items():
         depot = zone['depot']
-        distance = haversine_distance(lat, lon, depot['lat'], depot['lon'])
+        distance = planar_distance(lat, lon, depot['lat'], depot['lon'])
         if distance < min_distance:
             min_distance = distance
             nearest_zone = zone
@@ -376,6 +376,13 @@ def insert_telemetry_to_db(records: List[Dict]):
         
         # Batch insert for speed
         execute_batch(cur, insert_query, data, page_size=100)
+        
+        # Backfilled history bypasses the backend's rolling fill-rate state;
+        # drop it so forecasts rebuild it from the new history
+        cur.execute(
+            "DELETE FROM bin_fill_rate_state WHERE bin_id = ANY(%s)",
+            (list({r["bin_id"] for r in records}),)
+        )
         conn.commit()
         
         print(f"Inserted {len(records)} records successfully")
@@ -0,0 +1,64 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Convert telemetry into a monthly range-partitioned table on ts.
+--
+-- Queries filter on recent ts (ORDER BY ts DESC LIMIT n, latest-per-bin),
+-- so the planner can prune to the newest partitions and old months can be
+-- dropped instead of deleted. Existing rows are copied across.
+--
+-- Run once:
+--   psql "$DATABASE_URL" -f backend/migrations/001_partition_telemetry.sql
+--
+-- Future monthly partitions are created by db.ensure_telemetry_partitions()
+-- on backend startup; rows outside any monthly range land in telemetry_default.
+-- ─────────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+ALTER TABLE telemetry RENAME TO telemetry_unpartitioned;
+ALTER TABLE telemetry_unpartitioned RENAME CONSTRAINT telemetry_pkey TO telemetry_unpartitioned_pkey;
+ALTER INDEX IF EXISTS idx_telemetry_bin_ts RENAME TO idx_telemetry_unpartitioned_bin_ts;
+
+-- The partition key must be part of the primary key
+CREATE TABLE telemetry (
+  id BIGINT NOT NULL DEFAULT nextval('telemetry_id_seq'),
+  ts TIMESTAMPTZ NOT NULL,
+  bin_id TEXT NOT NULL REFERENCES bins(bin_id),
+  fill_pct DOUBLE PRECISION NOT NULL CHECK (fill_pct >= 0 AND fill_pct <= 100),
+  batt_v DOUBLE PRECISION,
+  temp_c DOUBLE PRECISION,
+  emptied BOOLEAN DEFAULT FALSE,
+  lat DOUBLE PRECISION,
+  lon DOUBLE PRECISION,
+  received_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (id, ts)
+) PARTITION BY RANGE (ts);
+
+ALTER SEQUENCE telemetry_id_seq OWNED BY telemetry.id;
+
+-- Created on the parent, so every partition gets a local (bin_id, ts DESC) index
+CREATE INDEX idx_telemetry_bin_ts ON telemetry (bin_id, ts DESC);
+
+CREATE TABLE telemetry_default PARTITION OF telemetry DEFAULT;
+
+-- One partition per month from the oldest reading through two months ahead
+DO $$
+DECLARE
+  m DATE;
+  last_month DATE := (date_trunc('month', NOW()) + INTERVAL '2 months')::date;
+BEGIN
+  SELECT date_trunc('month', COALESCE(MIN(ts), NOW()))::date INTO m FROM telemetry_unpartitioned;
+  WHILE m <= last_month LOOP
+    EXECUTE format(
+      'CREATE TABLE IF NOT EXISTS %I PARTITION OF telemetry FOR VALUES FROM (%L) TO (%L)',
+      'telemetry_' || to_char(m, 'YYYY_MM'), m, (m + INTERVAL '1 month')::date
+    );
+    m := (m + INTERVAL '1 month')::date;
+  END LOOP;
+END $$;
+
+INSERT INTO telemetry (id, ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon, received_at)
+SELECT id, ts, bin_id, fill_pct, batt_v, temp_c, emptied, lat, lon, received_at
+FROM telemetry_unpartitioned;
+
+DROP TABLE telemetry_unpartitioned;
+
+COMMIT;
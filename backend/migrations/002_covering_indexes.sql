@@ -0,0 +1,40 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Covering / partial indexes for the hot read paths.
+--
+--   idx_telemetry_bin_ts_covering  get_all_bins_latest, get_recent_telemetry
+--                                  (latest-per-bin and ORDER BY ts DESC LIMIT n
+--                                  become index-only scans)
+--   idx_bins_user_id               get_user_bins
+--   idx_alerts_unresolved          get_unresolved_alerts
+--
+-- Indexes are built CONCURRENTLY so ingest keeps running, which cannot happen
+-- inside a transaction: run this with psql in autocommit mode (no -1):
+--   psql "$DATABASE_URL" -f backend/migrations/002_covering_indexes.sql
+--
+-- Partitioned parents (see 001) do not support CONCURRENTLY; there the
+-- telemetry index is created normally and cascades to every partition,
+-- including the ones ensure_telemetry_partitions() adds later.
+-- ─────────────────────────────────────────────────────────────────────────────
+
+SELECT format(
+  'CREATE INDEX %s IF NOT EXISTS idx_telemetry_bin_ts_covering '
+  'ON telemetry (bin_id, ts DESC) INCLUDE (fill_pct, batt_v, temp_c, emptied, lat, lon)',
+  CASE WHEN c.relkind = 'p' THEN '' ELSE 'CONCURRENTLY' END
+)
+FROM pg_class c
+WHERE c.oid = 'telemetry'::regclass
+\gexec
+
+-- The plain (bin_id, ts DESC) index is a prefix of the covering one
+SELECT format(
+  'DROP INDEX %s IF EXISTS idx_telemetry_bin_ts',
+  CASE WHEN c.relkind = 'p' THEN '' ELSE 'CONCURRENTLY' END
+)
+FROM pg_class c
+WHERE c.oid = 'telemetry'::regclass
+\gexec
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_bins_user_id ON bins (user_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_alerts_unresolved
+  ON alerts (bin_id, created_at DESC) WHERE resolved = FALSE;
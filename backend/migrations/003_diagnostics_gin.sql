@@ -0,0 +1,13 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- GIN index for containment queries on device_diagnostics.data
+-- (data @> '{"type": "..."}') and jsonpath matches (data @? '$.errors[*]').
+-- jsonb_path_ops is smaller than the default jsonb_ops and serves @>, @?
+-- and @@; only key-existence operators (?, ?|, ?&) would need jsonb_ops.
+--
+-- init_diagnostics_table() creates the same index on startup; on a large
+-- existing table, build it here first without blocking diagnostic writes:
+--   psql "$DATABASE_URL" -f backend/migrations/003_diagnostics_gin.sql
+-- ─────────────────────────────────────────────────────────────────────────────
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_diag_data_gin
+  ON device_diagnostics USING GIN (data jsonb_path_ops);
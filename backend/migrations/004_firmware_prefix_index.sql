@@ -0,0 +1,12 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Prefix index for zone-filtered pending firmware updates
+-- (status = 'pending' AND bin_id LIKE 'COL1%'). text_pattern_ops lets the
+-- left-anchored LIKE use a btree range scan under any database collation.
+--
+-- init_firmware_table() creates the same index on startup; on a large
+-- existing table, build it here first without blocking OTA writes:
+--   psql "$DATABASE_URL" -f backend/migrations/004_firmware_prefix_index.sql
+-- ─────────────────────────────────────────────────────────────────────────────
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fw_updates_pending_bin_pattern
+  ON firmware_updates (bin_id text_pattern_ops) WHERE status = 'pending';
@@ -0,0 +1,11 @@
+-- ─────────────────────────────────────────────────────────────────────────────
+-- Prefix index for zone membership lookups (bin_id LIKE ANY('{COL1%,...}'),
+-- used by get_bins_in_zone and get_zone_bins_status). The primary key's
+-- btree only serves LIKE under the C collation; text_pattern_ops makes the
+-- left-anchored match a range scan under any collation.
+--
+--   psql "$DATABASE_URL" -f backend/migrations/005_bins_prefix_index.sql
+-- ─────────────────────────────────────────────────────────────────────────────
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_bins_bin_id_pattern
+  ON bins (bin_id text_pattern_ops);
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Kernel Consistency Test - Fast paths against their reference paths
+No database, no MQTT, no backend server needed
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(__file__))
+
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from app import db, ml_prediction, route_optimizer
+
+def print_section(title):
+    print(f"\n{'='*70}")
+    print(f"  {title}")
+    print(f"{'='*70}\n")
+
+def random_history(rng, n, start=None):
+    """Telemetry history (oldest first) with repeats, emptyings and sensor spikes"""
+    ts = start or datetime(2026, 1, 1, tzinfo=timezone.utc)
+    fill = float(rng.uniform(0, 30))
+    history = []
+    for _ in range(n):
+        history.append({"ts": ts, "fill_pct": fill})
+        ts += timedelta(minutes=int(rng.choice([0, 15, 30, 60, 120])))
+        fill = max(0.0, fill + float(rng.choice([rng.uniform(0, 5), -40.0, 35.0])))
+    return history
+
+def test_ewma_paths():
+    """Test 1: Vectorized EWMA matches the scalar loop"""
+    print_section("TEST 1: EWMA Vectorized vs Scalar")
+
+    rng = np.random.default_rng(7)
+    checked = 0
+    for n in range(2, 60):
+        for alpha in (0.1, ml_prediction.EWMA_ALPHA, 0.9):
+            history = random_history(rng, n)
+            scalar = ml_prediction._ewma_rate_scalar(history, alpha)
+            vectorized = ml_prediction._ewma_rate_vectorized(history, alpha)
+            if scalar is None:
+                assert vectorized is None, f"n={n} alpha={alpha}: {vectorized} vs None"
+            else:
+                assert np.isclose(scalar, vectorized, rtol=1e-9, atol=1e-12), \
+                    f"n={n} alpha={alpha}: {vectorized} vs {scalar}"
+            checked += 1
+
+    print(f"Done: {checked} histories agree")
+
+def nn_kernels():
+    """Every nearest-neighbor kernel available in this environment"""
+    kernels = [("numpy", route_optimizer._nn_order_numpy)]
+    jit = getattr(route_optimizer, "_nn_order_jit", None)
+    if jit is not None:
+        kernels.append(("numba", jit))
+    else:
+        print("Skipped: numba not installed")
+    return kernels
+
+def test_nn_kernels():
+    """Test 2: NumPy, Numba and k-d tree kernels give the same route"""
+    print_section("TEST 2: Nearest-Neighbor Kernels Agree")
+
+    rng = np.random.default_rng(11)
+    kernels = nn_kernels()
+    if route_optimizer.cKDTree is None:
+        print("Skipped: scipy not installed (k-d tree kernel)")
+
+    for n in (1, 2, 10, 200, 1500):
+        x = rng.uniform(0, 20, n)
+        y = rng.uniform(0, 20, n)
+        start_x, start_y = 10.0, 10.0
+
+        ref_order, ref_legs = route_optimizer._nn_order_numpy(x, y, start_x, start_y, np.zeros(n))
+        assert sorted(ref_order.tolist()) == list(range(n)), "order must visit every bin once"
+
+        for name, kernel in kernels[1:]:
+            order, legs = kernel(x, y, start_x, start_y, np.zeros(n))
+            assert np.array_equal(order, ref_order), f"{name} order differs (n={n})"
+            assert np.allclose(legs, ref_legs), f"{name} legs differ (n={n})"
+
+        if route_optimizer.cKDTree is not None:
+            order, legs = route_optimizer._nn_order_kdtree(x, y, start_x, start_y)
+            assert np.array_equal(order, ref_order), f"kdtree order differs (n={n})"
+            assert np.allclose(legs, ref_legs), f"kdtree legs differ (n={n})"
+
+        # Fill priority: the weighted scan must agree across kernels too
+        bonus = route_optimizer.ROUTE_PRIORITY_ALPHA * rng.uniform(0, 100, n)
+        ref_order, ref_legs = route_optimizer._nn_order_numpy(x, y, start_x, start_y, bonus)
+        for name, kernel in kernels[1:]:
+            order, legs = kernel(x, y, start_x, start_y, bonus)
+            assert np.array_equal(order, ref_order), f"{name} weighted order differs (n={n})"
+            assert np.allclose(legs, ref_legs), f"{name} weighted legs differ (n={n})"
+
+        print(f"Done: {n:5} bins - {len(kernels)} scan kernel(s) agree")
+
+def test_bin_row_merge():
+    """Test 3: Bin upsert rows collapse to one per bin"""
+    print_section("TEST 3: Bin Row Merge Rules")
+
+    t0 = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+    t1 = t0 + timedelta(minutes=5)
+    t2 = t0 + timedelta(minutes=10)
+
+    # Newest last_seen wins, even when it arrives first
+    merged = db._merge_bin_rows([
+        ("B1", 6.90, 79.80, t2, None),
+        ("B1", 6.91, 79.81, t1, None),
+    ])
+    assert merged["B1"] == ("B1", 6.90, 79.80, t2, None)
+
+    # An emptied flag on an older row is not lost
+    merged = db._merge_bin_rows([
+        ("B1", 6.90, 79.80, t1, t1),
+        ("B1", 6.92, 79.82, t2, None),
+    ])
+    assert merged["B1"] == ("B1", 6.92, 79.82, t2, t1)
+
+    merged = db._merge_bin_rows([
+        ("B1", 6.92, 79.82, t2, None),
+        ("B1", 6.90, 79.80, t0, t0),
+    ])
+    assert merged["B1"] == ("B1", 6.92, 79.82, t2, t0)
+
+    # Naive and aware stamps can't be compared: arrival order decides
+    naive = datetime(2026, 3, 1, 12, 30)
+    merged = db._merge_bin_rows([
+        ("B1", 6.90, 79.80, t2, None),
+        ("B1", 6.93, 79.83, naive, None),
+    ])
+    assert merged["B1"] == ("B1", 6.93, 79.83, naive, None)
+
+    # Bins are merged independently
+    merged = db._merge_bin_rows([
+        ("B1", 6.90, 79.80, t0, None),
+        ("B2", 6.95, 79.85, t1, t1),
+        ("B1", 6.91, 79.81, t1, None),
+    ])
+    assert set(merged) == {"B1", "B2"}
+    assert merged["B1"][3] == t1 and merged["B2"][4] == t1
+
+    print("Done: last_seen, emptied_at and mixed-timezone rules hold")
+
+# Fake fleet for TEST 4: (bin_id, lat, lon, device_status, fill, ewma_rate, n_samples)
+FLEET = [
+    ("B01", 6.90, 79.85, "online", 20.0, 2.5, 30),
+    ("B02", 6.91, 79.86, "online", 60.0, 1.0, 12),
+    ("B03", 6.92, 79.87, "online", 85.0, 0.5, 20),   # already over threshold
+    ("B04", 6.93, 79.88, "online", 70.0, None, 8),   # no valid rates
+    ("B05", 6.94, 79.89, "offline", 95.0, 3.0, 25),  # offline: never collected
+    ("B06", None, None, "online", 90.0, 3.0, 25),    # no GPS fix
+    ("B07", 6.95, 79.90, "online", 10.0, 0.2, 6),
+    ("B08", 6.96, 79.91, "online", 79.9, 0.0, 40),
+    ("B09", 6.97, 79.92, "online", 41.0, None, 2),   # new bin: replayed from history
+]
+
+def recent_history(now, start_fill, hours):
+    """Hourly readings ending at `now`, filling 1% per hour"""
+    return [{"ts": now - timedelta(hours=hours - i), "fill_pct": start_fill + i}
+            for i in range(hours + 1)]
+
+class FakeCursor:
+    """Answers the two queries behind get_bins_needing_collection from FLEET"""
+    def __init__(self, now):
+        self.now = now
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        if "bin_fill_rate_state" in sql:
+            # The candidate query's WHERE is only a pre-filter; return every
+            # eligible bin so the Python side does all of the selection.
+            # Thin state is flagged for a replay, as in the real query
+            self.rows = [
+                {"bin_id": b, "lat": lat, "lon": lon, "last_seen": self.now,
+                 "device_status": status, "current_fill": fill, "n_samples": n,
+                 "fill_rate": rate,
+                 "needs_recompute": n < ml_prediction.MIN_DATA_POINTS}
+                for b, lat, lon, status, fill, rate, n in FLEET
+                if lat is not None and lon is not None and status != "offline"
+            ]
+        else:
+            self.rows = [
+                {"bin_id": b, "lat": lat, "lon": lon, "last_seen": self.now,
+                 "device_status": status, "current_fill": fill, "current_ts": self.now}
+                for b, lat, lon, status, fill, rate, n in FLEET
+            ]
+
+    def fetchall(self):
+        return self.rows
+
+def test_collection_paths():
+    """Test 4: Rolling-state fast path matches the full forecast"""
+    print_section("TEST 4: Collection Fast Path vs forecast_all_bins")
+
+    now = datetime.now(timezone.utc)
+    states = {
+        b: {"ewma_rate": rate, "last_ts": now, "n_samples": n}
+        for b, lat, lon, status, fill, rate, n in FLEET
+    }
+
+    @contextmanager
+    def fake_cursor(*args, **kwargs):
+        yield FakeCursor(now)
+
+    histories = {"B09": recent_history(now, 29.0, 12)}
+    replayed = []
+
+    def fake_history(days=ml_prediction.MAX_HISTORY_DAYS, bin_ids=None):
+        replayed.append(bin_ids)
+        return {b: h for b, h in histories.items() if bin_ids is None or b in bin_ids}
+
+    saved = (db.get_cursor, db.get_fill_rate_state, db.save_fill_rate_states,
+             ml_prediction.USE_CSV_DATA, ml_prediction._bins_needing_collection_from_state,
+             ml_prediction.get_all_historical_data)
+    db.get_cursor = fake_cursor
+    db.get_fill_rate_state = lambda *args, **kwargs: states
+    db.save_fill_rate_states = lambda rows: None
+    ml_prediction.USE_CSV_DATA = False
+    ml_prediction.get_all_historical_data = fake_history
+    try:
+        for hours in (1, 12, 24, 72):
+            for threshold in (50.0, 80.0, 95.0):
+                target = datetime.utcnow() + timedelta(hours=hours)
+
+                ml_prediction.invalidate_ewma_cache()
+                ml_prediction._bins_needing_collection_from_state = saved[4]
+                replayed.clear()
+                fast = ml_prediction.get_bins_needing_collection(target, threshold)
+                # Only the flagged bin is replayed; the rest come from state
+                assert replayed in ([], [["B09"]]), f"replayed {replayed}"
+
+                ml_prediction.invalidate_ewma_cache()
+                ml_prediction._bins_needing_collection_from_state = lambda *args: None
+                full = ml_prediction.get_bins_needing_collection(target, threshold)
+
+                assert [p['bin_id'] for p in fast] == [p['bin_id'] for p in full], \
+                    f"{hours}h @ {threshold}%: {[p['bin_id'] for p in fast]} vs {[p['bin_id'] for p in full]}"
+                for a, b in zip(fast, full):
+                    assert abs(a['predicted_fill'] - b['predicted_fill']) <= 0.1, \
+                        f"{a['bin_id']}: {a['predicted_fill']} vs {b['predicted_fill']}"
+                print(f"Done: {hours:3}h @ {threshold:.0f}% - {len(fast)} bins on both paths")
+    finally:
+        (db.get_cursor, db.get_fill_rate_state, db.save_fill_rate_states,
+         ml_prediction.USE_CSV_DATA, ml_prediction._bins_needing_collection_from_state,
+         ml_prediction.get_all_historical_data) = saved
+        ml_prediction.invalidate_ewma_cache()
+
+def main():
+    print("\n" + "="*70)
+    print("  CleanRoute Kernel Consistency Test")
+    print("="*70)
+    print("\n   No database, no MQTT, no backend server needed\n")
+
+    tests = [
+        test_ewma_paths,
+        test_nn_kernels,
+        test_bin_row_merge,
+        test_collection_paths,
+    ]
+
+    failed = 0
+    for test_func in tests:
+        try:
+            test_func()
+        except AssertionError as e:
+            print(f"\n[FAIL] {test_func.__name__}: {e}")
+            failed += 1
+
+    print_section("Test Summary")
+    print(f"[PASS] Passed: {len(tests) - failed}")
+    print(f"[FAIL] Failed: {failed}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())